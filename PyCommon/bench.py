@@ -0,0 +1,445 @@
+import argparse
+import csv
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+# Scripted sessions of the three apps under SDL's dummy video driver. Every
+# scenario runs the real app script in a child process (so peak memory is its
+# own) and feeds it events frame by frame; the results are flat JSON, one
+# dict of metrics per scenario, and can be compared against an earlier run:
+#   python bench.py -o bench.json --baseline old.json
+# exits with 1 when a metric got worse by more than the tolerance.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+# lower is better except for throughput; differences under the floor of a
+# unit are noise however large they are relative to a tiny value
+FLOORS = {'_ms': 1.0, 'wall_s': 0.05, '.seconds': 0.05, '_mb': 5.0}
+
+
+def percentiles(values, prefix, out):
+    if not values:
+        return
+    values = sorted(values)
+    for p in (50, 90, 99):
+        out[f'{prefix}.p{p}'] = round(values[min(len(values) - 1, len(values) * p // 100)], 3)
+    out[f'{prefix}.max'] = round(values[-1], 3)
+    out[f'{prefix}.mean'] = round(sum(values) / len(values), 3)
+
+
+class Session:
+    # What the app sees instead of a user: scripted events, dialogs that
+    # answer from the script and a clock that never sleeps. Records the time
+    # between presented frames, from each keystroke to the frame showing it,
+    # and timed I/O sections (whose frames are left out of the frame times).
+    def __init__(self, script, data, scale):
+        self.script = script
+        self.data = data
+        self.scale = scale
+        self.app = None
+        self.events = None
+        self.answer = ''
+        self.mouse = (0, 0)
+        self.stash = []
+        self.frames = []
+        self.keys = []
+        self.pending_keys = []
+        self.io = {}
+        self.timing = None
+        self.last_present = None
+        self.started = time.perf_counter()
+        self.startup = None
+
+    # -- hooks into pygame and tkinter
+
+    def install(self, pygame):
+        self.pygame = pygame
+        self.real_get = pygame.event.get
+        pygame.event.get = self.get
+        pygame.event.wait = self.wait
+        self.real_flip, self.real_update = pygame.display.flip, pygame.display.update
+        pygame.display.flip = self.flip
+        pygame.display.update = self.update
+        pygame.mouse.get_pos = lambda: self.mouse
+        session = self
+
+        class Clock:
+            # frames run back to back: the benchmark measures work, not FPS caps
+            def __init__(self):
+                self.last = time.perf_counter()
+
+            def tick(self, framerate=0):
+                now = time.perf_counter()
+                ms, self.last = int((now - self.last) * 1000), now
+                return ms
+
+            def get_fps(self):
+                return 0.0
+        pygame.time.Clock = Clock
+
+        tk = types.ModuleType('tkinter')
+        tk.Tk = lambda: types.SimpleNamespace(withdraw=lambda: None, destroy=lambda: None)
+        filedialog = types.ModuleType('tkinter.filedialog')
+        filedialog.askopenfilename = filedialog.asksaveasfilename = lambda **kw: session.answer
+        colorchooser = types.ModuleType('tkinter.colorchooser')
+        colorchooser.askcolor = lambda **kw: (None, None)
+        messagebox = types.ModuleType('tkinter.messagebox')
+        messagebox.askyesno = lambda *a, **kw: False
+        messagebox.showerror = messagebox.showinfo = messagebox.showwarning = lambda *a, **kw: None
+        tk.filedialog, tk.colorchooser, tk.messagebox = filedialog, colorchooser, messagebox
+        sys.modules.update({'tkinter': tk, 'tkinter.filedialog': filedialog,
+                            'tkinter.colorchooser': colorchooser, 'tkinter.messagebox': messagebox})
+
+    def get(self, *args, **kwargs):
+        self.real_get()
+        if self.stash:
+            batch, self.stash = self.stash, []
+            return batch
+        if self.events is None:
+            self.events = self.script(self, self.app)
+        try:
+            batch = next(self.events)
+        except StopIteration:
+            batch = [self.pygame.event.Event(self.pygame.QUIT)]
+        now = time.perf_counter()
+        for event in batch:
+            if hasattr(event, 'pos'):
+                self.mouse = event.pos
+            if event.type == self.pygame.KEYDOWN:
+                self.pending_keys.append(now)
+        return batch
+
+    def wait(self, timeout=0):
+        batch = self.get()
+        if not batch:
+            return self.pygame.event.Event(self.pygame.NOEVENT)
+        # the rest of the batch comes with the next get()
+        self.stash = batch[1:]
+        return batch[0]
+
+    def flip(self):
+        self.real_flip()
+        self._presented()
+
+    def update(self, *args):
+        self.real_update(*args)
+        self._presented()
+
+    def _presented(self):
+        now = time.perf_counter()
+        if self.startup is None:
+            self.startup = (now - self.started) * 1000
+        elif self.timing is None and self.last_present is not None:
+            self.frames.append((now - self.last_present) * 1000)
+        self.last_present = now
+        self.keys.extend((now - t) * 1000 for t in self.pending_keys)
+        self.pending_keys = []
+
+    # -- helpers for scripts
+
+    def start(self, name):
+        self.timing = (name, time.perf_counter())
+
+    def stop(self, name, path=None, count=None, unit=None):
+        # path: the file read or written, for MB/s; count/unit: e.g. rows
+        seconds = time.perf_counter() - self.timing[1]
+        self.timing = None
+        self.last_present = None
+        self.pending_keys = []
+        result = {'seconds': round(seconds, 4)}
+        if path is not None:
+            result['mb_per_s'] = round(os.path.getsize(path) / 1e6 / seconds, 2)
+        if count is not None:
+            result[f'{unit}_per_s'] = round(count / seconds, 1)
+        self.io[name] = result
+
+    def until(self, done, limit=300):
+        # idle frames until done() holds
+        deadline = time.perf_counter() + limit
+        while not done():
+            if time.perf_counter() > deadline:
+                raise RuntimeError("benchmark step timed out")
+            yield []
+
+    def click(self, pos, button=1):
+        E = self.pygame.event.Event
+        return [E(self.pygame.MOUSEBUTTONDOWN, button=button, pos=pos),
+                E(self.pygame.MOUSEBUTTONUP, button=button, pos=pos)]
+
+    def drag(self, start, end, steps, button=1):
+        E = self.pygame.event.Event
+        yield [E(self.pygame.MOUSEBUTTONDOWN, button=button, pos=start)]
+        for i in range(1, steps + 1):
+            pos = (start[0] + (end[0] - start[0]) * i // steps, start[1] + (end[1] - start[1]) * i // steps)
+            yield [E(self.pygame.MOUSEMOTION, pos=pos, rel=(0, 0), buttons=(1, 0, 0))]
+        yield [E(self.pygame.MOUSEBUTTONUP, button=button, pos=end)]
+
+    def type(self, text):
+        for ch in text:
+            yield [self.pygame.event.Event(self.pygame.KEYDOWN, key=ord(ch.lower()), mod=0, unicode=ch, scancode=0)]
+
+    def result(self):
+        out = {'wall_s': round(time.perf_counter() - self.started, 3),
+               'startup_ms': round(self.startup or 0.0, 3),
+               'frames': len(self.frames)}
+        percentiles(self.frames, 'frame_ms', out)
+        percentiles(self.keys, 'key_latency_ms', out)
+        for name, values in self.io.items():
+            for key, value in values.items():
+                out[f'io.{name}.{key}'] = value
+        try:
+            import resource
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # kilobytes on Linux, bytes on macOS
+            out['peak_rss_mb'] = round(rss / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+        except ImportError:
+            pass
+        return out
+
+
+# -- data
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+
+
+def make_csv(path, rows, rnd):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        for r in range(rows):
+            writer.writerow([str(r), rnd.choice(WORDS), f"{rnd.random() * 1000:.2f}", str(rnd.randrange(100))])
+        # a few formulas over the whole column, as a real sheet would have
+        writer.writerow(["", "", f"=SUM(C1:C{rows})", f"=AVERAGE(D1:D{rows})"])
+
+
+def make_document(path, paragraphs, rnd):
+    # PyWord's JSON format: a list of characters per paragraph
+    lines = []
+    for _ in range(paragraphs):
+        text = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randrange(5, 40)))
+        lines.append([[c, [], 20, [0, 0, 0]] for c in text])
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"lines": lines}, f)
+
+
+def make_deck(path, slides, items, busy, rnd):
+    # PyPoint's JSON format; the first slide is the busy one
+    deck = []
+    for s in range(slides):
+        n = busy if s == 0 else items
+        deck.append([{'text': rnd.choice(WORDS), 'font_size': rnd.choice((16, 20, 24, 32)),
+                      'pos': (rnd.randrange(210, 900), rnd.randrange(60, 620))} for _ in range(n)])
+    with open(path, 'w') as f:
+        json.dump(deck, f)
+    return deck
+
+
+# -- scenarios: (app dir, script, session(session, app globals) -> events)
+
+def excel_session(s, app):
+    rows = int(100000 * s.scale)
+    src, out = os.path.join(s.data, 'big.csv'), os.path.join(s.data, 'out.csv')
+    make_csv(src, rows, random.Random(1))
+    yield []
+    s.answer = src
+    s.start('load_csv')
+    yield s.click(app['load_button'].center)
+    yield from s.until(lambda: app['file_job'] is None)
+    s.stop('load_csv', src, rows, 'rows')
+    # scroll down the grid by panning with the right button
+    for _ in range(30):
+        yield from s.drag((600, 550), (520, 150), 8, button=3)
+    # type into a cell
+    yield s.click((250, 200))
+    yield from s.type("benchmark typing " * 6)
+    s.answer = out
+    s.start('save_csv')
+    yield s.click(app['save_button'].center)
+    yield from s.until(lambda: app['file_job'] is None and not app['io_worker'].busy())
+    s.stop('save_csv', out, rows, 'rows')
+
+
+def word_session(s, app):
+    paragraphs = int(4000 * s.scale)
+    src, out = os.path.join(s.data, 'long.json'), os.path.join(s.data, 'out.pword')
+    make_document(src, paragraphs, random.Random(2))
+    toolbar = app['Toolbar'](app['WIN_W'])
+    yield []
+    s.answer = src
+    s.start('load_json')
+    yield s.click(toolbar.load_btn.center)
+    yield []
+    s.stop('load_json', src, paragraphs, 'paragraphs')
+    E = s.pygame.event.Event
+    s.mouse = (app['WIN_W'] // 2, app['WIN_H'] // 2)
+    for _ in range(40):
+        yield [E(s.pygame.MOUSEWHEEL, x=0, y=-3, flipped=False)]
+    yield s.click(s.mouse)
+    yield from s.type("The quick brown fox jumps over the lazy dog. " * 5)
+    s.answer = out
+    s.start('save_pword')
+    yield s.click(toolbar.save_btn.center)
+    yield from s.until(lambda: not app['io_worker'].busy())
+    s.stop('save_pword', out, paragraphs, 'paragraphs')
+
+
+def point_session(s, app):
+    slides, busy = int(200 * s.scale), int(400 * s.scale)
+    src, out = os.path.join(s.data, 'deck.json'), os.path.join(s.data, 'out.json')
+    deck = make_deck(src, slides, 20, busy, random.Random(3))
+    load = next(b for b in app['buttons'] if b.text == 'Load')
+    save = next(b for b in app['buttons'] if b.text == 'Save')
+    yield []
+    s.answer = src
+    s.start('load_json')
+    yield s.click(load.rect.center)
+    yield []
+    s.stop('load_json', src, slides, 'slides')
+    # drag single items around the busy slide, then a marquee and a group drag
+    slide = app['slide_mgr'].get_current()
+    for item in slide.items[-20:]:
+        start = item.rect.center
+        yield from s.drag(start, (start[0] + 60, start[1] + 40), 10)
+    yield from s.drag((215, 65), (700, 400), 10)
+    start = next(it for it in slide.items if it.selected).rect.center
+    yield from s.drag(start, (start[0] - 30, start[1] + 30), 10)
+    s.answer = out
+    s.start('save_json')
+    yield s.click(save.rect.center)
+    yield from s.until(lambda: not app['io_worker'].busy())
+    s.stop('save_json', out, len(deck), 'slides')
+
+
+SCENARIOS = {
+    'excel': ('PyExcel', 'Excel.py', excel_session),
+    'word': ('PyWord', 'word.py', word_session),
+    'point': ('PyPoint', 'powerpoint.py', point_session),
+}
+
+
+def run_child(name, data, scale, out):
+    # inside the child: run the app with a Session in place of the user. The
+    # working folder is a scratch copy with the app's config.cfg, so journals
+    # and autosaves never land next to the real app.
+    folder, script, session_fn = SCENARIOS[name]
+    app_dir = os.path.join(ROOT, folder)
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    os.chdir(data)
+    shutil.copy(os.path.join(app_dir, 'config.cfg'), 'config.cfg')
+    sys.path.insert(0, app_dir)
+    import pygame
+    session = Session(session_fn, data, scale)
+    session.install(pygame)
+    path = os.path.join(app_dir, script)
+    with open(path, encoding='utf-8') as f:
+        code = compile(f.read(), path, 'exec')
+    session.app = {'__name__': '__main__', '__file__': path}
+    sys.argv = [path]
+    try:
+        exec(code, session.app)
+    except SystemExit:
+        pass
+    with open(out, 'w') as f:
+        json.dump(session.result(), f)
+
+
+def run(name, scale):
+    data = tempfile.mkdtemp(prefix=f'bench-{name}-')
+    try:
+        out = os.path.join(data, 'result.json')
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--child', name,
+                        '--data', data, '--scale', str(scale), '--out', out],
+                       check=True, stdout=subprocess.DEVNULL)
+        with open(out) as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(data, ignore_errors=True)
+
+
+def median_runs(runs):
+    merged = {}
+    for key in runs[0]:
+        values = sorted(r[key] for r in runs if key in r)
+        merged[key] = values[len(values) // 2]
+    return merged
+
+
+def compare(results, baseline, tolerance):
+    # -> [(scenario, metric, old, new, change, regressed)]
+    rows = []
+    for name, metrics in results.items():
+        before = baseline.get(name, {})
+        for key, new in metrics.items():
+            old = before.get(key)
+            if old is None or key == 'frames' or key.endswith('.max') or not old:
+                continue
+            higher_better = key.endswith('_per_s')
+            change = (new - old) / old
+            worse = -change if higher_better else change
+            if higher_better:
+                # throughput is as noisy as the duration of its section
+                seconds = key.rsplit('.', 1)[0] + '.seconds'
+                noise = abs(metrics.get(seconds, 0) - before.get(seconds, 0)) <= FLOORS['.seconds']
+            else:
+                noise = abs(new - old) <= next((v for unit, v in FLOORS.items() if unit in key), 0.0)
+            regressed = worse > tolerance and not noise
+            rows.append((name, key, old, new, round(change, 4), regressed))
+    return rows
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='bench.py', description="headless benchmarks of PyExcel, PyWord and PyPoint")
+    parser.add_argument('scenarios', nargs='*', help=f"scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('-o', '--out', help="write the results here as JSON (default: stdout)")
+    parser.add_argument('--baseline', help="results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="relative change counted as a regression (default 0.2)")
+    parser.add_argument('--scale', type=float, default=1.0, help="size of the generated files (default 1.0)")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per scenario; the median of each metric is kept")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--data', help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.child:
+        run_child(args.child, args.data, args.scale, args.out)
+        return 0
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        build_parser().error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    results = {}
+    for name in args.scenarios or list(SCENARIOS):
+        print(f"{name}...", file=sys.stderr)
+        results[name] = median_runs([run(name, args.scale) for _ in range(max(1, args.repeat))])
+    report = {'scale': args.scale, 'results': results}
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare(results, baseline.get('results', {}), args.tolerance)
+        report['comparison'] = [dict(zip(('scenario', 'metric', 'baseline', 'current', 'change', 'regression'), row))
+                                for row in rows]
+        for name, key, old, new, change, regressed in rows:
+            if regressed:
+                print(f"REGRESSION {name} {key}: {old} -> {new} ({change:+.0%})", file=sys.stderr)
+                status = 1
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+import os
+from collections import OrderedDict
+
+import pygame
+
+
+class FontCache:
+    # Fonts pooled by (face, size, bold, italic, underline) and rendered text
+    # surfaces kept in an LRU bounded by their pixel memory. Surfaces handed
+    # out are shared, so callers only blit them and never draw on them.
+    # face is None for pygame's default font, a font file or a system font name.
+    def __init__(self, max_bytes=8 << 20):
+        self.max_bytes = max_bytes
+        self.fonts = {}
+        self.surfaces = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def font(self, size, face=None, bold=False, italic=False, underline=False):
+        key = (face, size, bold, italic, underline)
+        font = self.fonts.get(key)
+        if font is None:
+            if face is None or os.path.isfile(face):
+                font = pygame.font.Font(face, size)
+                font.set_bold(bold)
+                font.set_italic(italic)
+            else:
+                font = pygame.font.SysFont(face, size, bold=bold, italic=italic)
+            font.set_underline(underline)
+            self.fonts[key] = font
+        return font
+
+    def render(self, text, color, size, face=None, bold=False, italic=False, underline=False):
+        key = (text, tuple(color), face, size, bold, italic, underline)
+        entry = self.surfaces.get(key)
+        if entry is not None:
+            self.surfaces.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        surf = self.font(size, face, bold, italic, underline).render(text, True, color)
+        nbytes = surf.get_pitch() * surf.get_height()
+        if nbytes <= self.max_bytes:
+            self.surfaces[key] = (surf, nbytes)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                _, (_, old) = self.surfaces.popitem(last=False)
+                self.bytes -= old
+                self.evictions += 1
+        return surf
+
+    def invalidate(self, text, color, size, face=None, bold=False, italic=False, underline=False):
+        # drop a string that will not be drawn again (e.g. an edited cell's old value)
+        entry = self.surfaces.pop((text, tuple(color), face, size, bold, italic, underline), None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        self.surfaces.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'surfaces': len(self.surfaces), 'fonts': len(self.fonts),
+                'bytes': self.bytes, 'max_bytes': self.max_bytes}
@@ -0,0 +1,100 @@
+import multiprocessing
+import os
+import zlib
+
+import pygame
+
+from iowork import write_atomic
+
+# pages are drawn at 96 pixels per inch, PDF measures in 1/72 inch
+PT_PER_PX = 0.75
+
+
+def start():
+    # pygame without a window: SDL's dummy video driver, offscreen surfaces and fonts
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.display.init()
+    pygame.font.init()
+
+
+def render_all(render, tasks, jobs=None):
+    # render(task) for every task on a pool of worker processes (one per core
+    # by default); results come back in the order of tasks
+    if jobs == 1 or len(tasks) < 2:
+        start()
+        return [render(task) for task in tasks]
+    # closed and joined rather than terminated: SDL turns SIGTERM into a
+    # quit event, so a terminated worker would never exit
+    pool = multiprocessing.Pool(jobs, initializer=start)
+    try:
+        return pool.map(render, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def export(documents, out, pdf, render, jobs=None):
+    # documents: [(name, [page, ...]), ...]. Every page of every document is
+    # one task for render((page, png)); png is the file to write, or None when
+    # the page should come back from pdf_page for <name>.pdf.
+    os.makedirs(out, exist_ok=True)
+    tasks = []
+    for name, pages in documents:
+        for i, page in enumerate(pages):
+            tasks.append((page, None if pdf else os.path.join(out, f"{name}-{i + 1:03}.png")))
+    results = render_all(render, tasks, jobs)
+    if pdf:
+        done = 0
+        for name, pages in documents:
+            write_pdf(os.path.join(out, name + '.pdf'), results[done:done + len(pages)])
+            done += len(pages)
+    return len(tasks)
+
+
+def finish_page(surface, png):
+    if png:
+        pygame.image.save(surface, png)
+        return None
+    return pdf_page(surface)
+
+
+def pdf_page(surface):
+    # compressed in the worker, so write_pdf only has to copy bytes
+    w, h = surface.get_size()
+    return w, h, zlib.compress(pygame.image.tobytes(surface, 'RGB'))
+
+
+def write_pdf(path, pages):
+    # pages: [(width, height, zlib-compressed RGB), ...] from pdf_page, one
+    # full-page image each. Objects: 1 catalog, 2 page tree, then a page, its
+    # content stream and its image for every page.
+    def write(f):
+        offsets = []
+
+        def obj(body, stream=None):
+            offsets.append(f.tell())
+            f.write(b'%d 0 obj\n' % len(offsets))
+            if stream is None:
+                f.write(body + b'\nendobj\n')
+            else:
+                f.write(body[:-2] + b' /Length %d >>\nstream\n' % len(stream))
+                f.write(stream + b'\nendstream\nendobj\n')
+
+        f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        kids = b' '.join(b'%d 0 R' % (3 + 3 * i) for i in range(len(pages)))
+        obj(b'<< /Type /Catalog /Pages 2 0 R >>')
+        obj(b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(pages)))
+        for i, (w, h, data) in enumerate(pages):
+            n = 3 + 3 * i
+            pw, ph = w * PT_PER_PX, h * PT_PER_PX
+            obj(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] '
+                b'/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>' % (pw, ph, n + 2, n + 1))
+            obj(b'<< >>', b'q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q' % (pw, ph))
+            obj(b'<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB '
+                b'/BitsPerComponent 8 /Filter /FlateDecode >>' % (w, h), data)
+        xref = f.tell()
+        f.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(offsets) + 1))
+        for offset in offsets:
+            f.write(b'%010d 00000 n \n' % offset)
+        f.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(offsets) + 1, xref))
+    write_atomic(path, write, binary=True)
@@ -0,0 +1,141 @@
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+
+
+def write_atomic(path, write, binary=False, encoding='utf-8', newline=None):
+    # write(f) fills a temp file next to `path`, which then replaces it in one
+    # rename; a crash or error part way leaves the old file untouched
+    folder, name = os.path.split(os.path.abspath(path))
+    tmp = os.path.join(folder, f'.{name}.{uuid.uuid4().hex[:8]}.tmp')
+    try:
+        if binary:
+            f = open(tmp, 'xb')
+        else:
+            f = open(tmp, 'x', encoding=encoding, newline=newline)
+        with f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class Job:
+    def __init__(self, path, write, options, seq):
+        self.path = path
+        self.write = write
+        self.options = options
+        self.seq = seq
+        self.error = None
+        self.skipped = False
+        self._done = threading.Event()
+
+    @property
+    def finished(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+
+class IOWorker:
+    # A few writer threads behind one queue. The main thread takes a cheap
+    # snapshot and submits a function that serializes it. Saves to one path
+    # never overlap, and one that finds a newer snapshot already written is
+    # skipped instead of putting older data back.
+    def __init__(self, threads=2):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.written = {}
+        self.path_locks = {}
+        self.seq = 0
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(threads)]
+        for t in self.threads:
+            t.start()
+
+    def submit(self, path, write, **options):
+        # options go to write_atomic: binary, encoding, newline
+        path = os.path.abspath(path)
+        with self.lock:
+            self.seq += 1
+            self.path_locks.setdefault(path, threading.Lock())
+            job = Job(path, write, options, self.seq)
+        self.queue.put(job)
+        return job
+
+    def busy(self):
+        return self.queue.unfinished_tasks > 0
+
+    def close(self):
+        # lets queued writes finish, so quitting right after Save loses nothing
+        self.queue.join()
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            try:
+                with self.path_locks[job.path]:
+                    if self.written.get(job.path, 0) > job.seq:
+                        job.skipped = True
+                    else:
+                        write_atomic(job.path, job.write, **job.options)
+                        self.written[job.path] = job.seq
+            except Exception as e:
+                job.error = e
+            finally:
+                job._done.set()
+                self.queue.task_done()
+
+
+# start time and pid: several instances in one folder, or a later one that got
+# the same pid, never write over each other's untitled autosave
+SESSION = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+
+
+def autosave_path(path, untitled):
+    # autosaves are always written in the format `untitled` is named for, so
+    # they take its extension even next to a document of another kind
+    # (book.xlsx -> book.xlsx.autosave.csv)
+    root, ext = os.path.splitext(untitled)
+    if path:
+        return f"{path}.autosave{ext}"
+    return f"{root}-{SESSION}{ext}"
+
+
+class Autosave:
+    # Paces periodic background saves from the main loop: due() says when to
+    # take a snapshot, and never while the previous autosave is still writing.
+    def __init__(self, worker, interval):
+        self.worker = worker
+        self.interval = interval
+        self.last = time.monotonic()
+        self.job = None
+
+    def due(self):
+        if self.interval <= 0 or (self.job is not None and not self.job.finished):
+            return False
+        now = time.monotonic()
+        if now - self.last < self.interval:
+            return False
+        self.last = now
+        return True
+
+    def save(self, path, write, **options):
+        self.job = self.worker.submit(path, write, **options)
+        return self.job
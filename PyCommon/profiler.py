@@ -0,0 +1,250 @@
+import json
+import os
+import time
+from collections import deque
+
+import pygame
+
+from iowork import write_atomic
+
+# Opt-in timing of the main loops (PROFILE = 1 in config.cfg). Every frame is
+# cut into phases: enter(name) ends the current phase and starts the next one,
+# `with phase(name)` times a part nested inside it. Phase times are exclusive,
+# so nested ones are not counted twice. F3 shows the averages of the last
+# frames on screen. F4 starts recording a Chrome trace and writes it when
+# pressed again (or at exit), on the app's iowork.IOWorker; open it in
+# chrome://tracing or ui.perfetto.dev. Disabled, every call returns at once.
+
+HUD_KEY, TRACE_KEY = pygame.K_F3, pygame.K_F4
+HISTORY = 120
+# newest events kept while tracing: about 100 MB of JSON at most
+TRACE_LIMIT = 500000
+HUD_REFRESH = 0.25
+HUD_BG = (20, 20, 20)
+HUD_TEXT = (230, 230, 230)
+
+
+class _Null:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL = _Null()
+
+
+class _Phase:
+    __slots__ = ('profiler', 'name')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._push(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._pop()
+        return False
+
+
+class Profiler:
+    def __init__(self, app, enabled=False, trace_file='', worker=None):
+        self.app = app
+        # traces are written on the worker; without one, on the spot
+        self.worker = worker
+        self.job = None
+        self.enabled = enabled
+        self.hud = False
+        self.stack = []            # [name, start, time spent in nested phases]
+        self.totals = {}
+        self.counts = {}
+        self.sources = []          # (name, stats function, keys shown per second)
+        self.history = deque(maxlen=HISTORY)
+        self.frame_start = None
+        self.t0 = time.perf_counter()
+        self.trace = None
+        self.trace_file = trace_file
+        self.hud_font = None
+        self.hud_image = None
+        self.hud_at = 0.0
+        self.hud_sample = None
+        if enabled and trace_file:
+            self.start_trace()
+
+    # -- timing
+
+    def frame(self):
+        # call first thing in every loop iteration
+        if not self.enabled:
+            return
+        job = self.job
+        if job is not None and job.finished:
+            self.job = None
+            if job.error is not None:
+                pygame.display.set_caption(f"{self.app} - trace: {job.error}")
+        now = time.perf_counter()
+        while self.stack:
+            self._pop(now)
+        if self.frame_start is not None:
+            self.history.append((now - self.frame_start, self.totals, self.counts))
+            if self.trace is not None:
+                self._event('frame', self.frame_start, now)
+                ts = (now - self.t0) * 1e6
+                if self.counts:
+                    self.trace.append({'name': 'counts', 'ph': 'C', 'ts': ts, 'pid': os.getpid(),
+                                       'args': self.counts})
+                for name, stats, _ in self.sources:
+                    self.trace.append({'name': name, 'ph': 'C', 'ts': ts, 'pid': os.getpid(), 'args': stats()})
+            self.totals, self.counts = {}, {}
+        self.frame_start = now
+
+    def enter(self, name):
+        # ends the current phase of the frame and starts `name`
+        if not self.enabled:
+            return
+        job = self.job
+        if job is not None and job.finished:
+            self.job = None
+            if job.error is not None:
+                pygame.display.set_caption(f"{self.app} - trace: {job.error}")
+        now = time.perf_counter()
+        while self.stack:
+            self._pop(now)
+        self.stack.append([name, now, 0.0])
+
+    def phase(self, name):
+        if not self.enabled:
+            return NULL
+        return _Phase(self, name)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def watch(self, name, stats, rates=()):
+        # stats() -> {key: number}, shown on the HUD and sampled into the
+        # trace every frame; keys in `rates` are counters shown per second
+        self.sources.append((name, stats, rates))
+
+    def _push(self, name):
+        self.stack.append([name, time.perf_counter(), 0.0])
+
+    def _pop(self, now=None):
+        if now is None:
+            now = time.perf_counter()
+        name, start, nested = self.stack.pop()
+        spent = now - start
+        self.totals[name] = self.totals.get(name, 0.0) + spent - nested
+        if self.stack:
+            self.stack[-1][2] += spent
+        if self.trace is not None:
+            self._event(name, start, now)
+
+    # -- trace
+
+    def _event(self, name, start, end):
+        self.trace.append({'name': name, 'ph': 'X', 'ts': (start - self.t0) * 1e6,
+                           'dur': (end - start) * 1e6, 'pid': os.getpid(), 'tid': 1})
+
+    def start_trace(self):
+        self.trace = deque(maxlen=TRACE_LIMIT)
+
+    def stop_trace(self):
+        # -> the file being written, or None when nothing was being recorded;
+        # the JSON of up to TRACE_LIMIT events takes seconds, so not here
+        if self.trace is None:
+            return None
+        events, self.trace = list(self.trace), None
+        path = self.trace_file or f"{self.app.lower()}-trace-{time.strftime('%Y%m%d-%H%M%S')}.json"
+        meta = {'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': self.app}}
+
+        def write(f):
+            json.dump({'traceEvents': [meta] + events, 'displayTimeUnit': 'ms'}, f)
+        if self.worker is None:
+            write_atomic(path, write)
+        else:
+            self.job = self.worker.submit(path, write)
+        return path
+
+    def close(self):
+        # before the worker's close(), which then waits for the trace
+        if self.enabled:
+            return self.stop_trace()
+        return None
+
+    # -- keys and overlay
+
+    def handle_event(self, event):
+        # True when the event was one of the profiler's keys
+        if not self.enabled or event.type != pygame.KEYDOWN:
+            return False
+        if event.key == HUD_KEY:
+            self.hud = not self.hud
+            self.hud_image = None
+        elif event.key == TRACE_KEY:
+            if self.trace is None:
+                self.start_trace()
+            else:
+                path = self.stop_trace()
+                pygame.display.set_caption(f"{self.app} - trace: {path}")
+        else:
+            return False
+        return True
+
+    def draw(self, surface):
+        # the overlay in the top right corner; -> its rect, or None if hidden
+        if not self.hud or not self.enabled:
+            return None
+        self.enter('hud')
+        now = time.perf_counter()
+        if self.hud_image is None or now - self.hud_at >= HUD_REFRESH:
+            self.hud_image = self._render_hud(now)
+            self.hud_at = now
+        rect = self.hud_image.get_rect(topright=(surface.get_width() - 5, 5))
+        surface.blit(self.hud_image, rect)
+        return rect
+
+    def _render_hud(self, now):
+        frames = len(self.history) or 1
+        frame_ms = sum(f[0] for f in self.history) * 1000 / frames
+        phases, counts = {}, {}
+        for _, totals, frame_counts in self.history:
+            for name, spent in totals.items():
+                phases[name] = phases.get(name, 0.0) + spent
+            for name, n in frame_counts.items():
+                counts[name] = counts.get(name, 0) + n
+        lines = [f"frame {frame_ms:.2f} ms ({1000 / frame_ms if frame_ms else 0:.0f} fps)"]
+        lines += [f"{name}: {spent * 1000 / frames:.2f} ms" for name, spent in sorted(phases.items())]
+        lines += [f"{name}: {n / frames:.1f} per frame" for name, n in sorted(counts.items())]
+        sample = {name: stats() for name, stats, _ in self.sources}
+        elapsed = now - self.hud_at
+        for name, stats, rates in self.sources:
+            parts = []
+            for key, value in sample[name].items():
+                if key in rates:
+                    if self.hud_sample is not None and elapsed > 0:
+                        parts.append(f"{key} {(value - self.hud_sample[name][key]) / elapsed:.0f}/s")
+                elif key.endswith('bytes'):
+                    parts.append(f"{key} {value / (1 << 20):.1f} MB")
+                else:
+                    parts.append(f"{key} {value}")
+            lines.append(f"{name}: " + ', '.join(parts))
+        self.hud_sample = sample
+        if self.trace is not None:
+            lines.append(f"trace: {len(self.trace)} events (F4 - write)")
+        if self.hud_font is None:
+            self.hud_font = pygame.font.Font(None, 20)
+        images = [self.hud_font.render(line, True, HUD_TEXT) for line in lines]
+        width = max(image.get_width() for image in images) + 10
+        # opaque, so drawing it again over itself in dirty-rect apps changes nothing
+        hud = pygame.Surface((width, sum(image.get_height() for image in images) + 10))
+        hud.fill(HUD_BG)
+        y = 5
+        for image in images:
+            hud.blit(image, (5, y))
+            y += image.get_height()
+        return hud
@@ -1,24 +1,35 @@
 import pygame
-import string
+import os
+import sys
 import csv
+import string
 import tkinter as tk
 from tkinter import filedialog
 import configparser
+from sheet import Sheet, get_column_label, column_index
+from colindex import parse_condition
+from csvio import CSVExporter, open_importer, open_pool, write_rows
+from filejobs import Importer
+from xlsxio import XLSXImporter, XLSXExporter, is_xlsx
+from formula import FormulaEngine
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PyCommon'))
+from iowork import IOWorker, Autosave, autosave_path
+from fontcache import FontCache
+from profiler import Profiler
 
 config = configparser.ConfigParser()
 config.read('config.cfg')
 
+# CSV files from this size on are parsed by worker processes (0 - by all cores);
+# they are forked now, while this is the only thread
+PARALLEL_IMPORT_BYTES = config.getint('excel', 'PARALLEL_IMPORT_MB', fallback=32) << 20
+IMPORT_PROCESSES = config.getint('excel', 'IMPORT_PROCESSES', fallback=0)
+import_pool = open_pool(IMPORT_PROCESSES)
+
 pygame.init()
 root = tk.Tk()
 root.withdraw()
 
-def get_column_label(index):
-    label = ''
-    while index >= 0:
-        label = chr(index % 26 + ord('A')) + label
-        index = index // 26 - 1
-    return label
-
 WIDTH, HEIGHT = config.getint('General', 'WIDHT'), config.getint('General', 'HEIGHT')
 CELL_WIDTH, CELL_HEIGHT = 100, 50
 TOOLBAR_HEIGHT = 70
@@ -41,10 +52,15 @@ YELLOW        = (200, 200, 0)
 
 screen = pygame.display.set_mode((WIDTH, HEIGHT))
 pygame.display.set_caption("PyExcel")
-font = pygame.font.SysFont(None, 24)
+FONT_SIZE = 24
+text_cache = FontCache(config.getint('excel', 'TEXT_CACHE_KB', fallback=4096) * 1024)
+io_worker = IOWorker()
+profiler = Profiler("PyExcel", config.getboolean('excel', 'PROFILE', fallback=False),
+                    config.get('excel', 'TRACE_FILE', fallback=''), io_worker)
+profiler.watch('text', text_cache.stats, ('hits', 'misses', 'evictions'))
 
-cells = [["" for _ in range(COLS)] for _ in range(ROWS)]
-cell_colors = [[WHITE for _ in range(COLS)] for _ in range(ROWS)]
+sheet = Sheet(WHITE)
+engine = FormulaEngine(sheet)
 selected_cell = None
 
 offset_x, offset_y = 0, 0
@@ -57,6 +73,17 @@ input_rows_str = str(ROWS)
 active_input = None 
 input_cols_rect = pygame.Rect(10, 5, 80, 30)
 input_rows_rect = pygame.Rect(100, 5, 80, 30)
+input_filter_rect = pygame.Rect(320, 20, 200, 30)
+input_filter_str = ""
+
+# sort / filter: view_rows lists the sheet rows in the order they are drawn,
+# None shows the sheet as it is
+sort_asc_button = pygame.Rect(200, 20, 50, 30)
+sort_desc_button = pygame.Rect(260, 20, 50, 30)
+reset_view_button = pygame.Rect(530, 20, 90, 30)
+view_rows = None
+view_filtered = False
+view_base = 0
 
 save_button = pygame.Rect(WIDTH - 100, 20, 90, 30)
 load_button = pygame.Rect(WIDTH - 200, 20, 90, 30)
@@ -68,52 +95,163 @@ color_buttons = {
 }
 color_map = {'white': WHITE, 'green': GREEN, 'red': RED, 'yellow': YELLOW}
 
+file_job = None
+progress_rect = pygame.Rect(10, 45, 170, 15)
+autosave = Autosave(io_worker, config.getint('excel', 'AUTOSAVE_SECONDS', fallback=60))
+autosaved_version = sheet.version
+current_path = None
+FILE_TYPES = [("CSV files", "*.csv"), ("Excel files", "*.xlsx")]
+
 def save_file():
-    path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files","*.csv")])
+    global file_job, current_path
+    if file_job is not None:
+        return
+    path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=FILE_TYPES)
     if path:
-        with open(path, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerows(cells)
+        if is_xlsx(path):
+            file_job = XLSXExporter(path, sheet, io_worker, engine)
+        else:
+            file_job = CSVExporter(path, sheet, io_worker)
+        file_job.start()
+        current_path = path
 
 def load_file():
-    path = filedialog.askopenfilename(filetypes=[("CSV files","*.csv")])
+    global file_job, current_path
+    if file_job is not None:
+        return
+    path = filedialog.askopenfilename(filetypes=FILE_TYPES)
     if path:
-        with open(path, 'r', encoding='utf-8') as f:
-            reader = csv.reader(f)
-            for i, row in enumerate(reader):
-                if i < ROWS:
-                    for j, v in enumerate(row):
-                        if j < COLS:
-                            cells[i][j] = v
+        if is_xlsx(path):
+            file_job = XLSXImporter(path)
+        else:
+            file_job = open_importer(path, sheet, processes=IMPORT_PROCESSES,
+                                     min_bytes=PARALLEL_IMPORT_BYTES, pool=import_pool)
+        file_job.start()
+        current_path = path
 
-running = True
-while running:
-    screen.fill(WHITE)
+def autosave_sheet():
+    # snapshot on this thread, the CSV is written on the I/O worker
+    global autosaved_version
+    job = autosave.job
+    if job is not None and job.finished and job.error:
+        pygame.display.set_caption(f"PyExcel - {job.error}")
+        autosave.job = None
+    if file_job is not None or sheet.version == autosaved_version or not autosave.due():
+        return
+    autosaved_version = sheet.version
+    values = dict(sheet.values)
+    autosave.save(autosave_path(current_path, 'autosave.csv'),
+                  lambda f: write_rows(csv.writer(f), values), newline='')
+
+def poll_file_job():
+    global file_job, ROWS, COLS, input_cols_str, input_rows_str, autosaved_version, view_rows
+    if file_job is None:
+        return
+    done = file_job.apply(sheet)
+    used_rows, used_cols = sheet.used_range()
+    if used_rows > ROWS or used_cols > COLS:
+        ROWS, COLS = max(ROWS, used_rows), max(COLS, used_cols)
+        input_cols_str, input_rows_str = str(COLS), str(ROWS)
+    if done:
+        if isinstance(file_job, Importer):
+            engine.rebuild()
+            view_rows = None
+            autosaved_version = sheet.version
+        if file_job.error:
+            pygame.display.set_caption(f"PyExcel - {file_job.error}")
+        file_job = None
+
+def sheet_row(row):
+    # the sheet row drawn at grid row `row`, None past the end of a filter
+    if view_rows is None:
+        return row
+    if row < len(view_rows):
+        return view_rows[row]
+    if view_filtered:
+        return None
+    # after a sort the empty rows below the data follow in order
+    return view_base + row - len(view_rows)
+
+def sort_view(descending):
+    global view_rows, view_filtered, view_base
+    if selected_cell is None:
+        return
+    view_rows = sheet.sorted_rows(selected_cell[1], descending)
+    view_filtered = False
+    view_base = sheet.used_range()[0]
 
-    for col in range(COLS):
-        x = CELL_WIDTH + col*CELL_WIDTH + offset_x
-        y = TOOLBAR_HEIGHT + offset_y
-        label = get_column_label(col)
-        text = font.render(label, True, BLACK)
-        screen.blit(text, (x + (CELL_WIDTH-text.get_width())//2,
-                           y + (CELL_HEIGHT-text.get_height())//2))
-
-    for row in range(ROWS):
-        num_txt = font.render(str(row+1), True, BLACK)
-        x_num = offset_x + (CELL_WIDTH-num_txt.get_width())//2
-        y_num = GRID_Y_OFFSET + row*CELL_HEIGHT + offset_y + (CELL_HEIGHT-num_txt.get_height())//2
-        screen.blit(num_txt, (x_num, y_num))
-        for col in range(COLS):
+def filter_view(text):
+    global view_rows, view_filtered
+    try:
+        label, op, value = parse_condition(text)
+    except ValueError as e:
+        pygame.display.set_caption(f"PyExcel - {e}")
+        return
+    view_rows = sheet.filter_rows(column_index(label), op, value)
+    view_filtered = True
+    pygame.display.set_caption(f"PyExcel - {len(view_rows)} строк")
+
+def draw_progress():
+    pygame.draw.rect(screen, INPUT_BG, progress_rect)
+    filled = progress_rect.copy()
+    filled.width = int(progress_rect.width * file_job.progress())
+    pygame.draw.rect(screen, GREEN, filled)
+    pygame.draw.rect(screen, BLACK, progress_rect, 1)
+
+def visible_range(offset, origin, cell, view_start, view_end, count):
+    first = max(0, (view_start - origin - offset) // cell)
+    last = min(count, -((origin + offset - view_end) // cell))
+    return first, max(first, last)
+
+def draw_grid():
+    first_col, last_col = visible_range(offset_x, CELL_WIDTH, CELL_WIDTH, 0, WIDTH, COLS)
+    first_row, last_row = visible_range(offset_y, GRID_Y_OFFSET, CELL_HEIGHT, TOOLBAR_HEIGHT, HEIGHT, ROWS)
+
+    y = TOOLBAR_HEIGHT + offset_y
+    if y + CELL_HEIGHT > TOOLBAR_HEIGHT:
+        for col in range(first_col, last_col):
+            x = CELL_WIDTH + col*CELL_WIDTH + offset_x
+            label = get_column_label(col)
+            text = text_cache.render(label, BLACK, FONT_SIZE)
+            screen.blit(text, (x + (CELL_WIDTH-text.get_width())//2,
+                               y + (CELL_HEIGHT-text.get_height())//2))
+
+    show_numbers = offset_x + CELL_WIDTH > 0
+    for grid_row in range(first_row, last_row):
+        y = GRID_Y_OFFSET + grid_row*CELL_HEIGHT + offset_y
+        row = sheet_row(grid_row)
+        if row is None:
+            break
+        if show_numbers:
+            num_txt = text_cache.render(str(row+1), BLACK, FONT_SIZE)
+            x_num = offset_x + (CELL_WIDTH-num_txt.get_width())//2
+            y_num = y + (CELL_HEIGHT-num_txt.get_height())//2
+            screen.blit(num_txt, (x_num, y_num))
+        for col in range(first_col, last_col):
             x = CELL_WIDTH + col*CELL_WIDTH + offset_x
-            y = GRID_Y_OFFSET + row*CELL_HEIGHT + offset_y
             rect = pygame.Rect(x,y,CELL_WIDTH,CELL_HEIGHT)
-            pygame.draw.rect(screen, cell_colors[row][col], rect)
+            pygame.draw.rect(screen, sheet.get_color(row, col), rect)
             if selected_cell==(row,col): pygame.draw.rect(screen, LIGHT_BLUE, rect, 3)
             pygame.draw.rect(screen, BLACK, rect, 1)
-            ct = font.render(cells[row][col], True, BLACK)
-            screen.blit(ct, (x+5,y+5))
+            value = sheet.get(row, col) if selected_cell==(row,col) else engine.display(row, col)
+            if value:
+                ct = text_cache.render(value, BLACK, FONT_SIZE)
+                screen.blit(ct, (x+5,y+5))
 
+running = True
+while running:
+    profiler.frame()
+    profiler.enter('io')
+    poll_file_job()
+    autosave_sheet()
+    profiler.enter('draw')
+    screen.fill(WHITE)
+    draw_grid()
+
+    profiler.enter('events')
     for event in pygame.event.get():
+        if profiler.handle_event(event):
+            continue
         if event.type==pygame.QUIT:
             running=False
         elif event.type==pygame.MOUSEBUTTONDOWN and event.button==1:
@@ -122,18 +260,23 @@ while running:
                 active_input='cols'
             elif input_rows_rect.collidepoint(mx,my):
                 active_input='rows'
+            elif input_filter_rect.collidepoint(mx,my):
+                active_input='filter'
             else:
                 active_input=None
                 if save_button.collidepoint(mx,my): save_file()
                 if load_button.collidepoint(mx,my): load_file()
+                if sort_asc_button.collidepoint(mx,my): sort_view(False)
+                if sort_desc_button.collidepoint(mx,my): sort_view(True)
+                if reset_view_button.collidepoint(mx,my): view_rows = None
                 for nm, r in color_buttons.items():
                     if r.collidepoint(mx,my) and selected_cell:
-                        cells[selected_cell[0]][selected_cell[1]] = cells[selected_cell[0]][selected_cell[1]]
+                        sheet.set_color(selected_cell[0], selected_cell[1], color_map[nm])
                         break
                 if mx>CELL_WIDTH+offset_x and my>GRID_Y_OFFSET+offset_y:
                     c = (mx-CELL_WIDTH-offset_x)//CELL_WIDTH
                     r = (my-GRID_Y_OFFSET-offset_y)//CELL_HEIGHT
-                    if 0<=r<ROWS and 0<=c<COLS: selected_cell=(r,c)
+                    if 0<=r<ROWS and 0<=c<COLS and sheet_row(r) is not None: selected_cell=(sheet_row(r),c)
                     
         elif event.type==pygame.KEYDOWN:
             if active_input in ('cols','rows'):
@@ -146,18 +289,33 @@ while running:
                     val = int(s)
                     if active_input=='cols': COLS = val
                     else: ROWS = val
-                    cells = [["" for _ in range(COLS)] for _ in range(ROWS)]
-                    cell_colors = [[WHITE for _ in range(COLS)] for _ in range(ROWS)]
+                    if selected_cell and (selected_cell[0] >= ROWS or selected_cell[1] >= COLS):
+                        selected_cell = None
                     offset_x, offset_y = 0,0
                     input_cols_str, input_rows_str = str(COLS), str(ROWS)
                 if active_input=='cols': input_cols_str = s
                 else: input_rows_str = s
+            elif active_input=='filter':
+                if event.key==pygame.K_BACKSPACE:
+                    input_filter_str = input_filter_str[:-1]
+                elif event.key==pygame.K_RETURN:
+                    filter_view(input_filter_str)
+                elif event.unicode.isprintable():
+                    input_filter_str += event.unicode
             elif selected_cell and event.type==pygame.KEYDOWN:
                 r,c=selected_cell
+                value = sheet.get(r, c)
+                # arrows, Shift, F-keys: no text, nothing to recalculate or autosave
                 if event.key==pygame.K_BACKSPACE:
-                    cells[r][c]=cells[r][c][:-1]
+                    new_value = value[:-1]
+                elif event.unicode and event.unicode.isprintable():
+                    new_value = value + event.unicode
                 else:
-                    cells[r][c]+=event.unicode
+                    new_value = value
+                if new_value != value:
+                    text_cache.invalidate(value, BLACK, FONT_SIZE)
+                    sheet.set(r, c, new_value)
+                    engine.update(r, c)
         elif event.type==pygame.MOUSEBUTTONDOWN and event.button==3:
             is_panning=True
             pan_start=event.pos
@@ -177,6 +335,7 @@ while running:
             min_off_y=min(0,view_h-total_h)
             offset_x=max(min_off_x, min(0, offset_x))
             offset_y=max(min_off_y, min(0, offset_y))
+    profiler.enter('draw')
     pygame.draw.rect(screen, GRAY, (0,0,WIDTH,TOOLBAR_HEIGHT))
 
     bg_cols = INPUT_ACTIVE if active_input=='cols' else INPUT_BG
@@ -185,20 +344,34 @@ while running:
     txt_rows_color = WHITE if active_input=='rows' else BLACK
     pygame.draw.rect(screen, bg_cols, input_cols_rect)
     pygame.draw.rect(screen, bg_rows, input_rows_rect)
-    txt_c = font.render(f"Cols: {input_cols_str}", True, txt_cols_color)
-    txt_r = font.render(f"Rows: {input_rows_str}", True, txt_rows_color)
+    txt_c = text_cache.render(f"Cols: {input_cols_str}", txt_cols_color, FONT_SIZE)
+    txt_r = text_cache.render(f"Rows: {input_rows_str}", txt_rows_color, FONT_SIZE)
     screen.blit(txt_c, (input_cols_rect.x+5, input_cols_rect.y+5))
     screen.blit(txt_r, (input_rows_rect.x+5, input_rows_rect.y+5))
+    pygame.draw.rect(screen, INPUT_ACTIVE if active_input=='filter' else INPUT_BG, input_filter_rect)
+    txt_f = text_cache.render(f"Фильтр: {input_filter_str}", WHITE if active_input=='filter' else BLACK, FONT_SIZE)
+    screen.blit(txt_f, (input_filter_rect.x+5, input_filter_rect.y+5))
     
     mouse_pos = pygame.mouse.get_pos()
-    for b, label in [(save_button, "Сохранить"), (load_button, "Загрузить")]:
+    for b, label in [(save_button, "Сохранить"), (load_button, "Загрузить"), (sort_asc_button, "A-Z"),
+                     (sort_desc_button, "Z-A"), (reset_view_button, "Сброс")]:
         clr = BUTTON_HOVER if b.collidepoint(mouse_pos) else BUTTON_COLOR
         pygame.draw.rect(screen, clr, b)
-        t = font.render(label, True, BLACK)
+        t = text_cache.render(label, BLACK, FONT_SIZE)
         screen.blit(t, (b.x+(b.width-t.get_width())//2, b.y+(b.height-t.get_height())//2))
     for name, rect in color_buttons.items():
         pygame.draw.rect(screen, color_map[name], rect)
         pygame.draw.rect(screen, BLACK, rect, 1)
+    if file_job is not None:
+        draw_progress()
+    profiler.draw(screen)
+    profiler.enter('present')
     pygame.display.flip()
 
+if file_job is not None:
+    file_job.close()
+profiler.close()
+io_worker.close()
+if import_pool is not None:
+    import_pool.terminate()
 pygame.quit()
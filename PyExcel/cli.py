@@ -0,0 +1,114 @@
+import argparse
+import csv
+import sys
+
+from colindex import parse_condition as split_condition
+from formula import FUNCTIONS
+from sheet import column_index
+from workbook import Workbook
+
+
+def parse_condition(text):
+    # -> (column, operator, value) for Sheet.filter_rows
+    try:
+        col, op, expected = split_condition(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return column_index(col), op, expected
+
+
+def cmd_convert(args):
+    Workbook.open(args.src, args.encoding).save(args.dst, args.values, args.encoding)
+
+
+def cmd_filter(args):
+    # through the sheet's column indexes, so it matches the window's filter
+    wb = Workbook.open(args.src, args.encoding)
+    keep = None
+    for col, op, expected in args.where:
+        rows = set(wb.sheet.filter_rows(col, op, expected))
+        keep = rows if keep is None else keep & rows
+    if args.header:
+        keep.add(0)
+    with open(args.dst, 'w', newline='', encoding=args.encoding) as f:
+        writer = csv.writer(f)
+        for row in sorted(keep):
+            writer.writerow(wb.row(row, values=True))
+
+
+def cmd_sort(args):
+    # rows reordered through the sheet's column index, stable like Excel;
+    # values, as for filter: moved formulas would point at other rows
+    wb = Workbook.open(args.src, args.encoding)
+    rows = wb.sheet.sorted_rows(column_index(args.column), args.desc)
+    with open(args.dst, 'w', newline='', encoding=args.encoding) as f:
+        writer = csv.writer(f)
+        if args.header:
+            writer.writerow(wb.row(0, values=True))
+        for row in rows:
+            if not (args.header and row == 0):
+                writer.writerow(wb.row(row, values=True))
+
+
+def cmd_aggregate(args):
+    out = csv.writer(sys.stdout, delimiter='\t', lineterminator='\n')
+    for path in args.files:
+        wb = Workbook.open(path, args.encoding)
+        results = [wb.evaluate(f"{args.func}({wb.column_range(col.upper())})") for col in args.columns]
+        out.writerow([path] + results)
+
+
+def cmd_eval(args):
+    for path in args.files:
+        wb = Workbook.open(path, args.encoding)
+        print(f"{path}\t{wb.evaluate(args.expr)}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='cli.py', description="PyExcel without a window")
+    parser.add_argument('--encoding', default='utf-8')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('convert', help="re-save a sheet, optionally with formulas replaced by values")
+    p.add_argument('src')
+    p.add_argument('dst')
+    p.add_argument('--values', action='store_true', help="write computed values instead of formulas")
+    p.set_defaults(handler=cmd_convert)
+
+    p = sub.add_parser('filter', help="keep rows matching every condition, e.g. 'B>10' or 'A~text'")
+    p.add_argument('src')
+    p.add_argument('dst')
+    p.add_argument('-w', '--where', action='append', type=parse_condition, default=[], required=True)
+    p.add_argument('--header', action='store_true', help="always keep the first row")
+    p.set_defaults(handler=cmd_filter)
+
+    p = sub.add_parser('sort', help="sort rows by one column, numbers before text")
+    p.add_argument('src')
+    p.add_argument('dst')
+    p.add_argument('column', help="column label, e.g. B")
+    p.add_argument('--desc', action='store_true')
+    p.add_argument('--header', action='store_true', help="keep the first row on top")
+    p.set_defaults(handler=cmd_sort)
+
+    p = sub.add_parser('aggregate', help="aggregate whole columns of one or more sheets")
+    p.add_argument('func', type=str.upper, choices=sorted(FUNCTIONS))
+    p.add_argument('columns', help="comma separated column labels, e.g. B,C")
+    p.add_argument('files', nargs='+')
+    p.set_defaults(handler=cmd_aggregate)
+
+    p = sub.add_parser('eval', help="evaluate a formula against each sheet, e.g. 'SUM(B1:B10)/2'")
+    p.add_argument('expr')
+    p.add_argument('files', nargs='+')
+    p.set_defaults(handler=cmd_eval)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == 'aggregate':
+        args.columns = [c.strip() for c in args.columns.split(',') if c.strip()]
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import re
+from bisect import bisect_left, bisect_right, insort
+from datetime import date
+
+from columns import to_number
+
+CONDITION_RE = re.compile(r"^\s*([A-Za-z]+)\s*(==|!=|<=|>=|=|<|>|~)\s*(.*)$")
+ROW_MAX = float('inf')
+# 2024-01-31, 2024-01-31 12:30[:15[.5]] (or with a T), 31.01.2024, 31/01/24
+DATE_RE = re.compile(r'\s*(?:(\d{4})-(\d{1,2})-(\d{1,2})(?:[ T](\d{1,2}):(\d{2})(?::(\d{2}(?:\.\d+)?))?)?'
+                     r'|(\d{1,2})[./](\d{1,2})[./](\d{4}|\d{2}))\s*')
+# day 0, as in Excel, so day numbers match the ones in xlsx files
+EPOCH = date(1899, 12, 30).toordinal()
+
+
+def date_key(raw):
+    # day number of a date (the time as a fraction of a day), None if it is not one
+    m = DATE_RE.fullmatch(raw)
+    if m is None:
+        return None
+    year, month, day, hour, minute, second, d, mo, y = m.groups()
+    if year is None:
+        year, month, day = int(y), mo, d
+        if len(y) == 2:
+            year += 2000 if year < 69 else 1900
+    try:
+        days = date(int(year), int(month), int(day)).toordinal() - EPOCH
+    except ValueError:
+        return None
+    if hour is None:
+        return float(days)
+    second = float(second or 0)
+    if int(hour) > 23 or int(minute) > 59 or second >= 60:
+        return None
+    return days + (int(hour) * 3600 + int(minute) * 60 + second) / 86400
+
+
+def sort_key(raw, dates=False):
+    # how a cell sorts: numbers as floats, any other text case-insensitively;
+    # in a column of dates (dates=True) those sort as their day number
+    number = to_number(raw)
+    if number is None and dates:
+        number = date_key(raw)
+    if number is not None and number == number:
+        return number
+    return raw.casefold()
+
+
+def parse_condition(text):
+    # 'B>10', 'A=x', 'C~part' -> (column label, operator, value)
+    m = CONDITION_RE.match(text)
+    if not m:
+        raise ValueError(f"bad condition: {text!r}")
+    col, op, value = m.groups()
+    return col, '=' if op == '==' else op, value
+
+
+class SortedKeys:
+    # Sorted list kept as blocks of at most 2*LOAD keys plus the last key of
+    # each block: a two level B-tree. Finding a key is two bisects, inserting
+    # or removing one only moves the keys of its block.
+    LOAD = 512
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        self.blocks = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        self.maxes = [block[-1] for block in self.blocks]
+        self.size = len(keys)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, key):
+        self.size += 1
+        if not self.blocks:
+            self.blocks.append([key])
+            self.maxes.append(key)
+            return
+        i = min(bisect_left(self.maxes, key), len(self.blocks) - 1)
+        block = self.blocks[i]
+        insort(block, key)
+        self.maxes[i] = block[-1]
+        if len(block) > 2 * self.LOAD:
+            self.blocks.insert(i + 1, block[self.LOAD:])
+            del block[self.LOAD:]
+            self.maxes.insert(i, block[-1])
+
+    def remove(self, key):
+        i = bisect_left(self.maxes, key)
+        block = self.blocks[i]
+        del block[bisect_left(block, key)]
+        self.size -= 1
+        if block:
+            self.maxes[i] = block[-1]
+        else:
+            del self.blocks[i]
+            del self.maxes[i]
+
+    def irange(self, lo=None, hi=None, reverse=False):
+        # keys with lo <= key <= hi (None = unbounded), ascending or descending
+        # whole blocks are yielded as slices, only the two ends are bisected
+        blocks = self.blocks
+        if not reverse:
+            i = 0 if lo is None else bisect_left(self.maxes, lo)
+            j = 0 if lo is None or i == len(blocks) else bisect_left(blocks[i], lo)
+            while i < len(blocks):
+                block = blocks[i]
+                if hi is not None and block[-1] > hi:
+                    yield from block[j:bisect_right(block, hi)]
+                    return
+                yield from block[j:]
+                i, j = i + 1, 0
+        else:
+            i = len(blocks) - 1 if hi is None else min(bisect_right(self.maxes, hi), len(blocks) - 1)
+            k = None if hi is None or i < 0 else bisect_right(blocks[i], hi)
+            while i >= 0:
+                block = blocks[i]
+                if lo is not None and block[0] < lo:
+                    yield from reversed(block[bisect_left(block, lo):k])
+                    return
+                yield from reversed(block[:k])
+                i, k = i - 1, None
+
+
+class ColumnIndex:
+    # The values of one column in sorted order, as (value, row) keys: numbers
+    # in one tree, text in another (numbers sort before text, like Excel).
+    # Sheet keeps it in step with every edit once it has been built.
+    def __init__(self, cells, dates=False):
+        # cells: (row, key) pairs, key from sort_key(raw, dates)
+        self.dates = dates
+        self.keys = keys = dict(cells)
+        # rows sorted by a plain float or str key (much cheaper than comparing
+        # tuples) and stably, so equal values stay in row order
+        for name, kind in (('numbers', float), ('texts', str)):
+            rows = sorted([row for row, key in keys.items() if isinstance(key, kind)])
+            rows.sort(key=keys.__getitem__)
+            setattr(self, name, SortedKeys(zip(map(keys.__getitem__, rows), rows)))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _tree(self, key):
+        return self.numbers if isinstance(key, float) else self.texts
+
+    def update(self, row, key):
+        # key None removes the row
+        old = self.keys.get(row)
+        if old == key and type(old) is type(key):
+            return
+        if old is not None:
+            self._tree(old).remove((old, row))
+            del self.keys[row]
+        if key is not None:
+            self._tree(key).add((key, row))
+            self.keys[row] = key
+
+    def equal(self, key, r1=0, r2=ROW_MAX):
+        # rows in r1..r2 holding key, top to bottom
+        for _, row in self._tree(key).irange((key, r1), (key, r2)):
+            yield row
+
+    def between(self, lo, hi):
+        # rows whose key is in lo..hi (both the same type), in key order
+        for _, row in self._tree(lo).irange((lo, -1), (hi, ROW_MAX)):
+            yield row
+
+    def select(self, op, raw):
+        # rows matching one filter condition, top to bottom
+        key = sort_key(raw, self.dates)
+        if op == '=':
+            return list(self.equal(key))
+        if op == '~':
+            part = raw.casefold()
+            return sorted([row for row, k in self.keys.items() if isinstance(k, str) and part in k])
+        if op == '!=':
+            return sorted([row for row, k in self.keys.items() if k != key or type(k) is not type(key)])
+        tree = self._tree(key)
+        if op in ('<', '<='):
+            keys = tree.irange(None, (key, ROW_MAX if op == '<=' else -1))
+        else:
+            keys = tree.irange((key, -1 if op == '>=' else ROW_MAX), None)
+        rows = [row for _, row in keys]
+        rows.sort()
+        return rows
+
+    def ordered(self, descending=False):
+        # every indexed row by value; rows with equal values stay top to bottom
+        if not descending:
+            for tree in (self.numbers, self.texts):
+                for _, row in tree.irange():
+                    yield row
+            return
+        for tree in (self.texts, self.numbers):
+            group, value = [], None
+            for key, row in tree.irange(reverse=True):
+                if group and key != value:
+                    yield from reversed(group)
+                    group = []
+                group.append(row)
+                value = key
+            yield from reversed(group)
+
+    def lookup(self, key, r1, r2, match=0):
+        # MATCH-style search among rows r1..r2 -> row or None.
+        # match 0: first exact match; 1: the largest value <= key;
+        # -1: the smallest value >= key (only values of key's type count)
+        tree = self._tree(key)
+        if match == 0:
+            return next(self.equal(key, r1, r2), None)
+        if match > 0:
+            keys = tree.irange(None, (key, ROW_MAX), reverse=True)
+        else:
+            keys = tree.irange((key, -1), None)
+        for _, row in keys:
+            if r1 <= row <= r2:
+                return row
+        return None
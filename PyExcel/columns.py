@@ -0,0 +1,106 @@
+import re
+from array import array
+from itertools import compress
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# what counts as a number in a cell; float() alone also takes nan, inf,
+# 1_000 and non-ASCII digits
+NUMBER_RE = re.compile(r'\s*[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?\s*')
+
+
+def to_number(raw):
+    if NUMBER_RE.fullmatch(raw) is None:
+        return None
+    number = float(raw)
+    # 1e400 overflows to inf
+    return number if number - number == 0 else None
+
+
+class NumericColumn:
+    # Typed shadow of one column: values[row] holds the number (0.0 when the
+    # cell is empty or not numeric) and valid[row] says whether it counts.
+    def __init__(self):
+        self.values = array('d')
+        self.valid = bytearray()
+
+    def __len__(self):
+        return len(self.valid)
+
+    def set(self, row, number):
+        if number is None:
+            self.clear(row)
+            return
+        if row >= len(self.valid):
+            self._grow(row + 1)
+        self.values[row] = number
+        self.valid[row] = 1
+
+    def set_many(self, rows, numbers, valid):
+        # rows ascending, numbers/valid side by side with them (0.0 where not valid)
+        if not rows:
+            return
+        if rows[-1] >= len(self.valid):
+            self._grow(rows[-1] + 1)
+        first, n = rows[0], len(rows)
+        if rows[-1] - first + 1 == n:
+            # consecutive rows, the usual case: two slice copies
+            self.values[first:first + n] = numbers
+            self.valid[first:first + n] = valid
+            return
+        values, flags = self.values, self.valid
+        for row, number, ok in zip(rows, numbers, valid):
+            values[row] = number
+            flags[row] = ok
+
+    def clear(self, row):
+        if row < len(self.valid):
+            self.values[row] = 0.0
+            self.valid[row] = 0
+
+    def _grow(self, size):
+        size = max(size, 2 * len(self.valid), 64)
+        extra = size - len(self.valid)
+        self.values.frombytes(bytes(8 * extra))
+        self.valid.extend(bytes(extra))
+
+    def reduce(self, kind, r1, r2):
+        # kind is 'sum', 'count', 'min' or 'max' over rows r1..r2 inclusive;
+        # min/max give None when there is no number in the block
+        r2 = min(r2, len(self.valid) - 1)
+        if r2 < r1:
+            return None if kind in ('min', 'max') else 0
+        if numpy is not None:
+            return self._reduce_numpy(kind, r1, r2 + 1)
+        if kind == 'sum':
+            return sum(self.values[r1:r2 + 1])
+        valid = self.valid[r1:r2 + 1]
+        if kind == 'count':
+            return valid.count(1)
+        numbers = compress(self.values[r1:r2 + 1], valid)
+        return (min if kind == 'min' else max)(numbers, default=None)
+
+    def _reduce_numpy(self, kind, start, stop):
+        values = numpy.frombuffer(self.values, dtype=numpy.float64)[start:stop]
+        if kind == 'sum':
+            return float(values.sum())
+        valid = numpy.frombuffer(self.valid, dtype=numpy.bool_)[start:stop]
+        if kind == 'count':
+            return int(numpy.count_nonzero(valid))
+        numbers = values[valid]
+        if not len(numbers):
+            return None
+        return float(numbers.min() if kind == 'min' else numbers.max())
+
+
+def combine(kind, parts):
+    if kind in ('sum', 'count'):
+        return sum(parts)
+    parts = [p for p in parts if p is not None]
+    if not parts:
+        return None
+    return min(parts) if kind == 'min' else max(parts)
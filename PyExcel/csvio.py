@@ -0,0 +1,398 @@
+import codecs
+import csv
+import io
+import multiprocessing
+import os
+import queue
+import re
+import signal
+from array import array
+from collections import deque
+from itertools import accumulate, islice
+from multiprocessing import resource_tracker, shared_memory
+
+from colindex import DATE_RE
+from columns import to_number
+from filejobs import Importer, Exporter
+
+CHUNK_ROWS = 2000
+# the parallel import: files from this size on, parsed in ranges of about
+# RANGE_BYTES each (small enough that merging one takes a frame or two)
+PARALLEL_MIN_BYTES = 32 << 20
+RANGE_BYTES = 1 << 20
+INT_RE = re.compile(r'\s*[+-]?[0-9]+\s*')
+
+
+class CSVImporter(Importer):
+    # Hands over chunks of parsed rows, chunk_rows at a time, with the type
+    # of each column in them (worked out here, off the main thread); apply()
+    # merges those into Sheet.column_types.
+    errors = (OSError, UnicodeDecodeError, csv.Error)
+
+    def __init__(self, path, encoding='utf-8', chunk_rows=CHUNK_ROWS):
+        super().__init__(path)
+        self.encoding = encoding
+        self.chunk_rows = chunk_rows
+        self.total = os.path.getsize(path)
+        self.rows_done = 0
+
+    def _read(self):
+        with open(self.path, 'rb') as raw:
+            reader = csv.reader(io.TextIOWrapper(raw, encoding=self.encoding, newline=''))
+            start, chunk = 0, []
+            for row in reader:
+                chunk.append(row)
+                if len(chunk) >= self.chunk_rows:
+                    self.position = raw.tell()
+                    if not self._put((start, chunk, _chunk_types(chunk, start))):
+                        return
+                    start += len(chunk)
+                    chunk = []
+            if chunk:
+                self._put((start, chunk, _chunk_types(chunk, start)))
+            self.position = self.total
+
+    def _apply_item(self, sheet, item):
+        start, rows, types = item
+        for i, row in enumerate(rows, start):
+            for j, v in enumerate(row):
+                sheet.set(i, j, v)
+        _merge_types(sheet, types)
+        self.rows_done = start + len(rows)
+
+
+class ParallelCSVImporter(CSVImporter):
+    # CSVImporter for big files on all cores. The file is cut into byte ranges
+    # that start on a record boundary: a newline outside quotes, found from
+    # the number of quotes before it (counted on the pool too). Every range is
+    # parsed by a worker process into a shared memory block, column by column:
+    # row numbers, to_number() results and the texts as one UTF-8 string (the
+    # column's type is worked out there too, see _column_type()). Only
+    # the block's name and layout are pickled back; apply() merges the columns
+    # into the sheet with Sheet.load_column. Workers are forked, so this is
+    # only used where fork exists; see open_importer() and open_pool().
+    def __init__(self, path, encoding='utf-8', processes=None, pool=None):
+        super().__init__(path, encoding)
+        self.processes = processes or os.cpu_count() or 1
+        # a pool from open_pool() is shared and stays up; without one the
+        # workers are forked here, on the caller's thread, not from run()
+        self.own_pool = pool is None
+        self.pool = open_pool(self.processes) if pool is None else pool
+
+    def _read(self):
+        pool = self.pool
+        pending = deque()
+        try:
+            ranges = self._ranges(pool)
+            if ranges is None:
+                # unbalanced quotes: boundaries cannot be trusted, read it in one go
+                return super()._read()
+            rows = 0
+            for start, end in ranges:
+                pending.append(pool.apply_async(_parse_range, (self.path, start, end, self.encoding)))
+                if len(pending) < 2 * self.processes:
+                    continue
+                rows = self._deliver(pending.popleft().get(), rows)
+                if rows is None:
+                    return
+            while pending:
+                rows = self._deliver(pending.popleft().get(), rows)
+                if rows is None:
+                    return
+        finally:
+            # blocks nobody is going to merge any more
+            for result in pending:
+                try:
+                    _release(result.get().name)
+                except Exception:
+                    pass
+            if self.cancelled:
+                self._drain()
+            if self.own_pool:
+                pool.close()
+                pool.join()
+
+    def _ranges(self, pool):
+        # [(start, end), ...] of whole records; None if the quotes do not pair up
+        size = self.total
+        splits = list(range(0, size, RANGE_BYTES))
+        counts = pool.map(_count_quotes, [(self.path, a, min(a + RANGE_BYTES, size)) for a in splits],
+                          chunksize=64)
+        if sum(counts) % 2:
+            return None
+        starts = [0]
+        with open(self.path, 'rb') as f:
+            for offset, quotes in zip(splits[1:], accumulate(counts)):
+                if offset <= starts[-1]:
+                    continue
+                start = _record_start(f, offset, quotes % 2 == 1)
+                if start is None or start >= size:
+                    break
+                if start > starts[-1]:
+                    starts.append(start)
+        return list(zip(starts, starts[1:] + [size]))
+
+    def _deliver(self, block, rows):
+        # -> rows so far, None when cancelled
+        block.start_row = rows
+        self.position = block.end
+        if not self._put(block):
+            _release(block.name)
+            return None
+        return rows + block.rows
+
+    def _drain(self):
+        while True:
+            try:
+                item = self.chunks.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(item, _Block):
+                _release(item.name)
+
+    def _apply_item(self, sheet, item):
+        if not isinstance(item, _Block):
+            return super()._apply_item(sheet, item)
+        shm = shared_memory.SharedMemory(name=item.name)
+        try:
+            buf = shm.buf
+            pos = 0
+            for col, n, size in item.columns:
+                rows = array('i')
+                rows.frombytes(buf[pos:pos + 4 * n])
+                pos += 4 * n
+                numbers = array('d')
+                numbers.frombytes(buf[pos:pos + 8 * n])
+                pos += 8 * n
+                offsets = array('q')
+                offsets.frombytes(buf[pos:pos + 8 * (n + 1)])
+                pos += 8 * (n + 1)
+                valid = bytes(buf[pos:pos + n])
+                pos += n
+                text = str(buf[pos:pos + size], 'utf-8')
+                pos += size
+                texts = [text[a:b] for a, b in zip(offsets, islice(offsets, 1, None))]
+                if item.start_row:
+                    rows = [row + item.start_row for row in rows]
+                sheet.load_column(col, rows, texts, numbers, valid)
+            del buf
+            _merge_types(sheet, item.types)
+        finally:
+            shm.close()
+            shm.unlink()
+        self.rows_done = item.start_row + item.rows
+
+
+class _Block:
+    # what a worker sends back: where its shared memory is and how it is laid out
+    def __init__(self, name, rows, end, columns, types):
+        self.name = name
+        self.rows = rows
+        self.end = end
+        self.columns = columns      # [(col, cells, text bytes)]
+        self.types = types          # {col: type}, see _column_type()
+        self.start_row = 0
+
+
+def open_pool(processes=None):
+    # the worker processes of the parallel import, None where fork does not
+    # exist. A forked child gets a copy of every lock other threads hold at
+    # that moment, so an app calls this before it starts any (SDL, Tk, the
+    # I/O worker). spawn or forkserver would not have that problem, but they
+    # import the app's main script again in every worker.
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    return multiprocessing.get_context('fork').Pool(processes or os.cpu_count() or 1,
+                                                    initializer=_worker_init)
+
+
+def open_importer(path, sheet, encoding='utf-8', processes=None, min_bytes=PARALLEL_MIN_BYTES, pool=None):
+    # the parallel importer where it pays off and can be used: a big file, an
+    # empty sheet (it writes only the cells that are not empty), fork, and an
+    # encoding that keeps '\n' and '"' as single bytes
+    try:
+        ascii_safe = codecs.lookup(encoding).name not in ('utf-16', 'utf-32') and \
+            '\n"'.encode(encoding) == b'\n"'
+    except LookupError:
+        ascii_safe = False
+    if (not sheet.values and ascii_safe and os.path.getsize(path) >= min_bytes
+            and 'fork' in multiprocessing.get_all_start_methods()):
+        return ParallelCSVImporter(path, encoding, processes, pool)
+    return CSVImporter(path, encoding)
+
+
+def _worker_init():
+    # Ctrl+C in the terminal is for the app; a worker is stopped by the pool
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _count_quotes(task):
+    path, start, end = task
+    count = 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        left = end - start
+        while left > 0:
+            block = f.read(min(left, 1 << 20))
+            if not block:
+                break
+            count += block.count(b'"')
+            left -= len(block)
+    return count
+
+
+def _record_start(f, offset, inside):
+    # first offset after `offset` where a record starts, given whether
+    # `offset` is inside a quoted field; None at the end of the file
+    f.seek(offset)
+    pos = offset
+    while True:
+        block = f.read(1 << 16)
+        if not block:
+            return None
+        i = 0
+        while True:
+            n = block.find(b'\n', i)
+            if n < 0:
+                inside ^= block.count(b'"', i) % 2 == 1
+                break
+            inside ^= block.count(b'"', i, n) % 2 == 1
+            if not inside:
+                return pos + n + 1
+            i = n + 1
+        pos += len(block)
+
+
+def _parse_range(path, start, end, encoding):
+    # runs in a worker: one range of whole records into a shared memory block
+    with open(path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode(encoding)
+    cells = {}
+    rows = 0
+    for rows, record in enumerate(csv.reader(io.StringIO(text, newline='')), 1):
+        for c, v in enumerate(record):
+            if v:
+                column = cells.get(c)
+                if column is None:
+                    column = cells[c] = ([], [])
+                column[0].append(rows - 1)
+                column[1].append(v)
+    del text
+    parts, columns, types = [], [], {}
+    for c in sorted(cells):
+        row_list, texts = cells.pop(c)
+        numbers = list(map(to_number, texts))
+        valid = bytes([n is not None for n in numbers])
+        # the file's first row is taken for a header, whatever it holds
+        skip = 1 if start == 0 and row_list[0] == 0 else 0
+        types[c] = _column_type(texts[skip:], valid[skip:])
+        blob = ''.join(texts).encode('utf-8')
+        offsets = array('q', [0])
+        offsets.extend(accumulate(map(len, texts)))
+        parts += [array('i', row_list), array('d', [0.0 if n is None else n for n in numbers]),
+                  offsets, valid, blob]
+        columns.append((c, len(texts), len(blob)))
+    views = [memoryview(part).cast('B') for part in parts]
+    shm = shared_memory.SharedMemory(create=True, size=max(1, sum(map(len, views))))
+    try:
+        # the app owns the block from here; without this the worker's resource
+        # tracker would remove it when the pool shuts down
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        pos = 0
+        for view in views:
+            shm.buf[pos:pos + len(view)] = view
+            pos += len(view)
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    name = shm.name
+    shm.close()
+    return _Block(name, rows, end, columns, types)
+
+
+def _column_type(texts, valid):
+    # 'int', 'float', 'date' or 'string' for the non-empty cells of a column
+    # (valid: which of them are numbers); None when there are none
+    if not texts:
+        return None
+    if all(valid):
+        return 'int' if all(map(INT_RE.fullmatch, texts)) else 'float'
+    if not any(valid) and all(map(DATE_RE.fullmatch, texts)):
+        return 'date'
+    return 'string'
+
+
+def _chunk_types(rows, start):
+    # _column_type() per column of a chunk of rows starting at row `start`
+    columns = {}
+    for row in rows[1:] if start == 0 else rows:
+        for c, v in enumerate(row):
+            if v:
+                texts = columns.get(c)
+                if texts is None:
+                    texts = columns[c] = []
+                texts.append(v)
+    return {c: _column_type(texts, [to_number(v) is not None for v in texts]) for c, texts in columns.items()}
+
+
+def _merge_types(sheet, types):
+    # a column is int/float/date only if every part of the file says so
+    for col, kind in types.items():
+        old = sheet.column_types.get(col)
+        if kind is None or old == kind:
+            continue
+        if old is not None:
+            kind = 'float' if {old, kind} == {'int', 'float'} else 'string'
+        sheet.set_column_type(col, kind)
+
+
+def _release(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+class CSVExporter(Exporter):
+    # The used range as CSV.
+    def __init__(self, path, sheet, worker, encoding='utf-8'):
+        self.values = dict(sheet.values)
+        super().__init__(path, worker, len(self.values), encoding=encoding, newline='')
+
+    def _write(self, f):
+        write_rows(csv.writer(f), self.values, self._count)
+
+
+def write_rows(writer, values, on_row=None):
+    # values: {(row, col): str}; empty rows in between are kept as blank lines
+    next_row = 0
+    row_cells = []
+    current = None
+    for key in sorted(values):
+        r, c = key
+        if r != current:
+            if current is not None:
+                _flush(writer, row_cells)
+                if on_row:
+                    on_row(len(row_cells))
+            for _ in range(next_row, r):
+                writer.writerow([])
+            current, next_row = r, r + 1
+            row_cells = []
+        row_cells.append((c, values[key]))
+    if current is not None:
+        _flush(writer, row_cells)
+        if on_row:
+            on_row(len(row_cells))
+
+
+def _flush(writer, row_cells):
+    row = [""] * (row_cells[-1][0] + 1)
+    for c, v in row_cells:
+        row[c] = v
+    writer.writerow(row)
@@ -0,0 +1,110 @@
+import queue
+import threading
+import time
+
+QUEUE_CHUNKS = 8
+
+
+class Importer(threading.Thread):
+    # Parses a file on a worker thread and hands over bounded chunks; the main
+    # loop writes them into the sheet with apply() a few at a time. Subclasses
+    # fill in _read() (which calls _put() per chunk and keeps position/total
+    # up to date, in bytes) and _apply_item(); `errors` are what a bad file
+    # raises, reported through .error instead of ending the thread.
+    errors = (OSError,)
+
+    def __init__(self, path):
+        super().__init__(daemon=True)
+        self.path = path
+        self.chunks = queue.Queue(maxsize=QUEUE_CHUNKS)
+        self.position = 0
+        self.total = 0
+        self.finished = False
+        self.cancelled = False
+        self.error = None
+
+    def run(self):
+        try:
+            self._read()
+        except self.errors as e:
+            self.error = e
+        finally:
+            self._put(None)
+
+    def _put(self, item):
+        while not self.cancelled:
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def close(self):
+        self.cancel()
+
+    def progress(self):
+        if self.finished:
+            return 1.0
+        if not self.total:
+            return 0.0
+        return min(1.0, self.position / self.total)
+
+    def apply(self, sheet, budget=0.01):
+        # returns True once every chunk has been written into the sheet
+        deadline = time.perf_counter() + budget
+        while not self.finished:
+            try:
+                item = self.chunks.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.finished = True
+                break
+            self._apply_item(sheet, item)
+            if time.perf_counter() >= deadline:
+                break
+        return self.finished
+
+
+class Exporter:
+    # Writes a snapshot of the sheet taken in __init__ as one job on an
+    # iowork.IOWorker, so the file is replaced only once it is complete.
+    # Subclasses fill in _write(f), calling _count(n) as cells go out, and
+    # pass the worker's open options.
+    def __init__(self, path, worker, total, **options):
+        self.path = path
+        self.worker = worker
+        self.total = total
+        self.options = options
+        self.written = 0
+        self.job = None
+
+    def start(self):
+        self.job = self.worker.submit(self.path, self._write, **self.options)
+
+    def _count(self, n):
+        self.written += n
+
+    @property
+    def finished(self):
+        return self.job is not None and self.job.finished
+
+    @property
+    def error(self):
+        return self.job.error if self.job is not None else None
+
+    def close(self):
+        # let a write in progress finish instead of dropping it
+        self.job.wait()
+
+    def progress(self):
+        if self.finished or not self.total:
+            return 1.0
+        return self.written / self.total
+
+    def apply(self, sheet, budget=0.01):
+        return self.finished
@@ -0,0 +1,502 @@
+import re
+
+from columns import combine, to_number
+from colindex import sort_key
+from sheet import column_index
+
+TOKEN_RE = re.compile(r"""\s*(?:
+    (?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<str>"[^"]*")
+  | (?P<ref>\$?[A-Za-z]{1,3}\$?\d+)
+  | (?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+  | (?P<op>[-+*/^(),:])
+)""", re.VERBOSE)
+REF_RE = re.compile(r"\$?([A-Za-z]+)\$?(\d+)$")
+
+
+class FormulaError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+def parse_ref(text):
+    m = REF_RE.match(text)
+    if not m or int(m.group(2)) < 1:
+        raise FormulaError('#REF!')
+    return int(m.group(2)) - 1, column_index(m.group(1))
+
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = TOKEN_RE.match(text, pos)
+        if not m or m.end() == pos:
+            raise FormulaError('#ERROR!')
+        kind = m.lastgroup
+        tokens.append((kind, m.group(kind)))
+        pos = m.end()
+    return tokens
+
+
+# AST nodes are plain tuples:
+#   ('num', value) ('str', text) ('ref', row, col) ('range', r1, c1, r2, c2)
+#   ('neg', node) ('bin', op, left, right) ('call', NAME, [args])
+class Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def take(self, value=None):
+        tok = self.peek()
+        if tok[0] is None or (value is not None and tok[1] != value):
+            raise FormulaError('#ERROR!')
+        self.pos += 1
+        return tok
+
+    def parse(self):
+        node = self.expr()
+        if self.pos != len(self.tokens):
+            raise FormulaError('#ERROR!')
+        return node
+
+    def expr(self):
+        node = self.term()
+        while self.peek()[1] in ('+', '-'):
+            op = self.take()[1]
+            node = ('bin', op, node, self.term())
+        return node
+
+    def term(self):
+        node = self.power()
+        while self.peek()[1] in ('*', '/'):
+            op = self.take()[1]
+            node = ('bin', op, node, self.power())
+        return node
+
+    def power(self):
+        node = self.unary()
+        while self.peek()[1] == '^':
+            self.take()
+            node = ('bin', '^', node, self.unary())
+        return node
+
+    def unary(self):
+        if self.peek()[1] == '-':
+            self.take()
+            return ('neg', self.unary())
+        if self.peek()[1] == '+':
+            self.take()
+            return self.unary()
+        return self.atom()
+
+    def atom(self):
+        kind, value = self.take()
+        if kind == 'num':
+            return ('num', float(value))
+        if kind == 'str':
+            return ('str', value[1:-1])
+        if kind == 'ref':
+            row, col = parse_ref(value)
+            if self.peek()[1] == ':':
+                self.take()
+                kind2, value2 = self.take()
+                if kind2 != 'ref':
+                    raise FormulaError('#ERROR!')
+                row2, col2 = parse_ref(value2)
+                return ('range', min(row, row2), min(col, col2), max(row, row2), max(col, col2))
+            return ('ref', row, col)
+        if kind == 'name':
+            name = value.upper()
+            if name not in FUNCTIONS and name not in LOOKUPS:
+                raise FormulaError('#NAME?')
+            self.take('(')
+            args = []
+            if self.peek()[1] != ')':
+                args.append(self.expr())
+                while self.peek()[1] == ',':
+                    self.take()
+                    args.append(self.expr())
+            self.take(')')
+            return ('call', name, args)
+        if value == '(':
+            node = self.expr()
+            self.take(')')
+            return node
+        raise FormulaError('#ERROR!')
+
+
+def parse(text):
+    # text without the leading '='
+    return Parser(tokenize(text)).parse()
+
+
+def compile_formula(text):
+    try:
+        return parse(text)
+    except FormulaError as e:
+        return ('error', e.code)
+
+
+def references(node, cells, ranges):
+    kind = node[0]
+    if kind == 'ref':
+        cells.add((node[1], node[2]))
+    elif kind == 'range':
+        ranges.add(node[1:])
+    elif kind == 'neg':
+        references(node[1], cells, ranges)
+    elif kind == 'bin':
+        references(node[2], cells, ranges)
+        references(node[3], cells, ranges)
+    elif kind == 'call':
+        for arg in node[2]:
+            references(arg, cells, ranges)
+
+
+# function name -> reductions it needs over its arguments
+FUNCTIONS = {
+    'SUM': ('sum',),
+    'COUNT': ('count',),
+    'AVERAGE': ('sum', 'count'),
+    'MIN': ('min',),
+    'MAX': ('max',),
+}
+# looked up through the sorted index of the range's first column
+LOOKUPS = ('VLOOKUP', 'MATCH')
+
+
+def _finish(name, totals):
+    if name == 'SUM':
+        return totals['sum']
+    if name == 'COUNT':
+        return totals['count']
+    if name == 'AVERAGE':
+        if not totals['count']:
+            raise FormulaError('#DIV/0!')
+        return totals['sum'] / totals['count']
+    value = totals['min' if name == 'MIN' else 'max']
+    return 0.0 if value is None else value
+
+
+def format_value(value):
+    if isinstance(value, FormulaError):
+        return value.code
+    if isinstance(value, str):
+        return value
+    if value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return f"{value:.10g}"
+
+
+class FormulaEngine:
+    # Keeps parsed formulas and their results next to a Sheet. Edits only
+    # recalculate the formulas downstream of the changed cell.
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.formulas = {}
+        self.results = {}
+        self.precedents = {}
+        self.dependents = {}
+        self.range_dependents = {}
+        # where the ranges are, for _dependents_of(): col -> {(level, i): set
+        # of ranges}. The rows of a range are split into aligned blocks of
+        # 2**level rows (i << level up to ((i + 1) << level) - 1), at most two
+        # per level, so a cell is in no more than one block per level.
+        self.range_blocks = {}
+        self.range_levels = 0
+        self.errors = set()
+
+    def is_formula(self, row, col):
+        return (row, col) in self.formulas
+
+    def display(self, row, col):
+        key = (row, col)
+        if key in self.results:
+            return format_value(self.results[key])
+        return self.sheet.get(row, col)
+
+    def value(self, row, col):
+        # numeric value of a cell as seen by formulas
+        key = (row, col)
+        if key in self.formulas:
+            result = self.results.get(key, 0.0)
+            if isinstance(result, FormulaError):
+                raise result
+            return result
+        raw = self.sheet.get(row, col)
+        if not raw:
+            return 0.0
+        number = to_number(raw)
+        if number is None:
+            raise FormulaError('#VALUE!')
+        return number
+
+    def update(self, row, col):
+        # call after the raw text of a cell changed
+        key = (row, col)
+        self._unlink(key)
+        raw = self.sheet.get(row, col)
+        if raw.startswith('='):
+            node = compile_formula(raw[1:])
+            self.formulas[key] = node
+            self._link(key, node)
+        self.recalculate([key])
+
+    def rebuild(self):
+        self.formulas.clear()
+        self.results.clear()
+        self.precedents.clear()
+        self.dependents.clear()
+        self.range_dependents.clear()
+        self.range_blocks.clear()
+        self.range_levels = 0
+        self.errors.clear()
+        for key, raw in self.sheet.values.items():
+            if raw.startswith('='):
+                node = compile_formula(raw[1:])
+                self.formulas[key] = node
+                self._link(key, node)
+        self._evaluate_in_order(set(self.formulas))
+
+    def evaluate(self, text):
+        # one-off expression against the current sheet, nothing is stored
+        return self._evaluate(compile_formula(text[1:] if text.startswith('=') else text))
+
+    def recalculate(self, changed):
+        dirty = set()
+        stack = list(changed)
+        for key in changed:
+            if key in self.formulas:
+                dirty.add(key)
+        while stack:
+            key = stack.pop()
+            for dep in self._dependents_of(key):
+                if dep not in dirty:
+                    dirty.add(dep)
+                    stack.append(dep)
+        self._evaluate_in_order(dirty)
+        return dirty
+
+    def _evaluate_in_order(self, dirty):
+        indegree = dict.fromkeys(dirty, 0)
+        edges = {}
+        for key in dirty:
+            targets = [dep for dep in self._dependents_of(key) if dep in indegree]
+            edges[key] = targets
+            for dep in targets:
+                indegree[dep] += 1
+        ready = [key for key, n in indegree.items() if n == 0]
+        while ready:
+            key = ready.pop()
+            self._store(key, self._evaluate(self.formulas[key]))
+            for dep in edges[key]:
+                indegree[dep] -= 1
+                if indegree[dep] == 0:
+                    ready.append(dep)
+        for key, n in indegree.items():
+            if n:
+                self._store(key, FormulaError('#CYCLE!'))
+
+    def _store(self, key, result):
+        self.results[key] = result
+        if isinstance(result, FormulaError):
+            self.errors.add(key)
+            self.sheet.set_number(key[0], key[1], None)
+        else:
+            self.errors.discard(key)
+            self.sheet.set_number(key[0], key[1], None if isinstance(result, str) else result)
+
+    def _evaluate(self, node):
+        try:
+            value = self._eval(node)
+        except FormulaError as e:
+            return e
+        except ZeroDivisionError:
+            return FormulaError('#DIV/0!')
+        except (OverflowError, ValueError):
+            return FormulaError('#NUM!')
+        except TypeError:
+            # text used in arithmetic
+            return FormulaError('#VALUE!')
+        return value if isinstance(value, str) else float(value)
+
+    def _eval(self, node):
+        kind = node[0]
+        if kind in ('num', 'str'):
+            return node[1]
+        if kind == 'ref':
+            # a bare reference passes text through; arithmetic wants numbers
+            return self._cell_value(node[1], node[2])
+        if kind == 'neg':
+            return -self._number(node[1])
+        if kind == 'bin':
+            a = self._number(node[2])
+            b = self._number(node[3])
+            op = node[1]
+            if op == '+':
+                return a + b
+            if op == '-':
+                return a - b
+            if op == '*':
+                return a * b
+            if op == '/':
+                return a / b
+            return a ** b
+        if kind == 'call':
+            return self._call(node[1], node[2])
+        if kind == 'range':
+            raise FormulaError('#VALUE!')
+        raise FormulaError(node[1])
+
+    def _number(self, node):
+        # text that reads as a number counts, like "5"+1; other text is #VALUE!
+        value = self._eval(node)
+        if isinstance(value, str):
+            value = to_number(value)
+            if value is None:
+                raise FormulaError('#VALUE!')
+        return value
+
+    def _call(self, name, args):
+        # ranges are reduced over the sheet's numeric columns in one pass each;
+        # text cells do not count and an error inside a range propagates
+        if name in LOOKUPS:
+            return self._lookup(name, args)
+        kinds = FUNCTIONS[name]
+        parts = {kind: [] for kind in kinds}
+        for arg in args:
+            if arg[0] == 'range':
+                self._check_range(*arg[1:])
+                for kind in kinds:
+                    parts[kind].append(self.sheet.aggregate(kind, *arg[1:]))
+            else:
+                value = self._number(arg)
+                for kind in kinds:
+                    parts[kind].append(1 if kind == 'count' else value)
+        return _finish(name, {kind: combine(kind, p) for kind, p in parts.items()})
+
+    def _lookup(self, name, args):
+        # VLOOKUP(value, range, column[, approximate]) and MATCH(value, range[, type]).
+        # Approximate lookups (the default) expect the first column sorted
+        # ascending and take the largest value <= the one looked up.
+        if len(args) < (3 if name == 'VLOOKUP' else 2) or len(args) > (4 if name == 'VLOOKUP' else 3):
+            raise FormulaError('#VALUE!')
+        if args[1][0] != 'range':
+            raise FormulaError('#VALUE!')
+        r1, c1, r2, c2 = args[1][1:]
+        index = self.sheet.index(c1)
+        key = self._lookup_key(args[0], index.dates)
+        if name == 'MATCH':
+            if c1 != c2:
+                raise FormulaError('#N/A')
+            match = self._number(args[2]) if len(args) > 2 else 1
+            row = index.lookup(key, r1, r2, (match > 0) - (match < 0))
+            if row is None:
+                raise FormulaError('#N/A')
+            return row - r1 + 1
+        column = int(self._number(args[2]))
+        if column < 1:
+            raise FormulaError('#VALUE!')
+        if column > c2 - c1 + 1:
+            raise FormulaError('#REF!')
+        approximate = self._number(args[3]) != 0 if len(args) > 3 else True
+        row = index.lookup(key, r1, r2, 1 if approximate else 0)
+        if row is None:
+            raise FormulaError('#N/A')
+        return self._cell_value(row, c1 + column - 1)
+
+    def _lookup_key(self, node, dates):
+        value = self._eval(node)
+        return sort_key(value, dates) if isinstance(value, str) else float(value)
+
+    def _cell_value(self, row, col):
+        # like value(), but a text cell gives its text instead of #VALUE!
+        if (row, col) not in self.formulas:
+            raw = self.sheet.get(row, col)
+            if raw and to_number(raw) is None:
+                return raw
+        return self.value(row, col)
+
+    def _check_range(self, r1, c1, r2, c2):
+        for r, c in self.errors:
+            if r1 <= r <= r2 and c1 <= c <= c2:
+                raise self.results[(r, c)]
+
+    def _dependents_of(self, key):
+        deps = self.dependents.get(key)
+        result = list(deps) if deps else []
+        blocks = self.range_blocks.get(key[1])
+        if blocks:
+            r = key[0]
+            for level in range(self.range_levels):
+                ranges = blocks.get((level, r >> level))
+                if ranges:
+                    for rng in ranges:
+                        result.extend(self.range_dependents[rng])
+        return result
+
+    def _link(self, key, node):
+        cells, ranges = set(), set()
+        references(node, cells, ranges)
+        self.precedents[key] = (cells, ranges)
+        for ref in cells:
+            self.dependents.setdefault(ref, set()).add(key)
+        for rng in ranges:
+            deps = self.range_dependents.get(rng)
+            if deps is None:
+                deps = self.range_dependents[rng] = set()
+                self._place_range(rng, True)
+            deps.add(key)
+
+    def _unlink(self, key):
+        self.formulas.pop(key, None)
+        self.results.pop(key, None)
+        self.errors.discard(key)
+        links = self.precedents.pop(key, None)
+        if not links:
+            return
+        cells, ranges = links
+        for ref in cells:
+            deps = self.dependents[ref]
+            deps.discard(key)
+            if not deps:
+                del self.dependents[ref]
+        for rng in ranges:
+            deps = self.range_dependents[rng]
+            deps.discard(key)
+            if not deps:
+                del self.range_dependents[rng]
+                self._place_range(rng, False)
+
+    def _place_range(self, rng, add):
+        # adds the range to its blocks in range_blocks, or takes it out
+        r1, c1, r2, c2 = rng
+        blocks = []
+        level, lo, hi = 0, r1, r2 + 1
+        while lo < hi:
+            if lo & 1:
+                blocks.append((level, lo))
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                blocks.append((level, hi))
+            lo, hi, level = lo >> 1, hi >> 1, level + 1
+        self.range_levels = max(self.range_levels, level)
+        for c in range(c1, c2 + 1):
+            column = self.range_blocks.setdefault(c, {})
+            for block in blocks:
+                if add:
+                    column.setdefault(block, set()).add(rng)
+                    continue
+                ranges = column[block]
+                ranges.discard(rng)
+                if not ranges:
+                    del column[block]
+            if not column:
+                del self.range_blocks[c]
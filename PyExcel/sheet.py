@@ -0,0 +1,259 @@
+from itertools import repeat
+
+from columns import NumericColumn, combine, to_number
+from colindex import ColumnIndex, date_key, sort_key
+
+WHITE = (255, 255, 255)
+
+
+def get_column_label(index):
+    label = ''
+    while index >= 0:
+        label = chr(index % 26 + ord('A')) + label
+        index = index // 26 - 1
+    return label
+
+
+def column_index(label):
+    index = 0
+    for ch in label.upper():
+        index = index * 26 + (ord(ch) - ord('A') + 1)
+    return index - 1
+
+
+class Sheet:
+    # Only non-empty or coloured cells are stored, keyed by (row, col).
+    # The logical ROWS/COLS of the window are just a view over this.
+    def __init__(self, default_color=WHITE):
+        self.default_color = default_color
+        self.values = {}
+        self.colors = {}
+        self._rows = {}
+        self._cols = {}
+        self.numeric = {}
+        # sorted column indexes, built by index() and kept up to date after that
+        self.indexes = {}
+        # col -> 'int', 'float', 'date' or 'string', as the CSV import found them
+        self.column_types = {}
+        self._max_row = -1
+        self._max_col = -1
+        self._bounds_dirty = False
+        # bumped on every change to values or colors, for autosave
+        self.version = 0
+
+    def __len__(self):
+        return len(self.values.keys() | self.colors.keys())
+
+    def get(self, row, col):
+        return self.values.get((row, col), "")
+
+    def get_color(self, row, col):
+        return self.colors.get((row, col), self.default_color)
+
+    def set(self, row, col, value):
+        key = (row, col)
+        if self.values.get(key, "") == value:
+            return
+        self.version += 1
+        if value:
+            self.values[key] = value
+            self._track(row, col)
+            self.set_number(row, col, to_number(value))
+        elif key in self.values:
+            del self.values[key]
+            self.set_number(row, col, None)
+            if key not in self.colors:
+                self._untrack(row, col)
+
+    def load_column(self, col, rows, texts, numbers, valid):
+        # set() for many cells of one column at once, for imports: rows
+        # ascending, texts not empty, numbers/valid what to_number gave
+        if not rows:
+            return
+        self.version += 1
+        self.values.update(zip(zip(rows, repeat(col)), texts))
+        row_cols = self._rows
+        for row in rows:
+            cols = row_cols.get(row)
+            if cols is None:
+                row_cols[row] = {col}
+            else:
+                cols.add(col)
+        col_rows = self._cols.get(col)
+        if col_rows is None:
+            col_rows = self._cols[col] = set()
+        col_rows.update(rows)
+        self._max_row = max(self._max_row, rows[-1])
+        self._max_col = max(self._max_col, col)
+        column = self.numeric.get(col)
+        if column is None and any(valid):
+            column = self.numeric[col] = NumericColumn()
+        if column is not None:
+            column.set_many(rows, numbers, valid)
+        # cheaper to build again on demand than to keep in step cell by cell
+        self.indexes.pop(col, None)
+
+    def set_column_type(self, col, kind):
+        # a date column sorts and filters its dates by day, not as text
+        if self.column_types.get(col) != kind:
+            self.column_types[col] = kind
+            self.indexes.pop(col, None)
+
+    def set_number(self, row, col, number):
+        # also used by the formula engine to publish computed results
+        index = self.indexes.get(col)
+        if index is not None:
+            index.update(row, self._index_key(row, col, number))
+        column = self.numeric.get(col)
+        if column is None:
+            if number is None:
+                return
+            column = self.numeric[col] = NumericColumn()
+        column.set(row, number)
+
+    def _index_key(self, row, col, number):
+        # formulas are indexed by their result; text formulas and errors are not
+        if number is not None and number == number:
+            return number
+        raw = self.values.get((row, col))
+        if raw is None or raw.startswith('='):
+            return None
+        return sort_key(raw, self.column_types.get(col) == 'date')
+
+    def index(self, col):
+        index = self.indexes.get(col)
+        if index is None:
+            # the same keys as _index_key, without a call per cell
+            column = self.numeric.get(col)
+            numbers, valid = (column.values, column.valid) if column is not None else ((), b'')
+            values = self.values
+            dates = self.column_types.get(col) == 'date'
+            cells = []
+            for row in self._cols.get(col, ()):
+                if row < len(valid) and valid[row] and numbers[row] == numbers[row]:
+                    cells.append((row, numbers[row]))
+                else:
+                    raw = values.get((row, col))
+                    if raw is not None and not raw.startswith('='):
+                        day = date_key(raw) if dates else None
+                        cells.append((row, raw.casefold() if day is None else day))
+            index = self.indexes[col] = ColumnIndex(cells, dates)
+        return index
+
+    def sorted_rows(self, col, descending=False):
+        # every used row ordered by its value in col, rows empty there last;
+        # a view for drawing, the cells themselves do not move
+        index = self.index(col)
+        rows = list(index.ordered(descending))
+        rows.extend(row for row in self.used_rows() if row not in index.keys)
+        return rows
+
+    def filter_rows(self, col, op, raw):
+        # rows whose value in col passes the condition, top to bottom
+        return self.index(col).select(op, raw)
+
+    def aggregate(self, kind, r1, c1, r2, c2):
+        parts = []
+        for col in range(c1, c2 + 1):
+            column = self.numeric.get(col)
+            if column is not None:
+                parts.append(column.reduce(kind, r1, r2))
+        return combine(kind, parts)
+
+    def set_color(self, row, col, color):
+        key = (row, col)
+        self.version += 1
+        if color != self.default_color:
+            self.colors[key] = color
+            self._track(row, col)
+        elif key in self.colors:
+            del self.colors[key]
+            if key not in self.values:
+                self._untrack(row, col)
+
+    def clear(self):
+        self.version += 1
+        self.values.clear()
+        self.colors.clear()
+        self._rows.clear()
+        self._cols.clear()
+        self.numeric.clear()
+        self.indexes.clear()
+        self.column_types.clear()
+        self._max_row = self._max_col = -1
+        self._bounds_dirty = False
+
+    def iter_row(self, row):
+        for col in sorted(self._rows.get(row, ())):
+            value = self.values.get((row, col))
+            if value is not None:
+                yield col, value
+
+    def iter_col(self, col):
+        for row in sorted(self._cols.get(col, ())):
+            value = self.values.get((row, col))
+            if value is not None:
+                yield row, value
+
+    def cells_in(self, r1, c1, r2, c2):
+        # stored values inside the inclusive block, in no particular order
+        values = self.values
+        if (r2 - r1 + 1) * (c2 - c1 + 1) <= len(values):
+            for r in range(r1, r2 + 1):
+                for c in range(c1, c2 + 1):
+                    v = values.get((r, c))
+                    if v is not None:
+                        yield r, c, v
+            return
+        for c in range(c1, c2 + 1):
+            for r in self._cols.get(c, ()):
+                if r1 <= r <= r2:
+                    v = values.get((r, c))
+                    if v is not None:
+                        yield r, c, v
+
+    def row_values(self, row, width=None):
+        # dense list for one row, trailing empty cells trimmed unless width is given
+        if width is None:
+            cols = self._rows.get(row, ())
+            width = max((c + 1 for c in cols if (row, c) in self.values), default=0)
+        return [self.values.get((row, c), "") for c in range(width)]
+
+    def used_rows(self):
+        return sorted(self._rows)
+
+    def used_range(self):
+        # (rows, cols) needed to show every stored cell
+        if self._bounds_dirty:
+            self._max_row = max(self._rows, default=-1)
+            self._max_col = max(self._cols, default=-1)
+            self._bounds_dirty = False
+        return self._max_row + 1, self._max_col + 1
+
+    def _track(self, row, col):
+        cols = self._rows.get(row)
+        if cols is None:
+            cols = self._rows[row] = set()
+        cols.add(col)
+        rows = self._cols.get(col)
+        if rows is None:
+            rows = self._cols[col] = set()
+        rows.add(row)
+        if row > self._max_row:
+            self._max_row = row
+        if col > self._max_col:
+            self._max_col = col
+
+    def _untrack(self, row, col):
+        cols = self._rows[row]
+        cols.discard(col)
+        if not cols:
+            del self._rows[row]
+            if row == self._max_row:
+                self._bounds_dirty = True
+        rows = self._cols[col]
+        rows.discard(row)
+        if not rows:
+            del self._cols[col]
+            if col == self._max_col:
+                self._bounds_dirty = True
@@ -0,0 +1,31 @@
+import csv
+
+import cli
+
+
+def write_csv(path, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerows(rows)
+
+
+def read_csv(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        return list(csv.reader(f))
+
+
+def test_sort_writes_formula_results(tmp_path):
+    src, dst = tmp_path / 'in.csv', tmp_path / 'out.csv'
+    write_csv(src, [['name', 'qty', 'double'], ['a', '1', '=B2*2'], ['b', '3', '=B3*2'], ['c', '2', '=B4*2']])
+    cli.main(['sort', str(src), str(dst), 'B', '--header'])
+    assert read_csv(dst) == [['name', 'qty', 'double'], ['a', '1', '2'], ['c', '2', '4'], ['b', '3', '6']]
+    cli.main(['sort', str(src), str(dst), 'C', '--desc'])
+    assert read_csv(dst) == [['name', 'qty', 'double'], ['b', '3', '6'], ['c', '2', '4'], ['a', '1', '2']]
+
+
+def test_filter_combines_conditions(tmp_path):
+    src, dst = tmp_path / 'in.csv', tmp_path / 'out.csv'
+    write_csv(src, [['name', 'qty'], ['apple', '5'], ['pear', '12'], ['apricot', '20'], ['plum', '=B3+1']])
+    cli.main(['filter', str(src), str(dst), '-w', 'B>10', '-w', 'A~ap', '--header'])
+    assert read_csv(dst) == [['name', 'qty'], ['apricot', '20']]
+    cli.main(['filter', str(src), str(dst), '-w', 'B>=12'])
+    assert read_csv(dst) == [['pear', '12'], ['apricot', '20'], ['plum', '13']]
@@ -0,0 +1,60 @@
+import random
+
+from colindex import ColumnIndex, SortedKeys, sort_key
+from sheet import Sheet
+
+
+def test_sorted_keys_against_a_list():
+    rnd = random.Random(1)
+    SortedKeys.LOAD, load = 4, SortedKeys.LOAD
+    try:
+        keys = SortedKeys(rnd.sample(range(1000), 50))
+        ref = sorted(keys.irange())
+        for _ in range(2000):
+            if ref and rnd.random() < 0.45:
+                key = rnd.choice(ref)
+                keys.remove(key)
+                ref.remove(key)
+            else:
+                key = rnd.randrange(1000)
+                keys.add(key)
+                ref.append(key)
+                ref.sort()
+            assert len(keys) == len(ref)
+        assert list(keys.irange()) == ref
+        for lo, hi in [(None, None), (100, 500), (None, 300), (700, None), (400, 400), (600, 100)]:
+            expected = [k for k in ref if (lo is None or k >= lo) and (hi is None or k <= hi)]
+            assert list(keys.irange(lo, hi)) == expected
+            assert list(keys.irange(lo, hi, reverse=True)) == expected[::-1]
+    finally:
+        SortedKeys.LOAD = load
+
+
+def index_of(values):
+    return ColumnIndex((row, sort_key(v)) for row, v in enumerate(values) if v)
+
+
+def test_select_is_case_insensitive():
+    index = index_of(['Apple', 'apple pie', 'BANANA', 'banana', '5', '12'])
+    assert index.select('=', 'apple') == [0]
+    assert index.select('~', 'AN') == [2, 3]
+    assert index.select('!=', 'banana') == [0, 1, 4, 5]
+    assert index.select('>', '6') == [5]
+    assert index.select('<=', '12') == [4, 5]
+
+
+def test_ordered_is_stable_numbers_first():
+    index = index_of(['b', '2', 'a', '1', 'B', '2'])
+    assert list(index.ordered()) == [3, 1, 5, 2, 0, 4]
+    assert list(index.ordered(descending=True)) == [0, 4, 2, 1, 5, 3]
+
+
+def test_index_follows_sheet_edits():
+    sheet = Sheet()
+    for row, value in enumerate(['3', 'x', '1']):
+        sheet.set(row, 0, value)
+    assert sheet.sorted_rows(0) == [2, 0, 1]
+    sheet.set(1, 0, '2')
+    sheet.set(3, 0, '0')
+    assert sheet.sorted_rows(0) == [3, 2, 1, 0]
+    assert sheet.filter_rows(0, '>=', '2') == [0, 1]
@@ -0,0 +1,20 @@
+import pytest
+
+from columns import to_number
+from workbook import Workbook
+
+
+@pytest.mark.parametrize('raw, number', [
+    ('1', 1.0), (' -2.5 ', -2.5), ('.5', 0.5), ('1e3', 1000.0),
+    ('nan', None), ('inf', None), ('Infinity', None), ('1_000', None), ('1e400', None), ('', None), ('0x10', None),
+])
+def test_to_number(raw, number):
+    assert to_number(raw) == number
+
+
+def test_text_that_float_accepts_is_not_counted():
+    wb = Workbook()
+    for ref, value in (('A1', 'nan'), ('A2', 'inf'), ('A3', '2')):
+        wb.set(ref, value)
+    assert wb.evaluate('SUM(A1:A3)') == '2'
+    assert wb.evaluate('COUNT(A1:A3)') == '1'
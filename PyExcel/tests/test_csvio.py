@@ -0,0 +1,134 @@
+import csv
+import multiprocessing
+import time
+
+import pytest
+
+import csvio
+from colindex import date_key
+from csvio import CSVImporter, ParallelCSVImporter, open_pool, write_rows
+from sheet import Sheet
+from workbook import Workbook
+
+ROWS = [['name', 'qty', 'note'], ['a', '1', 'multi\nline'], [], ['b, c', '2.5', 'quote "x"'],
+        ['ünïcödé', '=B2*2', ''], ['', '', 'last']]
+
+
+def write_csv(path, rows=ROWS):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerows(rows)
+
+
+def run(importer):
+    sheet = Sheet()
+    importer.start()
+    while not importer.apply(sheet):
+        time.sleep(0.001)
+    assert importer.error is None
+    return sheet
+
+
+def expected_values(rows=ROWS):
+    return {(r, c): v for r, row in enumerate(rows) for c, v in enumerate(row) if v}
+
+
+def test_csv_importer(tmp_path):
+    path = tmp_path / 'in.csv'
+    write_csv(path)
+    assert run(CSVImporter(str(path), chunk_rows=2)).values == expected_values()
+
+
+needs_fork = pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason="needs fork")
+
+
+@needs_fork
+def test_parallel_importer_matches(tmp_path, monkeypatch):
+    rows = [[f'r{r}', str(r * 1.5), 'x\ny' if r % 7 == 0 else 'ü' * (r % 3)] for r in range(500)]
+    path = tmp_path / 'big.csv'
+    write_csv(path, rows)
+    monkeypatch.setattr(csvio, 'RANGE_BYTES', 97)
+    sheet = run(ParallelCSVImporter(str(path), processes=2))
+    assert sheet.values == run(CSVImporter(str(path))).values
+    assert sheet.aggregate('sum', 0, 1, 499, 1) == pytest.approx(sum(r * 1.5 for r in range(500)))
+
+
+@needs_fork
+def test_shared_pool_outlives_imports(tmp_path, monkeypatch):
+    path = tmp_path / 'big.csv'
+    write_csv(path, [[str(r), f'v{r}'] for r in range(300)])
+    monkeypatch.setattr(csvio, 'RANGE_BYTES', 64)
+    pool = open_pool(2)
+    try:
+        first = run(ParallelCSVImporter(str(path), processes=2, pool=pool))
+        second = run(ParallelCSVImporter(str(path), processes=2, pool=pool))
+        assert first.values == second.values == expected_values([[str(r), f'v{r}'] for r in range(300)])
+    finally:
+        pool.terminate()
+
+
+def test_write_rows_keeps_blank_rows(tmp_path):
+    path = tmp_path / 'out.csv'
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        write_rows(csv.writer(f), expected_values())
+    with open(path, newline='', encoding='utf-8') as f:
+        back = list(csv.reader(f))
+    assert {(r, c): v for r, row in enumerate(back) for c, v in enumerate(row) if v} == expected_values()
+    assert back[2] == []
+
+
+def test_workbook_round_trip(tmp_path):
+    wb = Workbook()
+    for (r, c), v in expected_values().items():
+        wb.sheet.set(r, c, v)
+    wb.engine.rebuild()
+    path = str(tmp_path / 'book.csv')
+    wb.save(path)
+    back = Workbook.open(path)
+    assert back.sheet.values == wb.sheet.values
+    assert back.value('B5') == '2'
+
+
+DATED = [['when', 'qty', 'price', 'note'], ['15.01.2024', '3', '1.5', 'b'], ['2024-01-02', '1', '2', 'a'],
+         ['03/02/24', '2', '0.5', 'c'], ['1.12.2023', '4', '3', '2024-01-01']]
+
+
+@pytest.mark.parametrize('raw, day', [
+    ('2024-01-31', 45322.0), ('31.01.2024', 45322.0), ('31/01/24', 45322.0), (' 1900-01-01 ', 2.0),
+    ('2024-01-31 12:00', 45322.5), ('2024-01-31T06:00:00', 45322.25),
+    ('31.02.2024', None), ('2024-01-31 25:00', None), ('2024', None), ('31.01', None),
+])
+def test_date_key(raw, day):
+    assert date_key(raw) == day
+
+
+def test_column_types_skip_the_header(tmp_path):
+    path = tmp_path / 'dated.csv'
+    write_csv(path, DATED)
+    sheet = run(CSVImporter(str(path), chunk_rows=2))
+    assert sheet.column_types == {0: 'date', 1: 'int', 2: 'float', 3: 'string'}
+
+
+def test_date_columns_sort_and_filter_by_day(tmp_path):
+    path = tmp_path / 'dated.csv'
+    write_csv(path, DATED)
+    wb = Workbook.open(str(path))
+    assert wb.sheet.sorted_rows(0) == [4, 2, 1, 3, 0]
+    assert wb.sheet.filter_rows(0, '>=', '2024-01-15') == [1, 3]
+    # text that only looks like a date is left alone outside a date column
+    assert wb.sheet.sorted_rows(3) == [4, 2, 1, 3, 0]
+    wb.set('E1', '=MATCH("15.01.2024", A2:A5, 0)')
+    assert wb.value('E1') == '1'
+    # edits keep their place among the dates
+    wb.sheet.set(5, 0, '2023-06-01')
+    assert wb.sheet.sorted_rows(0)[:2] == [5, 4]
+
+
+@needs_fork
+def test_parallel_importer_finds_the_same_types(tmp_path, monkeypatch):
+    rows = DATED + [[f'{d}.03.2024', str(d), 'x', ''] for d in range(1, 29)]
+    path = tmp_path / 'dated.csv'
+    write_csv(path, rows)
+    monkeypatch.setattr(csvio, 'RANGE_BYTES', 50)
+    sheet = run(ParallelCSVImporter(str(path), processes=2))
+    assert sheet.column_types == run(CSVImporter(str(path), chunk_rows=3)).column_types
+    assert sheet.column_types == {0: 'date', 1: 'int', 2: 'string', 3: 'string'}
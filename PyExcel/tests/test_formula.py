@@ -0,0 +1,125 @@
+import random
+
+import pytest
+
+from formula import parse_ref
+from workbook import Workbook
+
+
+def sheet(**cells):
+    wb = Workbook()
+    for ref, value in cells.items():
+        wb.set(ref, value)
+    return wb
+
+
+def test_arithmetic_and_functions():
+    wb = sheet(A1='2', A2='3', A3='=A1*A2+1', A4='=SUM(A1:A3)', A5='=AVERAGE(A1:A2)')
+    assert wb.value('A3') == '7'
+    assert wb.value('A4') == '12'
+    assert wb.value('A5') == '2.5'
+
+
+def test_chain_recalculates_downstream():
+    wb = sheet(A1='1', B1='=A1+1', C1='=B1*10', D1='=SUM(A1:C1)')
+    wb.set('A1', '5')
+    assert (wb.value('B1'), wb.value('C1'), wb.value('D1')) == ('6', '60', '71')
+
+
+def test_range_dependents_follow_new_cells():
+    wb = sheet(B1='=SUM(A1:A3)')
+    assert wb.value('B1') == '0'
+    wb.set('A2', '4')
+    assert wb.value('B1') == '4'
+    wb.set('A2', '')
+    assert wb.value('B1') == '0'
+
+
+def test_range_lookup_matches_a_scan():
+    pick = random.Random(5)
+    wb = Workbook()
+    engine = wb.engine
+    for i in range(60):
+        r1, r2 = sorted(pick.randrange(300) for _ in range(2))
+        c1, c2 = sorted(pick.randrange(4) for _ in range(2))
+        wb.sheet.set(i, 10, f'=SUM({chr(65 + c1)}{r1 + 1}:{chr(65 + c2)}{r2 + 1})')
+    engine.rebuild()
+    for i in range(0, 60, 3):
+        wb.set(f'K{i + 1}', '')
+    for r in range(301):
+        for c in range(5):
+            expected = sorted(key for (r1, c1, r2, c2), deps in engine.range_dependents.items()
+                              for key in deps if r1 <= r <= r2 and c1 <= c <= c2)
+            assert sorted(engine._dependents_of((r, c))) == expected
+    for i in range(60):
+        wb.set(f'K{i + 1}', '')
+    assert not engine.range_dependents and not engine.range_blocks
+
+
+def test_replaced_formula_drops_its_links():
+    wb = sheet(A1='1', B1='=A1')
+    wb.set('B1', '7')
+    assert wb.engine.dependents.get((0, 0)) is None
+    wb.set('A1', '2')
+    assert wb.value('B1') == '7'
+
+
+@pytest.mark.parametrize('cells', [
+    {'A1': '=A1'},
+    {'A1': '=B1', 'B1': '=A1'},
+    {'A1': '=SUM(A2:A3)', 'A3': '=A1+1'},
+])
+def test_cycles(cells):
+    wb = sheet(**cells)
+    for ref in cells:
+        assert wb.value(ref) == '#CYCLE!'
+
+
+def test_breaking_a_cycle_recovers():
+    wb = sheet(A1='=B1', B1='=A1')
+    wb.set('B1', '3')
+    assert wb.value('A1') == '3'
+
+
+def test_errors_propagate():
+    wb = sheet(A1='=1/0', A2='=A1+1', A3='=SUM(A1:A2)', A4='=B1+1', B1='text')
+    assert wb.value('A1') == '#DIV/0!'
+    assert wb.value('A2') == '#DIV/0!'
+    assert wb.value('A3') == '#DIV/0!'
+    assert wb.value('A4') == '#VALUE!'
+
+
+def test_bare_reference_passes_text_through():
+    wb = sheet(B1='hi', A1='=B1', A2='=A1', A3='="5"+1')
+    assert wb.value('A1') == 'hi'
+    assert wb.value('A2') == 'hi'
+    assert wb.value('A3') == '6'
+    wb.set('B1', 'bye')
+    assert wb.value('A2') == 'bye'
+
+
+def test_rebuild_matches_incremental():
+    cells = {'A1': '1', 'A2': '=A1*2', 'A3': '=SUM(A1:A2)', 'B1': '=A3-A1'}
+    wb = sheet(**cells)
+    again = Workbook()
+    for ref, value in cells.items():
+        again.sheet.set(*parse_ref(ref), value)
+    again.engine.rebuild()
+    assert all(wb.value(ref) == again.value(ref) for ref in cells)
+
+
+def test_lookups():
+    wb = sheet(A1='10', B1='ten', A2='20', B2='twenty', A3='30', B3='thirty',
+               C1='=VLOOKUP(20, A1:B3, 2, 0)', C2='=VLOOKUP(25, A1:B3, 2)',
+               C3='=MATCH(30, A1:A3, 0)', C4='=VLOOKUP(5, A1:B3, 2)', C5='=VLOOKUP(20, A1:B3, 3, 0)')
+    assert wb.value('C1') == 'twenty'
+    assert wb.value('C2') == 'twenty'
+    assert wb.value('C3') == '3'
+    assert wb.value('C4') == '#N/A'
+    assert wb.value('C5') == '#REF!'
+
+
+def test_evaluate_stores_nothing():
+    wb = sheet(A1='4')
+    assert wb.evaluate('A1*2') == '8'
+    assert not wb.engine.formulas
@@ -0,0 +1,55 @@
+import zipfile
+
+from workbook import Workbook
+
+CELLS = {(0, 0): 'name', (0, 1): 'qty', (1, 0): 'a', (1, 1): '1', (2, 2): 'multi\nline',
+         (3, 0): 'ünïcödé', (4, 1): '=B2*2', (5, 2): 'quote "x" & <tag>'}
+
+
+def test_workbook_round_trip(tmp_path):
+    wb = Workbook()
+    for (r, c), v in CELLS.items():
+        wb.sheet.set(r, c, v)
+    wb.engine.rebuild()
+    path = str(tmp_path / 'book.xlsx')
+    wb.save(path)
+    back = Workbook.open(path)
+    assert back.sheet.values == wb.sheet.values
+    assert back.value('B5') == '2'
+
+
+def test_xlsx_keeps_colors_and_values(tmp_path):
+    wb = Workbook()
+    wb.set('A1', '3')
+    wb.set('A2', '=A1*2')
+    wb.sheet.set_color(0, 1, (255, 0, 0))
+    path = str(tmp_path / 'c.xlsx')
+    wb.save(path)
+    back = Workbook.open(path)
+    assert back.sheet.get_color(0, 1) == (255, 0, 0)
+    assert back.get('A2') == '=A1*2'
+    assert back.value('A2') == '6'
+    values = tmp_path / 'v.csv'
+    wb.save(str(values), values=True)
+    assert Workbook.open(str(values)).get('A2') == '6'
+
+
+
+def test_numbers_only_when_they_read_back_the_same(tmp_path):
+    path = str(tmp_path / 'n.xlsx')
+    cells = {'A1': '007', 'A2': '1e400', 'A3': '-0.5', 'A4': '0', 'A5': ' 5', 'A6': '+01', 'A7': '12.50',
+             'A8': '=SUM(A3:A4)'}
+    wb = Workbook()
+    for ref, value in cells.items():
+        wb.set(ref, value)
+    wb.save(path)
+    with zipfile.ZipFile(path) as zf:
+        sheet = zf.read('xl/worksheets/sheet1.xml').decode()
+        strings = zf.read('xl/sharedStrings.xml').decode()
+    for ref in ('A1', 'A2', 'A5', 'A6'):
+        assert f'<c r="{ref}" t="s">' in sheet
+    assert '<c r="A3"><v>-0.5</v>' in sheet and '<c r="A7"><v>12.50</v>' in sheet
+    assert '>007</t>' in strings and '>1e400</t>' in strings
+    back = Workbook.open(path)
+    assert {ref: back.get(ref) for ref in cells} == cells
+    assert back.value('A8') == '-0.5'
@@ -0,0 +1,91 @@
+import csv
+import time
+
+from sheet import Sheet
+from formula import FormulaEngine, FormulaError, format_value, parse_ref
+from csvio import open_importer, write_rows
+from xlsxio import is_xlsx, read_cells, write_xlsx
+
+
+class Workbook:
+    # Headless sheet + formulas + file I/O; imports nothing from pygame/tkinter.
+    def __init__(self):
+        self.sheet = Sheet()
+        self.engine = FormulaEngine(self.sheet)
+
+    @classmethod
+    def open(cls, path, encoding='utf-8'):
+        wb = cls()
+        wb.load(path, encoding)
+        return wb
+
+    def load(self, path, encoding='utf-8'):
+        # .xlsx by extension (the encoding is then ignored), CSV otherwise
+        sheet = self.sheet
+        if is_xlsx(path):
+            for row, col, value, color in read_cells(path):
+                if value:
+                    sheet.set(row, col, value)
+                if color:
+                    sheet.set_color(row, col, color)
+            self.engine.rebuild()
+            return
+        # the window's importer (a big file into an empty sheet is parsed on
+        # all cores), so column types are found the same way
+        importer = open_importer(path, sheet, encoding)
+        importer.start()
+        while not importer.apply(sheet, 1.0):
+            time.sleep(0.005)
+        if importer.error:
+            raise importer.error
+        self.engine.rebuild()
+
+    def save(self, path, values=False, encoding='utf-8'):
+        # values=True writes computed results instead of formulas
+        data = self.sheet.values
+        if values:
+            data = {key: self.engine.display(*key) for key in data}
+        if is_xlsx(path):
+            with open(path, 'wb') as f:
+                write_xlsx(f, data, self.sheet.colors, self.engine.results)
+            return
+        with open(path, 'w', newline='', encoding=encoding) as f:
+            write_rows(csv.writer(f), data)
+
+    def get(self, ref):
+        return self.sheet.get(*parse_ref(ref))
+
+    def set(self, ref, value):
+        row, col = parse_ref(ref)
+        self.sheet.set(row, col, value)
+        self.engine.update(row, col)
+
+    def value(self, ref):
+        return self.engine.display(*parse_ref(ref))
+
+    def evaluate(self, text):
+        result = self.engine.evaluate(text)
+        if isinstance(result, FormulaError):
+            return result.code
+        return format_value(result)
+
+    def used_range(self):
+        return self.sheet.used_range()
+
+    def column_range(self, label):
+        # whole used part of one column, e.g. 'B' -> 'B1:B250'
+        rows, _ = self.used_range()
+        return f"{label}1:{label}{max(rows, 1)}"
+
+    def row(self, r, values=False):
+        # one dense row, trailing empty cells trimmed
+        row = self.sheet.row_values(r)
+        if values:
+            row = [self.engine.display(r, c) if v else v for c, v in enumerate(row)]
+        return row
+
+    def rows(self, values=False):
+        # dense rows of the used range
+        nrows, _ = self.used_range()
+        for r in range(nrows):
+            yield self.row(r, values)
@@ -0,0 +1,418 @@
+import posixpath
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape, quoteattr
+
+from columns import to_number
+from csvio import CHUNK_ROWS
+from filejobs import Importer, Exporter
+from formula import FUNCTIONS, LOOKUPS, FormulaError, compile_formula
+from sheet import get_column_label, column_index
+
+# Only the standard library: the package is a zip of XML parts, read with
+# iterparse and written part by part, so neither side ever holds a whole
+# worksheet as a tree. Handles shared and inline strings, numbers, booleans,
+# formulas (kept when PyExcel can evaluate them, else their cached value) and
+# solid RGB cell fills. Dates come through as their serial numbers.
+
+MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+REF_RE = re.compile(r'([A-Za-z]+)(\d+)')
+# characters XML 1.0 cannot carry at all
+BAD_XML_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f￾￿]')
+WHITE = (255, 255, 255)
+
+
+def is_xlsx(path):
+    # not .xlsm: the writer has no macro-enabled content types
+    return path.lower().endswith('.xlsx')
+
+
+def _local(tag):
+    # works for both the transitional and the strict namespace
+    return tag.rsplit('}', 1)[-1]
+
+
+class _Counter:
+    # file wrapper that remembers how far the parser has read, for progress
+    def __init__(self, f):
+        self.f = f
+        self.position = 0
+
+    def read(self, n=-1):
+        data = self.f.read(n)
+        self.position += len(data)
+        return data
+
+
+def _first_sheet(zf):
+    try:
+        book = ET.fromstring(zf.read('xl/workbook.xml'))
+        rels = ET.fromstring(zf.read('xl/_rels/workbook.xml.rels'))
+    except KeyError:
+        return 'xl/worksheets/sheet1.xml'
+    sheet = next((el for el in book.iter() if _local(el.tag) == 'sheet'), None)
+    rid = None if sheet is None else sheet.get(f'{{{REL_NS}}}id')
+    for rel in rels:
+        if rel.get('Id') == rid:
+            target = rel.get('Target')
+            if target.startswith('/'):
+                return target[1:]
+            return posixpath.normpath(posixpath.join('xl', target))
+    return 'xl/worksheets/sheet1.xml'
+
+
+def _shared_strings(zf):
+    strings = []
+    try:
+        f = zf.open('xl/sharedStrings.xml')
+    except KeyError:
+        return strings
+    with f:
+        parent = None
+        for event, el in ET.iterparse(f, ('start', 'end')):
+            name = _local(el.tag)
+            if event == 'start':
+                if name == 'sst':
+                    parent = el
+                continue
+            if name == 'si':
+                strings.append(_string_item(el))
+                parent.clear()
+    return strings
+
+
+def _string_item(el):
+    # <si>/<is>: plain <t>, or rich text runs <r><t>; phonetic <rPh> is skipped
+    parts = []
+    for child in el:
+        name = _local(child.tag)
+        if name == 't':
+            parts.append(child.text or '')
+        elif name == 'r':
+            for t in child:
+                if _local(t.tag) == 't':
+                    parts.append(t.text or '')
+    return ''.join(parts)
+
+
+def _fill_colors(zf):
+    # style index (the s attribute of a cell) -> fill colour or None
+    try:
+        styles = ET.fromstring(zf.read('xl/styles.xml'))
+    except KeyError:
+        return []
+    fills, xfs = [], []
+    for el in styles:
+        name = _local(el.tag)
+        if name == 'fills':
+            for fill in el:
+                color = None
+                for pattern in fill:
+                    if _local(pattern.tag) == 'patternFill' and pattern.get('patternType') == 'solid':
+                        for fg in pattern:
+                            rgb = fg.get('rgb')
+                            if _local(fg.tag) == 'fgColor' and rgb and len(rgb) in (6, 8):
+                                rgb = rgb[-6:]
+                                color = (int(rgb[0:2], 16), int(rgb[2:4], 16), int(rgb[4:6], 16))
+                fills.append(color)
+        elif name == 'cellXfs':
+            xfs = [int(xf.get('fillId', 0)) for xf in el]
+    return [fills[i] if i < len(fills) else None for i in xfs]
+
+
+def read_cells(path, progress=None):
+    # yields (row, col, value, color) for every stored cell of the first sheet;
+    # color is None for no fill. progress(done, total) gets the bytes parsed.
+    with zipfile.ZipFile(path) as zf:
+        strings = _shared_strings(zf)
+        colors = _fill_colors(zf)
+        name = _first_sheet(zf)
+        total = zf.getinfo(name).file_size
+        with zf.open(name) as raw:
+            f = _Counter(raw)
+            sheet_data = row_tag = None
+            row = -1
+            columns = {}
+            for event, el in ET.iterparse(f, ('start', 'end')):
+                if event == 'start':
+                    if row_tag is None:
+                        # the root's namespace names every other tag; plain
+                        # string compares keep the per-element cost down
+                        ns = el.tag[:el.tag.find('}') + 1]
+                        row_tag, data_tag, cell_tag = ns + 'row', ns + 'sheetData', ns + 'c'
+                        children = {ns + 'v': 'v', ns + 'f': 'f', ns + 'is': 'is'}
+                    elif el.tag == data_tag:
+                        sheet_data = el
+                    continue
+                if el.tag != row_tag:
+                    continue
+                r = el.get('r')
+                row = int(r) - 1 if r else row + 1
+                col = -1
+                for c in el:
+                    if c.tag != cell_tag:
+                        continue
+                    ref = c.get('r')
+                    if ref:
+                        label = REF_RE.match(ref).group(1)
+                        col = columns.get(label)
+                        if col is None:
+                            col = columns[label] = column_index(label)
+                    else:
+                        col += 1
+                    value = _cell_value(c, strings, children)
+                    style = c.get('s')
+                    color = colors[int(style)] if style and int(style) < len(colors) else None
+                    if color == WHITE:
+                        color = None
+                    if value or color:
+                        yield row, col, value, color
+                # the row is done: drop it so the tree never grows
+                if sheet_data is not None:
+                    sheet_data.clear()
+                if progress:
+                    progress(f.position, total)
+
+
+def _cell_value(el, strings, children):
+    kind = el.get('t', 'n')
+    v = formula = None
+    for child in el:
+        name = children.get(child.tag)
+        if name == 'v':
+            v = child.text
+        elif name == 'f':
+            formula = child.text
+        elif name == 'is':
+            return _string_item(child)
+    if formula and _supported(compile_formula(formula)):
+        return '=' + formula
+    if v is None:
+        return ''
+    if kind == 's':
+        return strings[int(v)]
+    if kind == 'b':
+        return 'TRUE' if v == '1' else 'FALSE'
+    return v
+
+
+def _supported(node):
+    # a formula PyExcel can evaluate: it parses and calls only known functions
+    kind = node[0]
+    if kind == 'error':
+        return False
+    if kind == 'neg':
+        return _supported(node[1])
+    if kind == 'bin':
+        return _supported(node[2]) and _supported(node[3])
+    if kind == 'call':
+        return (node[1] in FUNCTIONS or node[1] in LOOKUPS) and all(_supported(arg) for arg in node[2])
+    return True
+
+
+def write_xlsx(f, values, colors=None, results=None, on_row=None):
+    # values: {(row, col): str}, colors: {(row, col): (r, g, b)}, results: the
+    # formula engine's results, written as the cached value of each formula.
+    # f is a binary file; the sheet XML is streamed into the zip as it is made.
+    colors = colors or {}
+    results = results or {}
+    fills = {}
+    for color in colors.values():
+        fills.setdefault(color, len(fills) + 1)
+    strings = {}
+    with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zf:
+        with zf.open('xl/worksheets/sheet1.xml', 'w') as raw:
+            out = _Writer(raw)
+            out.write(f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                      f'<worksheet xmlns="{MAIN_NS}"><sheetData>')
+            current, cells = None, 0
+            for key in sorted(values.keys() | colors.keys()):
+                r, c = key
+                if r != current:
+                    if current is not None:
+                        out.write('</row>')
+                        if on_row:
+                            on_row(cells)
+                    out.write(f'<row r="{r + 1}">')
+                    current, cells = r, 0
+                cells += 1
+                ref = f'{get_column_label(c)}{r + 1}'
+                style = f' s="{fills[colors[key]]}"' if key in colors else ''
+                raw_value = values.get(key)
+                if not raw_value:
+                    out.write(f'<c r="{ref}"{style}/>')
+                elif raw_value.startswith('='):
+                    out.write(f'<c r="{ref}"{style}{_cached(results.get(key))}'
+                              f'<f>{_text(raw_value[1:])}</f>{_cached_value(results.get(key))}</c>')
+                elif _is_number(raw_value):
+                    out.write(f'<c r="{ref}"{style}><v>{raw_value}</v></c>')
+                else:
+                    index = strings.setdefault(raw_value, len(strings))
+                    out.write(f'<c r="{ref}"{style} t="s"><v>{index}</v></c>')
+            if current is not None:
+                out.write('</row>')
+                if on_row:
+                    on_row(cells)
+            out.write('</sheetData></worksheet>')
+            out.flush()
+        with zf.open('xl/sharedStrings.xml', 'w') as raw:
+            out = _Writer(raw)
+            out.write(f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                      f'<sst xmlns="{MAIN_NS}" count="{len(strings)}" uniqueCount="{len(strings)}">')
+            for text in strings:
+                out.write(f'<si><t xml:space="preserve">{_text(text)}</t></si>')
+            out.write('</sst>')
+            out.flush()
+        zf.writestr('xl/styles.xml', _styles(fills))
+        zf.writestr('[Content_Types].xml', CONTENT_TYPES)
+        zf.writestr('_rels/.rels', ROOT_RELS)
+        zf.writestr('xl/workbook.xml', WORKBOOK)
+        zf.writestr('xl/_rels/workbook.xml.rels', WORKBOOK_RELS)
+
+
+class _Writer:
+    # batches small strings into larger compressed writes
+    def __init__(self, raw):
+        self.raw = raw
+        self.parts = []
+        self.size = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size > 1 << 16:
+            self.flush()
+
+    def flush(self):
+        self.raw.write(''.join(self.parts).encode('utf-8'))
+        self.parts = []
+        self.size = 0
+
+
+def _is_number(raw):
+    # written as a number only if reading it back gives the same text: no
+    # padding, no leading zeros ('007' is a code, not 7), nothing to_number
+    # turns down (1e400 would overflow)
+    if raw != raw.strip() or to_number(raw) is None:
+        return False
+    digits = raw.lstrip('+-')
+    return not (len(digits) > 1 and digits[0] == '0' and digits[1].isdigit())
+
+
+def _text(text):
+    return escape(BAD_XML_RE.sub('', text))
+
+
+def _cached(result):
+    # the t attribute (closing the tag) matching a formula's cached result
+    if isinstance(result, FormulaError):
+        return ' t="e">'
+    if isinstance(result, str):
+        return ' t="str">'
+    return '>'
+
+
+def _cached_value(result):
+    if result is None or result != result or result in (float('inf'), float('-inf')):
+        return ''
+    if isinstance(result, FormulaError):
+        return f'<v>{_text(result.code)}</v>'
+    if isinstance(result, str):
+        return f'<v>{_text(result)}</v>'
+    return f'<v>{result!r}</v>'
+
+
+def _styles(fills):
+    # fill 0 and 1 are the two Excel requires; every colour used gets a solid
+    # fill and a cell format of its own, numbered like in `fills`
+    parts = [f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<styleSheet xmlns="{MAIN_NS}">',
+             '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>',
+             f'<fills count="{len(fills) + 2}"><fill><patternFill patternType="none"/></fill>'
+             '<fill><patternFill patternType="gray125"/></fill>']
+    for r, g, b in fills:
+        parts.append(f'<fill><patternFill patternType="solid"><fgColor rgb="FF{r:02X}{g:02X}{b:02X}"/>'
+                     '<bgColor indexed="64"/></patternFill></fill>')
+    parts.append('</fills><borders count="1"><border/></borders>'
+                 '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+                 f'<cellXfs count="{len(fills) + 1}"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>')
+    for i in range(len(fills)):
+        parts.append(f'<xf numFmtId="0" fontId="0" fillId="{i + 2}" borderId="0" xfId="0" applyFill="1"/>')
+    parts.append('</cellXfs></styleSheet>')
+    return ''.join(parts)
+
+
+CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/sharedStrings.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '</Types>')
+ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    f'<Relationships xmlns="{PKG_REL_NS}">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+    'officeDocument" Target="xl/workbook.xml"/></Relationships>')
+WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    f'<workbook xmlns="{MAIN_NS}" xmlns:r="{REL_NS}">'
+    '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>')
+WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    f'<Relationships xmlns="{PKG_REL_NS}">'
+    f'<Relationship Id="rId1" Type="{REL_NS}/worksheet" Target="worksheets/sheet1.xml"/>'
+    f'<Relationship Id="rId2" Type="{REL_NS}/styles" Target="styles.xml"/>'
+    f'<Relationship Id="rId3" Type="{REL_NS}/sharedStrings" Target="sharedStrings.xml"/>'
+    '</Relationships>')
+
+
+class XLSXImporter(Importer):
+    # Hands over chunks of (row, col, value, color) cells from read_cells.
+    errors = (OSError, zipfile.BadZipFile, ET.ParseError, KeyError, ValueError, IndexError)
+
+    def __init__(self, path, chunk_cells=CHUNK_ROWS * 8):
+        super().__init__(path)
+        self.chunk_cells = chunk_cells
+
+    def _read(self):
+        chunk = []
+        for cell in read_cells(self.path, self._progress):
+            chunk.append(cell)
+            if len(chunk) >= self.chunk_cells:
+                if not self._put(chunk):
+                    return
+                chunk = []
+        if chunk:
+            self._put(chunk)
+
+    def _progress(self, done, total):
+        self.position, self.total = done, total
+
+    def _apply_item(self, sheet, item):
+        for row, col, value, color in item:
+            if value:
+                sheet.set(row, col, value)
+            if color:
+                sheet.set_color(row, col, color)
+
+
+class XLSXExporter(Exporter):
+    # The used range with colours, and formula results as cached values.
+    def __init__(self, path, sheet, worker, engine=None):
+        self.values = dict(sheet.values)
+        self.colors = dict(sheet.colors)
+        self.results = dict(engine.results) if engine is not None else {}
+        super().__init__(path, worker, len(self.values.keys() | self.colors.keys()), binary=True)
+
+    def _write(self, f):
+        write_xlsx(f, self.values, self.colors, self.results, self._count)
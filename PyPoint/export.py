@@ -0,0 +1,67 @@
+import argparse
+import configparser
+import json
+import os
+import sys
+
+import pygame
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PyCommon'))
+from fontcache import FontCache
+from headless import export, finish_page
+from slidecache import compose, canvas_rect, SLIDE_TEXT
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.cfg'))
+WINDOW = (config.getint('General', 'WIDHT', fallback=1000), config.getint('General', 'HEIGHT', fallback=700))
+
+text_cache = None
+
+
+def render_slide(task):
+    # runs in a worker process; drawn like a presentation frame, the slide
+    # canvas scaled to the output size
+    global text_cache
+    if text_cache is None:
+        text_cache = FontCache()
+    (items, size), png = task
+    canvas = canvas_rect(WINDOW)
+    parts = [(text_cache.render(it['text'], SLIDE_TEXT, it['font_size']),
+              (it['pos'][0] - canvas.left, it['pos'][1] - canvas.top)) for it in items]
+    image = compose(pygame.Surface(canvas.size), parts)
+    if image.get_size() != size:
+        image = pygame.transform.smoothscale(image, size)
+    return finish_page(image, png)
+
+
+def parse_size(text):
+    try:
+        w, h = (int(v) for v in text.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"bad size: {text!r}, expected e.g. 1920x1080")
+    return w, h
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='export.py', description="render PyPoint decks without a window")
+    parser.add_argument('decks', nargs='+', help="decks saved by PyPoint (.json)")
+    parser.add_argument('-o', '--out', required=True, help="folder for <deck>-001.png, ... or <deck>.pdf")
+    parser.add_argument('--pdf', action='store_true', help="one PDF per deck instead of a PNG per slide")
+    parser.add_argument('--size', type=parse_size, default=WINDOW, help="output size, e.g. 1920x1080")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (default: one per core)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    decks = []
+    for path in args.decks:
+        with open(path, 'r') as f:
+            slides = json.load(f)
+        decks.append((os.path.splitext(os.path.basename(path))[0], [(items, args.size) for items in slides]))
+    count = export(decks, args.out, args.pdf, render_slide, args.jobs)
+    print(f"{count} slides -> {args.out}")
+
+
+if __name__ == '__main__':
+    main()
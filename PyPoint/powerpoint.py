@@ -1,9 +1,16 @@
 import pygame
+import os
 import sys
 import json
 import tkinter as tk
 from tkinter import filedialog
 import configparser
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PyCommon'))
+from iowork import IOWorker, Autosave, autosave_path
+from fontcache import FontCache
+from profiler import Profiler
+from slidecache import RenderCache, compose, canvas_rect, SLIDE_TEXT, SIDE_PANEL_W, TOP_PANEL_H
+from spatial import GridIndex
 
 config = configparser.ConfigParser()
 config.read('config.cfg')
@@ -13,14 +20,13 @@ pygame.init()
 screen = pygame.display.set_mode(data_size)
 pygame.display.set_caption("PyPoint")
 clock = pygame.time.Clock()
+text_cache = FontCache(config.getint('General', 'TEXT_CACHE_KB', fallback=4096) * 1024)
+io_worker = IOWorker()
+profiler = Profiler("PyPoint", config.getboolean('General', 'PROFILE', fallback=False),
+                    config.get('General', 'TRACE_FILE', fallback=''), io_worker)
+profiler.watch('text', text_cache.stats, ('hits', 'misses', 'evictions'))
 
-SIDE_PANEL_W = 100
-TOP_PANEL_H = 50
-CANVAS_RECT = pygame.Rect(
-    SIDE_PANEL_W, TOP_PANEL_H,
-    data_size[0] - SIDE_PANEL_W,
-    data_size[1] - TOP_PANEL_H
-)
+CANVAS_RECT = canvas_rect(data_size)
 
 COL_BG = (240, 240, 240)
 COL_SIDE = (200, 200, 200)
@@ -32,17 +38,17 @@ COL_MENU_BG = (220, 220, 220)
 
 side_scroll = 0
 SCROLL_STEP = 20
+SIDE_ROW_H = 50
 
 class Button:
     def __init__(self, text, rect, callback):
         self.text = text
         self.rect = pygame.Rect(rect)
         self.callback = callback
-        self.font = pygame.font.Font(None, 24)
         self.render()
 
     def render(self):
-        self.image = self.font.render(self.text, True, COL_TEXT)
+        self.image = text_cache.render(self.text, COL_TEXT, 24)
         self.text_rect = self.image.get_rect(center=self.rect.center)
 
     def draw(self, surface):
@@ -59,7 +65,6 @@ class Menu:
     def __init__(self, options, pos, callbacks):
         self.options = options
         self.callbacks = callbacks
-        self.font = pygame.font.Font(None, 24)
         self.pos = pos
         self.items = []
         self.setup()
@@ -69,7 +74,7 @@ class Menu:
         h = 30
         for idx, opt in enumerate(self.options):
             rect = pygame.Rect(x, y + idx*h, 120, h)
-            surf = self.font.render(opt, True, COL_TEXT)
+            surf = text_cache.render(opt, COL_TEXT, 24)
             self.items.append((opt, rect, surf))
 
     def draw(self, surface):
@@ -93,15 +98,20 @@ class TextItem:
         self.pos = position
         self.dragging = False
         self.selected = False
+        self.slide = None
         self._render()
 
     def _render(self):
-        self.font = pygame.font.Font(None, self.font_size)
-        self.image = self.font.render(self.text, True, COL_TEXT)
+        self.image = text_cache.render(self.text, SLIDE_TEXT, self.font_size)
         self.rect = self.image.get_rect(topleft=self.pos)
+        self.changed()
 
-    def draw(self, surface):
-        surface.blit(self.image, self.rect)
+    def changed(self):
+        if self.slide is not None:
+            self.slide.item_changed(self)
+
+    def draw_selection(self, surface):
+        # the item itself is part of its slide's cached surface
         if self.selected:
             pygame.draw.rect(surface, (0, 120, 215), self.rect, 2)
 
@@ -119,17 +129,65 @@ class TextItem:
         new_y = max(CANVAS_RECT.top, min(new_y, CANVAS_RECT.bottom - self.rect.height))
         self.rect.x = new_x
         self.rect.y = new_y
+        self.changed()
 
     def end_drag(self):
         self.dragging = False
 
     def set_text(self, new_text):
         self.text = new_text
+        self.pos = self.rect.topleft
         self._render()
 
 class Slide:
+    # `version` goes up on every change to the slide or its items; the
+    # rendered surface and the thumbnails are redone only when it moved
+    # `grid` answers "what is under the mouse" without looping over every item
     def __init__(self):
         self.items = []
+        self.version = 0
+        self.surface = None
+        self.surface_version = -1
+        self.grid = GridIndex()
+
+    def add(self, item):
+        item.slide = self
+        self.items.append(item)
+        self.grid.insert(item)
+        self.version += 1
+
+    def remove(self, item):
+        self.items.remove(item)
+        self.grid.remove(item)
+        item.slide = None
+        self.version += 1
+
+    def item_changed(self, item):
+        self.grid.update(item)
+        self.version += 1
+
+    def item_at(self, pos):
+        return self.grid.at_point(pos)
+
+    def items_in(self, rect):
+        return self.grid.in_rect(rect)
+
+    def selected(self):
+        return [item for item in self.items if item.selected]
+
+    def snapshot(self):
+        return [(item.image, (item.rect.x - CANVAS_RECT.left, item.rect.y - CANVAS_RECT.top))
+                for item in self.items]
+
+    def render(self):
+        if self.surface_version != self.version:
+            if self.surface is None:
+                self.surface = pygame.Surface(CANVAS_RECT.size)
+            with profiler.phase('compose'):
+                compose(self.surface, self.snapshot())
+            profiler.count('slide renders')
+            self.surface_version = self.version
+        return self.surface
 
 class SlideManager:
     def __init__(self):
@@ -154,13 +212,22 @@ current_font = 32
 context_menu = None
 presenting = False
 present_index = 0
-
-def save_presentation():
-    root = tk.Tk(); root.withdraw()
-    filename = filedialog.asksaveasfilename(defaultextension='.json',
-                                            filetypes=[('JSON Files', '*.json')])
-    if not filename:
-        return
+dragging = []
+marquee_start = None
+marquee_rect = None
+
+THUMB_SCALE = min((SIDE_PANEL_W - 24) / CANVAS_RECT.width, (SIDE_ROW_H - 8) / CANVAS_RECT.height)
+thumbnails = RenderCache(CANVAS_RECT.size,
+                         (int(CANVAS_RECT.width * THUMB_SCALE), int(CANVAS_RECT.height * THUMB_SCALE)),
+                         config.getint('General', 'THUMBNAIL_CACHE', fallback=128))
+# full-screen frames for presenting: the shown slide and its neighbours
+frames = RenderCache(CANVAS_RECT.size, data_size, 8)
+shown_frame = None
+autosave = Autosave(io_worker, config.getint('General', 'AUTOSAVE_SECONDS', fallback=60))
+current_path = None
+save_jobs = []
+
+def presentation_data():
     data = []
     for slide in slide_mgr.slides:
         slide_data = []
@@ -171,15 +238,44 @@ def save_presentation():
                 'pos': (item.rect.x, item.rect.y)
             })
         data.append(slide_data)
-    with open(filename, 'w') as f:
-        json.dump(data, f)
+    return data
+
+autosaved_data = presentation_data()
+
+def save_presentation():
+    global current_path
+    root = tk.Tk(); root.withdraw()
+    filename = filedialog.asksaveasfilename(defaultextension='.json',
+                                            filetypes=[('JSON Files', '*.json')])
+    if not filename:
+        return
+    # the data is a snapshot; json is written on the I/O worker
+    data = presentation_data()
+    save_jobs.append(io_worker.submit(filename, lambda f: json.dump(data, f)))
+    current_path = filename
+
+def poll_saves():
+    global save_jobs, autosaved_data
+    for job in save_jobs:
+        if job.finished and job.error is not None:
+            pygame.display.set_caption(f"PyPoint - {job.error}")
+    save_jobs = [job for job in save_jobs if not job.finished]
+    if autosave.due():
+        data = presentation_data()
+        if data != autosaved_data:
+            autosaved_data = data
+            path = autosave_path(current_path, 'autosave.json')
+            save_jobs.append(autosave.save(path, lambda f: json.dump(data, f)))
 
 def load_presentation():
+    global current_path, autosaved_data
     root = tk.Tk(); root.withdraw()
     filename = filedialog.askopenfilename(defaultextension='.json',
                                           filetypes=[('JSON Files', '*.json')])
     if not filename:
         return
+    for job in save_jobs:
+        job.wait()
     with open(filename, 'r') as f:
         data = json.load(f)
     slide_mgr.slides = []
@@ -187,9 +283,13 @@ def load_presentation():
         slide = Slide()
         for it in slide_data:
             item = TextItem(it['text'], it['font_size'], it['pos'])
-            slide.items.append(item)
+            slide.add(item)
         slide_mgr.slides.append(slide)
     slide_mgr.current = 0
+    thumbnails.clear()
+    frames.clear()
+    current_path = filename
+    autosaved_data = presentation_data()
 
 def new_slide():
     slide_mgr.add_slide()
@@ -197,7 +297,7 @@ def new_slide():
 def add_text():
     item = TextItem("New text", current_font,
                     (SIDE_PANEL_W + 20, TOP_PANEL_H + 20))
-    slide_mgr.get_current().items.append(item)
+    slide_mgr.get_current().add(item)
 
 def increase_font():
     global current_font
@@ -208,9 +308,10 @@ def decrease_font():
     current_font = max(8, current_font - 4)
 
 def start_presentation():
-    global presenting, present_index
+    global presenting, present_index, shown_frame
     presenting = True
     present_index = 0
+    shown_frame = None
 
 buttons = [
     Button("New Slide", (10, 10, 80, 30), new_slide),
@@ -225,13 +326,16 @@ buttons = [
 def prompt_text(initial=""):
     pygame.key.start_text_input()
     text = initial
-    font = pygame.font.Font(None, 32)
+    # the text changes on every key, so it is not worth keeping in text_cache
+    font = text_cache.font(32)
     input_rect = pygame.Rect(200, data_size[1]//2 - 20, 400, 40)
     active = True
     while active:
         for ev in pygame.event.get():
             if ev.type == pygame.QUIT:
                 pygame.key.stop_text_input()
+                profiler.close()
+                io_worker.close()
                 pygame.quit(); sys.exit()
             if ev.type == pygame.KEYDOWN:
                 if ev.key == pygame.K_RETURN:
@@ -250,7 +354,22 @@ def prompt_text(initial=""):
 
 running = True
 while running:
-    for event in pygame.event.get():
+    profiler.frame()
+    profiler.enter('io')
+    poll_saves()
+    profiler.enter('events')
+    events = pygame.event.get()
+    if presenting and not events:
+        # a slide on screen needs no new frames: sleep until a key is pressed
+        profiler.enter('idle')
+        event = pygame.event.wait(500)
+        if event.type != pygame.NOEVENT:
+            events = [event]
+        profiler.enter('events')
+    for event in events:
+        if profiler.handle_event(event):
+            shown_frame = None
+            continue
         if event.type == pygame.QUIT:
             running = False
 
@@ -258,7 +377,7 @@ while running:
                 and event.button in (4, 5)):
             mx, my = event.pos
             if mx < SIDE_PANEL_W and my > TOP_PANEL_H:
-                total_h = slide_mgr.num_slides() * 50
+                total_h = slide_mgr.num_slides() * SIDE_ROW_H
                 view_h = data_size[1] - TOP_PANEL_H
                 max_scroll = min(0, view_h - total_h)
                 if event.button == 4:  
@@ -267,6 +386,8 @@ while running:
                     side_scroll = max(side_scroll - SCROLL_STEP, max_scroll)
 
         if presenting:
+            if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                shown_frame = None
             if event.type == pygame.KEYDOWN:
                 if event.key in (pygame.K_RETURN, pygame.K_RIGHT, pygame.K_SPACE):
                     present_index = min(present_index + 1, slide_mgr.num_slides() - 1)
@@ -274,6 +395,7 @@ while running:
                     present_index = max(present_index - 1, 0)
                 elif event.key == pygame.K_BACKSPACE:
                     presenting = False
+                    shown_frame = None
             continue
 
         for btn in buttons:
@@ -282,7 +404,7 @@ while running:
         if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
             x, y = event.pos
             if x < SIDE_PANEL_W and y > TOP_PANEL_H:
-                idx = (y - TOP_PANEL_H - side_scroll) // 50
+                idx = (y - TOP_PANEL_H - side_scroll) // SIDE_ROW_H
                 slide_mgr.switch_to(idx)
 
         if context_menu:
@@ -291,34 +413,67 @@ while running:
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 context_menu = None
         else:
-            for item in slide_mgr.get_current().items:
-                if event.type == pygame.MOUSEBUTTONDOWN and event.button == 3:
-                    if item.rect.collidepoint(event.pos):
-                        def delete_item(i=item): slide_mgr.get_current().items.remove(i)
-                        def edit_item(i=item):  i.set_text(prompt_text(i.text))
-                        opts = ["Edit", "Delete"]
-                        cbs = {"Edit": edit_item, "Delete": delete_item}
-                        context_menu = Menu(opts, event.pos, cbs)
-                        break
-                if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                    if item.rect.collidepoint(event.pos):
-                        item.start_drag(event.pos)
-                if event.type == pygame.MOUSEMOTION and item.dragging:
-                    item.update_drag(event.pos)
-                if event.type == pygame.MOUSEBUTTONUP and event.button == 1 and item.dragging:
-                    item.end_drag()
-
-    screen.fill(COL_BG)
+            slide = slide_mgr.get_current()
+            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 3:
+                item = slide.item_at(event.pos)
+                if item is not None:
+                    def delete_item(i=item): slide_mgr.get_current().remove(i)
+                    def edit_item(i=item):  i.set_text(prompt_text(i.text))
+                    opts = ["Edit", "Delete"]
+                    cbs = {"Edit": edit_item, "Delete": delete_item}
+                    context_menu = Menu(opts, event.pos, cbs)
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and CANVAS_RECT.collidepoint(event.pos):
+                # click picks the topmost item, shift adds to the selection,
+                # dragging on empty canvas selects with a rectangle
+                item = slide.item_at(event.pos)
+                shift = pygame.key.get_mods() & pygame.KMOD_SHIFT
+                if item is None:
+                    if not shift:
+                        for it in slide.selected():
+                            it.selected = False
+                    marquee_start = event.pos
+                    marquee_rect = pygame.Rect(event.pos, (0, 0))
+                else:
+                    if not item.selected and not shift:
+                        for it in slide.selected():
+                            it.selected = False
+                    item.selected = True
+                    dragging = slide.selected()
+                    for it in dragging:
+                        it.start_drag(event.pos)
+            elif event.type == pygame.MOUSEMOTION and dragging:
+                for it in dragging:
+                    it.update_drag(event.pos)
+            elif event.type == pygame.MOUSEMOTION and marquee_start:
+                x0, y0 = marquee_start
+                x1, y1 = event.pos
+                marquee_rect = pygame.Rect(min(x0, x1), min(y0, y1), abs(x1 - x0), abs(y1 - y0))
+            elif event.type == pygame.MOUSEBUTTONUP and event.button == 1:
+                for it in dragging:
+                    it.end_drag()
+                dragging = []
+                if marquee_start:
+                    for it in slide.items_in(marquee_rect):
+                        it.selected = True
+                    marquee_start = marquee_rect = None
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_DELETE:
+                for it in slide.selected():
+                    slide.remove(it)
+
+    profiler.enter('draw')
     if presenting:
-        slide_surf = pygame.Surface((CANVAS_RECT.width, CANVAS_RECT.height))
-        slide_surf.fill((255,255,255))
-        for item in slide_mgr.slides[present_index].items:
-            rel_x = item.rect.x - CANVAS_RECT.left
-            rel_y = item.rect.y - CANVAS_RECT.top
-            slide_surf.blit(item.image, (rel_x, rel_y))
-        scaled = pygame.transform.smoothscale(slide_surf, data_size)
-        screen.blit(scaled, (0,0))
+        frame = frames.get_now(slide_mgr.slides[present_index])
+        for i in (present_index - 1, present_index + 1):
+            if 0 <= i < slide_mgr.num_slides():
+                frames.prefetch(slide_mgr.slides[i])
+        if frame is not shown_frame:
+            screen.blit(frame, (0, 0))
+            profiler.draw(screen)
+            profiler.enter('present')
+            pygame.display.flip()
+            shown_frame = frame
     else:
+        screen.fill(COL_BG)
         pygame.draw.rect(screen, COL_TOP, (0, 0, data_size[0], TOP_PANEL_H))
         for btn in buttons:
             btn.draw(screen)
@@ -327,29 +482,45 @@ while running:
         clip_rect = pygame.Rect(0, TOP_PANEL_H, SIDE_PANEL_W, data_size[1] - TOP_PANEL_H)
         screen.set_clip(clip_rect)
 
-        for i in range(slide_mgr.num_slides()):
-            y0 = TOP_PANEL_H + i*50 + side_scroll
-            rect = pygame.Rect(0, y0, SIDE_PANEL_W, 50)
-            if rect.bottom < TOP_PANEL_H or rect.top > data_size[1]:
-                continue
+        # only the rows on screen; previews come from the background cache
+        thumbnails.collect()
+        first = max(0, -side_scroll // SIDE_ROW_H)
+        last = min(slide_mgr.num_slides(), (data_size[1] - TOP_PANEL_H - side_scroll) // SIDE_ROW_H + 1)
+        for i in range(first, last):
+            y0 = TOP_PANEL_H + i*SIDE_ROW_H + side_scroll
+            rect = pygame.Rect(0, y0, SIDE_PANEL_W, SIDE_ROW_H)
             col = COL_ACTIVE if i == slide_mgr.current else COL_SIDE
             pygame.draw.rect(screen, col, rect)
-            num_surf = pygame.font.Font(None, 36).render(str(i+1), True, COL_TEXT)
-            num_rect = num_surf.get_rect()
-            num_rect.centerx = SIDE_PANEL_W // 2
-            num_rect.centery = y0 + 25
-            screen.blit(num_surf, num_rect)
+            thumb_rect = pygame.Rect((0, 0), thumbnails.size)
+            thumb_rect.midright = (SIDE_PANEL_W - 6, y0 + SIDE_ROW_H // 2)
+            thumb = thumbnails.get(slide_mgr.slides[i])
+            if thumb is not None:
+                screen.blit(thumb, thumb_rect)
+            else:
+                pygame.draw.rect(screen, (255, 255, 255), thumb_rect)
+            pygame.draw.rect(screen, COL_TEXT, thumb_rect, 1)
+            num_surf = text_cache.render(str(i+1), COL_TEXT, 20)
+            screen.blit(num_surf, num_surf.get_rect(midleft=(4, y0 + SIDE_ROW_H // 2)))
 
         screen.set_clip(None)
 
-        pygame.draw.rect(screen, (255, 255, 255), CANVAS_RECT)
+        screen.blit(slide_mgr.get_current().render(), CANVAS_RECT)
         for item in slide_mgr.get_current().items:
-            item.draw(screen)
+            item.draw_selection(screen)
+        if marquee_rect:
+            pygame.draw.rect(screen, (0, 120, 215), marquee_rect, 1)
 
         if context_menu:
             context_menu.draw(screen)
 
-    pygame.display.flip()
+        profiler.draw(screen)
+        profiler.enter('present')
+        pygame.display.flip()
+    profiler.enter('idle')
     clock.tick(60)
 
+profiler.close()
+io_worker.close()
+thumbnails.close()
+frames.close()
 pygame.quit()
\ No newline at end of file
@@ -0,0 +1,113 @@
+import queue
+import threading
+from collections import OrderedDict
+
+import pygame
+
+SLIDE_BG = (255, 255, 255)
+SLIDE_TEXT = (0, 0, 0)
+SIDE_PANEL_W = 100
+TOP_PANEL_H = 50
+
+
+def canvas_rect(window_size):
+    # where the slide sits in the window; decks store item positions in
+    # window coordinates, so this is also the offset they are drawn at
+    return pygame.Rect(SIDE_PANEL_W, TOP_PANEL_H,
+                       window_size[0] - SIDE_PANEL_W, window_size[1] - TOP_PANEL_H)
+
+
+def compose(surface, parts):
+    # parts: [(image, (x, y)), ...] relative to the slide's top-left corner
+    surface.fill(SLIDE_BG)
+    for image, pos in parts:
+        surface.blit(image, pos)
+    return surface
+
+
+class RenderCache:
+    # Slides rendered and scaled to `size` on a background thread; the most
+    # recently used `maxsize` are kept. Used for the side panel thumbnails and
+    # for full-screen presentation frames.
+    def __init__(self, full_size, size, maxsize=128):
+        self.full_size = full_size
+        self.size = size
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.pending = set()
+        self.generation = 0
+        # newest request first, so the slides on screen come before ones scrolled past
+        self.requests = queue.LifoQueue()
+        self.results = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def get(self, slide):
+        # never waits: an outdated image (or None) is returned while a new one is made
+        entry = self.items.get(slide)
+        if entry is not None:
+            self.items.move_to_end(slide)
+        self.prefetch(slide)
+        return entry[1] if entry is not None else None
+
+    def prefetch(self, slide):
+        entry = self.items.get(slide)
+        if (entry is None or entry[0] != slide.version) and slide not in self.pending:
+            self.pending.add(slide)
+            self.requests.put((slide, slide.version, slide.snapshot(), self.generation))
+
+    def get_now(self, slide):
+        # the current image, rendered on this thread if the worker has not got to it
+        self.collect()
+        entry = self.items.get(slide)
+        if entry is None or entry[0] != slide.version:
+            image = self._render(pygame.Surface(self.full_size), slide.snapshot())
+            entry = (slide.version, image)
+            self._store(slide, entry)
+        else:
+            self.items.move_to_end(slide)
+        return entry[1]
+
+    def _render(self, full, parts):
+        return pygame.transform.smoothscale(compose(full, parts), self.size)
+
+    def _store(self, slide, entry):
+        self.items[slide] = entry
+        self.items.move_to_end(slide)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def collect(self):
+        # called from the main loop; -> True when new previews came in
+        got = False
+        while True:
+            try:
+                slide, version, image, generation = self.results.get_nowait()
+            except queue.Empty:
+                return got
+            if generation != self.generation:
+                continue
+            self.pending.discard(slide)
+            current = self.items.get(slide)
+            if current is None or current[0] != slide.version:
+                self._store(slide, (version, image))
+            got = True
+
+    def clear(self):
+        # after loading another deck; previews still being made are dropped
+        self.generation += 1
+        self.items.clear()
+        self.pending.clear()
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def _run(self):
+        full = pygame.Surface(self.full_size)
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            slide, version, parts, generation = request
+            self.results.put((slide, version, self._render(full, parts), generation))
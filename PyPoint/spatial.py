@@ -0,0 +1,64 @@
+class GridIndex:
+    # Uniform grid over screen coordinates: every cell keeps the items whose
+    # rect touches it, so a point or a marquee only looks at nearby items.
+    # `order` is the stacking order (higher is drawn later, i.e. on top).
+    def __init__(self, cell=64):
+        self.cell = cell
+        self.cells = {}
+        self.spans = {}
+        self.order = {}
+        self.counter = 0
+
+    def _span(self, rect):
+        c = self.cell
+        return (rect.left // c, rect.top // c,
+                (rect.right - 1) // c if rect.width else rect.left // c,
+                (rect.bottom - 1) // c if rect.height else rect.top // c)
+
+    def insert(self, item):
+        self.counter += 1
+        self.order[item] = self.counter
+        self._place(item, self._span(item.rect))
+
+    def remove(self, item):
+        self._unplace(item)
+        del self.order[item]
+
+    def update(self, item):
+        # after the item moved or changed size; cheap when it stays in its cells
+        span = self._span(item.rect)
+        if self.spans.get(item) != span:
+            self._unplace(item)
+            self._place(item, span)
+
+    def _place(self, item, span):
+        x0, y0, x1, y1 = span
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                self.cells.setdefault((cx, cy), set()).add(item)
+        self.spans[item] = span
+
+    def _unplace(self, item):
+        x0, y0, x1, y1 = self.spans.pop(item)
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                bucket = self.cells[(cx, cy)]
+                bucket.discard(item)
+                if not bucket:
+                    del self.cells[(cx, cy)]
+
+    def at_point(self, pos):
+        # the topmost item under pos, or None
+        x, y = pos
+        bucket = self.cells.get((x // self.cell, y // self.cell), ())
+        hits = [item for item in bucket if item.rect.collidepoint(pos)]
+        return max(hits, key=self.order.get) if hits else None
+
+    def in_rect(self, rect):
+        # items touching rect, bottom to top
+        x0, y0, x1, y1 = self._span(rect)
+        found = set()
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                found.update(self.cells.get((cx, cy), ()))
+        return sorted((item for item in found if item.rect.colliderect(rect)), key=self.order.get)
@@ -0,0 +1,203 @@
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+from textbuffer import make_style
+
+# File layout, all little endian:
+#   header | UTF-8 text of every paragraph | runs | paragraph table | styles JSON
+# A run is (char count, style id); a table entry points a paragraph at its
+# bytes in the text section and its slice of runs.
+MAGIC = b'PYWD'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIQQQQ')
+ENTRY = struct.Struct('<QIIQI')
+RUN = struct.Struct('<II')
+EXTENSION = '.pword'
+
+
+def is_binary(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_document(f, paragraphs, default_style):
+    # paragraphs: iterable of [(text, style), ...]; f is a binary file.
+    # Style 0 is the default, which empty paragraphs fall back to on load.
+    f.write(bytes(HEADER.size))
+    text_off = f.tell()
+    fmt, size, color = default_style
+    styles, style_ids = [[sorted(fmt), size, list(color)]], {default_style: 0}
+    runs = bytearray()
+    table = bytearray()
+    text_pos = run_count = count = 0
+    for para in paragraphs:
+        data = []
+        chars = 0
+        first_run = run_count
+        for text, style in para:
+            sid = style_ids.get(style)
+            if sid is None:
+                sid = style_ids[style] = len(styles)
+                fmt, size, color = style
+                styles.append([sorted(fmt), size, list(color)])
+            data.append(text.encode('utf-8'))
+            chars += len(text)
+            runs += RUN.pack(len(text), sid)
+            run_count += 1
+        data = b''.join(data)
+        f.write(data)
+        table += ENTRY.pack(text_pos, len(data), chars, first_run, run_count - first_run)
+        text_pos += len(data)
+        count += 1
+    runs_off = f.tell()
+    f.write(runs)
+    table_off = f.tell()
+    f.write(table)
+    styles_off = f.tell()
+    f.write(json.dumps(styles).encode('utf-8'))
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, VERSION, 0, len(styles), count, text_off, runs_off, table_off, styles_off))
+
+
+class DocumentFile:
+    # Read side of the format over a memory map. Paragraphs are decoded on
+    # request and a few hundred of them are kept decoded.
+    def __init__(self, path, cache_size=512):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, n_styles, count, self.text_off, self.runs_off, self.table_off, styles_off = \
+            HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version > VERSION:
+            self.close()
+            raise ValueError(f"{path}: not a PyWord document")
+        self.count = count
+        self.styles = [make_style(fmt, size, color)
+                       for fmt, size, color in json.loads(self.map[styles_off:].decode('utf-8'))]
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        # background saves decode paragraphs too
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.cache.clear()
+        if self.map is not None:
+            self.map.close()
+            self._file.close()
+            self.map = None
+
+    def char_length(self, index):
+        return ENTRY.unpack_from(self.map, self.table_off + index * ENTRY.size)[2]
+
+    def runs(self, index):
+        with self.lock:
+            runs = self.cache.get(index)
+            if runs is not None:
+                self.cache.move_to_end(index)
+                return runs
+        text_pos, nbytes, _, first_run, run_count = \
+            ENTRY.unpack_from(self.map, self.table_off + index * ENTRY.size)
+        start = self.text_off + text_pos
+        text = self.map[start:start + nbytes].decode('utf-8')
+        runs = []
+        pos = 0
+        for i in range(first_run, first_run + run_count):
+            length, sid = RUN.unpack_from(self.map, self.runs_off + i * RUN.size)
+            runs.append((text[pos:pos + length], self.styles[sid]))
+            pos += length
+        with self.lock:
+            self.cache[index] = runs
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return runs
+
+    def pieces(self):
+        # one lazy piece per paragraph, the newline included in all but the last
+        last = self.count - 1
+        for i in range(self.count):
+            newline = i < last
+            length = self.char_length(i) + newline
+            if length:
+                yield LazyText(self, i, 0, length, newline), None
+
+
+def pieces_from_json(lines, default_style):
+    # old per-character format -> (text, style) runs with newlines between paragraphs
+    pieces = []
+    for i, line in enumerate(lines):
+        if i:
+            pieces.append(('\n', pieces[-1][1] if pieces else default_style))
+        run, style = [], None
+        for c, fmt, sz, col in line:
+            st = make_style(fmt, sz, col)
+            if st is not style and run:
+                pieces.append((''.join(run), style))
+                run = []
+            style = st
+            run.append(c)
+        if run:
+            pieces.append((''.join(run), style))
+    return pieces
+
+
+class LazyText:
+    # Stands in for the text of a rope piece that still lives in the file:
+    # the window [lo, hi) of paragraph `para` plus its newline. Only the
+    # newline position is known without decoding, which is all line lookups need.
+    __slots__ = ('doc', 'para', 'lo', 'hi', 'newline')
+
+    def __init__(self, doc, index, lo, hi, newline):
+        self.doc = doc
+        self.para = index
+        self.lo = lo
+        self.hi = hi
+        self.newline = newline
+
+    def __len__(self):
+        return self.hi - self.lo
+
+    def _newline_at(self):
+        if not self.newline:
+            return None
+        pos = self.doc.char_length(self.para)
+        return pos if self.lo <= pos < self.hi else None
+
+    def count(self, sub, start=0, end=None):
+        end = len(self) if end is None else end
+        pos = self._newline_at()
+        return int(pos is not None and self.lo + start <= pos < self.lo + end)
+
+    def index(self, sub, start=0):
+        pos = self._newline_at()
+        if pos is None or pos < self.lo + start:
+            raise ValueError('substring not found')
+        return pos - self.lo
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(len(self))
+        return LazyText(self.doc, self.para, self.lo + start, self.lo + max(start, stop), self.newline)
+
+    def runs(self, lo=0, hi=None):
+        # decoded (text, style) runs for [lo, hi) of this window
+        lo += self.lo
+        hi = self.hi if hi is None else self.lo + hi
+        pos = 0
+        out = []
+        runs = self.doc.runs(self.para)
+        for text, style in runs:
+            end = pos + len(text)
+            if end > lo and pos < hi:
+                out.append((text[max(0, lo - pos):hi - pos], style))
+            pos = end
+        if self.newline and lo <= pos < hi:
+            style = runs[-1][1] if runs else self.doc.styles[0]
+            if out and out[-1][1] is style:
+                out[-1] = (out[-1][0] + '\n', style)
+            else:
+                out.append(('\n', style))
+        return out
+
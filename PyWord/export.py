@@ -0,0 +1,92 @@
+import argparse
+import ast
+import configparser
+import json
+import os
+import sys
+
+import pygame
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PyCommon'))
+from fontcache import FontCache
+from headless import start, export, finish_page
+from textbuffer import TextBuffer, make_style
+from layout import LineBox, ParagraphLayout, font_functions, draw_line, default_size
+from docformat import DocumentFile, is_binary, pieces_from_json
+
+Config = configparser.ConfigParser()
+Config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.cfg'))
+PAGE_W = Config.getint('General', 'DOCUMENT_WIDTH', fallback=600)
+PAGE_H = Config.getint('General', 'DOCUMENT_HEIGHT', fallback=700)
+CANVAS_BG = ast.literal_eval(Config.get('Colors', 'DEFAULT_CANVAS_BG', fallback='(255, 255, 255)'))
+TEXT_COLOR = ast.literal_eval(Config.get('Colors', 'DEFAULT_TEXT_COLOR', fallback='(0, 0, 0)'))
+# the same inset as the editor's canvas
+MARGIN = 5
+
+render_text = None
+
+
+def read_pages(path, get_font):
+    # the document laid out at the editor's width and cut into pages of lines;
+    # a line that does not fit on a page starts the next one
+    buffer = TextBuffer()
+    source = None
+    if is_binary(path):
+        source = DocumentFile(path)
+        buffer.load(source.pieces())
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = json.load(f).get("lines", [])
+        buffer.load(pieces_from_json(lines, make_style((), default_size, TEXT_COLOR)))
+    height = PAGE_H - 2 * MARGIN
+    pages, page, top = [], [], 0
+    for runs in buffer.paragraphs():
+        for line in ParagraphLayout(runs, PAGE_W - 2 * MARGIN, get_font, default_size).lines:
+            if page and top + line.height > height:
+                pages.append(page)
+                page, top = [], 0
+            # only what drawing needs goes to the workers
+            page.append(LineBox(line.start, line.end, top, line.height, None, line.segments))
+            top += line.height
+    pages.append(page)
+    if source is not None:
+        source.close()
+    return pages
+
+
+def render_page(task):
+    # runs in a worker process
+    global render_text
+    if render_text is None:
+        _, render_text = font_functions(FontCache())
+    lines, png = task
+    page = pygame.Surface((PAGE_W, PAGE_H))
+    page.fill(CANVAS_BG)
+    for line in lines:
+        images = [render_text(text, size, fmt, color) for _, text, (fmt, size, color) in line.segments]
+        draw_line(page, line, images, MARGIN, MARGIN + line.y)
+    return finish_page(page, png)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='export.py', description="render PyWord documents without a window")
+    parser.add_argument('documents', nargs='+', help="documents saved by PyWord (.pword or .json)")
+    parser.add_argument('-o', '--out', required=True, help="folder for <document>-001.png, ... or <document>.pdf")
+    parser.add_argument('--pdf', action='store_true', help="one PDF per document instead of a PNG per page")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (default: one per core)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # layout measures text, so this process needs fonts too
+    start()
+    get_font, _ = font_functions(FontCache())
+    documents = [(os.path.splitext(os.path.basename(path))[0], read_pages(path, get_font))
+                 for path in args.documents]
+    count = export(documents, args.out, args.pdf, render_page, args.jobs)
+    print(f"{count} pages -> {args.out}")
+
+
+if __name__ == '__main__':
+    main()
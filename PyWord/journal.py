@@ -0,0 +1,330 @@
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+from textbuffer import make_style
+
+# Operations are tuples:
+#   ('insert', pos, text, style)
+#   ('delete', pos, pieces)          pieces = ((text, style), ...) that were removed
+#   ('format', pos, pieces, style)   pieces = the runs before the change
+OP_OVERHEAD = 64
+
+
+def op_size(op):
+    if op[0] == 'insert':
+        return OP_OVERHEAD + len(op[2])
+    return OP_OVERHEAD + sum(len(text) + OP_OVERHEAD for text, _ in op[2])
+
+
+def pieces_length(pieces):
+    return sum(len(text) for text, _ in pieces)
+
+
+def apply(op, box):
+    kind = op[0]
+    if kind == 'insert':
+        box.insert_text(op[1], op[2], op[3])
+        return op[1] + len(op[2])
+    if kind == 'delete':
+        box.delete_text(op[1], pieces_length(op[2]))
+        return op[1]
+    box.format_text(op[1], pieces_length(op[2]), op[3])
+    return op[1] + pieces_length(op[2])
+
+
+def revert(op, box):
+    kind = op[0]
+    if kind == 'insert':
+        box.delete_text(op[1], len(op[2]))
+        return op[1]
+    pos = op[1]
+    if kind == 'format':
+        box.delete_text(pos, pieces_length(op[2]))
+    for text, style in op[2]:
+        box.insert_text(pos, text, style)
+        pos += len(text)
+    return pos
+
+
+class Journal:
+    # Undo/redo history of compact deltas. Typing and backspacing in one
+    # place coalesce into one entry; the oldest entries are dropped once the
+    # history grows past `limit` bytes.
+    def __init__(self, limit=8 * 1024 * 1024, coalesce_delay=1.0):
+        self.limit = limit
+        self.coalesce_delay = coalesce_delay
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.size = 0
+        self.log = None
+        self._replaying = False
+        self._last_time = 0.0
+        self._open = False
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.size = 0
+        self._open = False
+
+    def break_group(self):
+        self._open = False
+
+    def record(self, op):
+        if self.log is not None:
+            self.log.write(op)
+        if self._replaying:
+            return
+        self.redo_stack.clear()
+        now = time.monotonic()
+        if self._open and now - self._last_time < self.coalesce_delay and self._coalesce(op):
+            self._last_time = now
+            return
+        self._push([op])
+        self._open = op[0] != 'format'
+        self._last_time = now
+
+    def record_batch(self, ops):
+        # several operations that undo and redo as one step
+        if self.log is not None:
+            for op in ops:
+                self.log.write(op)
+        if self._replaying or not ops:
+            return
+        self.redo_stack.clear()
+        self._push(list(ops))
+        self._open = False
+
+    def _push(self, entry):
+        self.undo_stack.append(entry)
+        self.size += sum(op_size(op) for op in entry)
+        while self.size > self.limit and len(self.undo_stack) > 1:
+            for old in self.undo_stack.popleft():
+                self.size -= op_size(old)
+
+    def _coalesce(self, op):
+        entry = self.undo_stack[-1]
+        last = entry[-1]
+        if op[0] == 'insert' and last[0] == 'insert':
+            if '\n' in op[2] or op[3] is not last[3] or last[1] + len(last[2]) != op[1]:
+                return False
+            entry[-1] = ('insert', last[1], last[2] + op[2], last[3])
+        elif op[0] == 'delete' and last[0] == 'delete':
+            if op[1] + pieces_length(op[2]) == last[1]:
+                entry[-1] = ('delete', op[1], tuple(op[2]) + tuple(last[2]))
+            elif op[1] == last[1]:
+                entry[-1] = ('delete', last[1], tuple(last[2]) + tuple(op[2]))
+            else:
+                return False
+        else:
+            return False
+        self.size += op_size(entry[-1]) - op_size(last)
+        return True
+
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def undo(self, box):
+        # -> offset to put the cursor at, or None when there is nothing to undo
+        if not self.undo_stack:
+            return None
+        entry = self.undo_stack.pop()
+        self.size -= sum(op_size(op) for op in entry)
+        pos = self._run(entry, box, revert, reversed(entry))
+        self.redo_stack.append(entry)
+        return pos
+
+    def redo(self, box):
+        if not self.redo_stack:
+            return None
+        entry = self.redo_stack.pop()
+        pos = self._run(entry, box, apply, entry)
+        self.undo_stack.append(entry)
+        self.size += sum(op_size(op) for op in entry)
+        return pos
+
+    def _run(self, entry, box, step, ops):
+        self._replaying = True
+        self._open = False
+        try:
+            pos = None
+            for op in ops:
+                pos = step(op, box)
+            return pos
+        finally:
+            self._replaying = False
+
+
+def _style_json(style):
+    fmt, size, color = style
+    return [sorted(fmt), size, list(color)]
+
+
+def encode_op(op):
+    kind = op[0]
+    if kind == 'insert':
+        return {'i': op[1], 't': op[2], 's': _style_json(op[3])}
+    if kind == 'delete':
+        return {'d': op[1], 'n': pieces_length(op[2])}
+    return {'f': op[1], 'n': pieces_length(op[2]), 's': _style_json(op[3])}
+
+
+class JournalLog(threading.Thread):
+    # Appends every applied operation to a file from a background thread, so
+    # a crashed session can be rebuilt from the last saved file plus the log.
+    def __init__(self, path):
+        super().__init__(daemon=True)
+        self.path = path
+        self.queue = queue.Queue()
+        self.start()
+
+    def write(self, op):
+        self.queue.put(('op', encode_op(op)))
+
+    def reset(self, base, job=None):
+        # called on a save or load: the log starts over from that file, once
+        # the background write `job` has put it on disk
+        self.queue.put(('base', (os.path.abspath(base) if base else None, job)))
+
+    def close(self, remove=True):
+        self.queue.put(('close', remove))
+        self.join()
+
+    def run(self):
+        f = None
+        while True:
+            kind, value = self.queue.get()
+            batch = [(kind, value)]
+            while kind != 'close' and not self.queue.empty():
+                kind, value = self.queue.get()
+                batch.append((kind, value))
+            for kind, value in batch:
+                if kind == 'base':
+                    base, job = value
+                    if job is not None and job.wait() and job.error is not None:
+                        continue
+                    if f is not None:
+                        f.close()
+                    f = open(self.path, 'w', encoding='utf-8')
+                    f.write(json.dumps({'base': base}) + '\n')
+                elif kind == 'op':
+                    if f is None:
+                        f = open(self.path, 'w', encoding='utf-8')
+                        f.write(json.dumps({'base': None}) + '\n')
+                    f.write(json.dumps(value, ensure_ascii=False) + '\n')
+                else:
+                    if f is not None:
+                        f.close()
+                    if value and os.path.exists(self.path):
+                        os.remove(self.path)
+                    return
+            if f is not None:
+                f.flush()
+
+
+def read_log(path):
+    # -> (base file or None, [op dicts]); a torn last line from a crash is skipped
+    base, ops = None, []
+    with open(path, 'r', encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if i == 0:
+                base = record.get('base')
+            else:
+                ops.append(record)
+    return base, ops
+
+
+def replay(records, box):
+    for record in records:
+        if 'i' in record:
+            fmt, size, color = record['s']
+            box.insert_text(record['i'], record['t'], make_style(fmt, size, color))
+        elif 'd' in record:
+            box.delete_text(record['d'], record['n'])
+        elif 'f' in record:
+            fmt, size, color = record['s']
+            box.format_text(record['f'], record['n'], make_style(fmt, size, color))
+
+
+# Every running PyWord writes its own journal, <name>-<pid>-<start><ext>, and holds an
+# exclusive lock on <journal>.lock while it does. The OS drops the lock when
+# the process dies however it died, so a journal whose lock can be taken was
+# left behind by a crash; a running instance's journal is never touched.
+
+def session_journal(path):
+    # the start time keeps a reused pid from picking up a dead session's name
+    root, ext = os.path.splitext(path)
+    return f"{root}-{os.getpid()}-{time.time_ns()}{ext}"
+
+
+def lock_journal(path):
+    # -> the open lock file, or None when a live process holds the lock
+    f = open(path + '.lock', 'a+b')
+    try:
+        if os.name == 'nt':
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # the holder removes the file before it lets go (unlock_journal):
+            # a lock on a file that is no longer there guards nothing
+            if not os.path.samestat(os.fstat(f.fileno()), os.stat(path + '.lock')):
+                raise OSError
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+def unlock_journal(path, lock):
+    # the journal itself has to be gone first: another process may already be
+    # waiting to lock this file, and it then finds nothing to recover. The
+    # lock file goes while still held, so nobody can take it over in between;
+    # Windows cannot remove an open file, there it is closed first.
+    if os.name == 'nt':
+        lock.close()
+    try:
+        os.remove(path + '.lock')
+    except OSError:
+        pass
+    lock.close()
+
+
+def crashed_journals(path, own=None):
+    # -> [(journal, lock)] left by sessions that are no longer running, newest
+    # first; each is locked for the caller, who removes it and unlocks it
+    root, ext = os.path.splitext(path)
+    found = []
+    pattern = glob.escape(root) + '-*' + glob.escape(ext)
+    # a session that crashed before its first edit left only the lock file
+    names = set(glob.glob(pattern)) | {name[:-5] for name in glob.glob(pattern + '.lock')}
+    for name in names:
+        if name == own or not name[len(root) + 1:len(name) - len(ext)].replace('-', '').isdigit():
+            continue
+        lock = lock_journal(name)
+        if lock is None:
+            continue
+        if os.path.exists(name) and os.path.getsize(name):
+            found.append((name, lock))
+        else:
+            if os.path.exists(name):
+                os.remove(name)
+            unlock_journal(name, lock)
+    found.sort(key=lambda item: os.path.getmtime(item[0]), reverse=True)
+    return found
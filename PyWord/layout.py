@@ -0,0 +1,322 @@
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import accumulate
+
+import pygame
+
+FORMAT_BOLD = "bold"
+FORMAT_ITALIC = "italic"
+FORMAT_UNDERLINE = "underline"
+FORMAT_STRIKETHROUGH = "strikethrough"
+
+default_size = 20
+
+
+def font_functions(text_cache):
+    # get_font(size, fmt) and render_text(text, size, fmt, color) on a FontCache
+    def get_font(size, fmt):
+        return text_cache.font(size, bold=(FORMAT_BOLD in fmt), italic=(FORMAT_ITALIC in fmt),
+                               underline=(FORMAT_UNDERLINE in fmt))
+
+    def render_text(text, size, fmt, color):
+        return text_cache.render(text, color, size, bold=(FORMAT_BOLD in fmt), italic=(FORMAT_ITALIC in fmt),
+                                 underline=(FORMAT_UNDERLINE in fmt))
+    return get_font, render_text
+
+
+def draw_line(surf, line, images, x, y):
+    # one LineBox whose top-left is at (x, y); images are its segments rendered
+    for (sx, text, (fmt, sz, col)), image in zip(line.segments, images):
+        gx, gy = x + sx, y + line.height - sz
+        surf.blit(image, (gx, gy))
+        if FORMAT_STRIKETHROUGH in fmt:
+            pygame.draw.line(surf, col, (gx, gy+sz//2), (gx+image.get_width(), gy+sz//2), 1)
+
+
+class LineBox:
+    # One wrapped line of a paragraph. xs[i] is the x of the caret before
+    # character start+i, segments are runs of one style: (x, text, style).
+    __slots__ = ('start', 'end', 'y', 'height', 'xs', 'segments')
+
+    def __init__(self, start, end, y, height, xs, segments):
+        self.start = start
+        self.end = end
+        self.y = y
+        self.height = height
+        self.xs = xs
+        self.segments = segments
+
+
+def measure(font, text):
+    # per-character advances in one call, font.size only for glyphs metrics misses
+    advances = []
+    for ch, m in zip(text, font.metrics(text)):
+        advances.append(m[4] if m is not None else font.size(ch)[0])
+    return advances
+
+
+class ParagraphLayout:
+    def __init__(self, runs, width, get_font, empty_height):
+        self.surfaces = None
+        chars, advances, styles = [], [], []
+        for text, style in runs:
+            fmt, size, _ = style
+            chars.extend(text)
+            advances.extend(measure(get_font(size, fmt), text))
+            styles.extend([style] * len(text))
+        self.length = len(chars)
+        self.lines = []
+        y = 0
+        start = 0
+        n = len(chars)
+        while True:
+            end, x, last_space = start, 0, -1
+            while end < n:
+                if x + advances[end] > width and end > start:
+                    if chars[end] == ' ':
+                        end += 1
+                    elif last_space >= start:
+                        end = last_space + 1
+                    break
+                if chars[end] == ' ':
+                    last_space = end
+                x += advances[end]
+                end += 1
+            line = self._line(chars, advances, styles, start, end, y, empty_height)
+            self.lines.append(line)
+            y += line.height
+            start = end
+            if start >= n:
+                break
+        self.height = y
+        self.starts = [line.start for line in self.lines]
+        self.tops = [line.y for line in self.lines]
+
+    def _line(self, chars, advances, styles, start, end, y, empty_height):
+        xs = [0]
+        segments = []
+        height = 0
+        seg_start = start
+        for i in range(start, end):
+            xs.append(xs[-1] + advances[i])
+            if i + 1 == end or styles[i + 1] is not styles[i]:
+                style = styles[i]
+                segments.append((xs[seg_start - start], ''.join(chars[seg_start:i + 1]), style))
+                height = max(height, style[1])
+                seg_start = i + 1
+        return LineBox(start, end, y, height or empty_height, xs, segments)
+
+    def render(self, render_text):
+        # surfaces are made on first draw and dropped again by the cache
+        if self.surfaces is None:
+            self.surfaces = []
+            for line in self.lines:
+                row = []
+                for x, text, (fmt, size, color) in line.segments:
+                    row.append(render_text(text, size, fmt, color))
+                self.surfaces.append(row)
+        return self.surfaces
+
+    def release(self):
+        self.surfaces = None
+
+    def line_of(self, idx):
+        # the caret at a wrap point belongs to the following line
+        return self.lines[max(0, bisect_right(self.starts, idx) - 1)]
+
+    def caret(self, idx):
+        # (x, y, height) relative to the paragraph's top-left corner
+        line = self.line_of(idx)
+        i = min(max(idx - line.start, 0), len(line.xs) - 1)
+        return line.xs[i], line.y, line.height
+
+    def hit(self, x, y):
+        # character index closest to a point relative to the paragraph
+        line = self.lines[max(0, bisect_right(self.tops, y) - 1)]
+        xs = line.xs
+        mids = [(xs[i] + xs[i + 1]) / 2 for i in range(len(xs) - 1)]
+        i = bisect_right(mids, x)
+        if i == len(mids) and mids and line is not self.lines[-1]:
+            # stay on this line rather than jumping to the start of the next one
+            i -= 1
+        return line.start + i
+
+
+# paragraphs per HeightIndex block; a block is split once it has twice as many
+HEIGHT_BLOCK = 256
+
+
+def _fenwick(values):
+    tree = values[:]
+    n = len(tree)
+    for i in range(n):
+        j = i | (i + 1)
+        if j < n:
+            tree[j] += tree[i]
+    return tree
+
+
+def _fenwick_add(tree, index, delta):
+    while index < len(tree):
+        tree[index] += delta
+        index |= index + 1
+
+
+def _fenwick_prefix(tree, index):
+    total = 0
+    while index > 0:
+        total += tree[index - 1]
+        index &= index - 1
+    return total
+
+
+def _fenwick_find(tree, step, value):
+    # -> (how many leading entries add up to <= value, what is left of it)
+    pos = 0
+    while step:
+        nxt = pos + step
+        if nxt <= len(tree) and tree[nxt - 1] <= value:
+            pos = nxt
+            value -= tree[nxt - 1]
+        step >>= 1
+    return pos, value
+
+
+class HeightIndex:
+    # Paragraph heights in blocks of about HEIGHT_BLOCK, with Fenwick trees
+    # over the blocks' paragraph counts and total heights: prefix sums and
+    # "which paragraph is at y" in O(log n + HEIGHT_BLOCK). Splicing paragraphs
+    # in or out edits one block and both trees in place; only splitting a full
+    # block, or an edit across blocks, rebuilds the trees - over the blocks,
+    # not the paragraphs.
+    def __init__(self, heights=()):
+        self.build(list(heights))
+
+    def build(self, heights):
+        self.blocks = [heights[i:i + HEIGHT_BLOCK] for i in range(0, len(heights), HEIGHT_BLOCK)]
+        self._index()
+
+    def _index(self):
+        self.counts = _fenwick([len(block) for block in self.blocks])
+        self.sums = _fenwick([sum(block) for block in self.blocks])
+        self.size = _fenwick_prefix(self.counts, len(self.counts))
+        n = len(self.blocks)
+        self.step = 1 << max(0, n.bit_length() - 1) if n else 0
+
+    def _locate(self, index):
+        # -> (block, position in it) of paragraph `index`
+        return _fenwick_find(self.counts, self.step, index)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        block, i = self._locate(index)
+        return self.blocks[block][i]
+
+    def update(self, index, height):
+        block, i = self._locate(index)
+        delta = height - self.blocks[block][i]
+        if delta:
+            self.blocks[block][i] = height
+            _fenwick_add(self.sums, block, delta)
+
+    def prefix(self, index):
+        # total height of paragraphs [0, index)
+        if index >= self.size:
+            return self.total()
+        block, i = self._locate(index)
+        return _fenwick_prefix(self.sums, block) + sum(self.blocks[block][:i])
+
+    def total(self):
+        return _fenwick_prefix(self.sums, len(self.sums))
+
+    def find(self, y):
+        # index of the paragraph covering y, clamped to the document
+        block, y = _fenwick_find(self.sums, self.step, y)
+        index = _fenwick_prefix(self.counts, block)
+        if block < len(self.blocks):
+            index += bisect_right(list(accumulate(self.blocks[block])), y)
+        return min(index, self.size - 1)
+
+    def splice(self, index, removed, heights):
+        # paragraphs index..index+removed are replaced by `heights`
+        b0, i0 = self._locate(index)
+        b1, i1 = self._locate(index + removed)
+        if b0 == b1:
+            block = self.blocks[b0]
+            old = block[i0:i1 + 1]
+            block[i0:i1 + 1] = heights
+            if len(block) <= 2 * HEIGHT_BLOCK:
+                _fenwick_add(self.counts, b0, len(heights) - len(old))
+                _fenwick_add(self.sums, b0, sum(heights) - sum(old))
+                self.size += len(heights) - len(old)
+                return
+            joined = block
+        else:
+            # the blocks in between lie wholly inside the removed range
+            joined = self.blocks[b0][:i0] + heights + self.blocks[b1][i1 + 1:]
+        self.blocks[b0:b1 + 1] = [joined[i:i + HEIGHT_BLOCK] for i in range(0, len(joined), HEIGHT_BLOCK)]
+        self._index()
+
+
+class LayoutCache:
+    # Layouts indexed like the buffer's paragraphs; None means "needs layout".
+    # Heights of paragraphs not laid out yet are estimates in the HeightIndex.
+    # Only the most recently drawn paragraphs keep their rendered surfaces.
+    def __init__(self, empty_height, max_rendered=256):
+        self.items = [None]
+        self.empty_height = empty_height
+        self.heights = HeightIndex([empty_height])
+        self.max_rendered = max_rendered
+        self.rendered = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def reset(self, count, heights=None):
+        self._drop(self.items)
+        self.items = [None] * count
+        self.heights.build(heights if heights is not None else [self.empty_height] * count)
+
+    def invalidate(self, index):
+        self._drop(self.items[index:index + 1])
+        self.items[index] = None
+
+    def splice(self, index, removed, added):
+        # paragraphs index..index+removed became index..index+added
+        old = self.items[index:index + removed + 1]
+        self._drop(old)
+        self.items[index:index + removed + 1] = [None] * (added + 1)
+        if removed or added:
+            first = self.heights[index]
+            self.heights.splice(index, removed, [first] + [self.empty_height] * added)
+
+    def get(self, index):
+        return self.items[index]
+
+    def put(self, index, layout):
+        self.items[index] = layout
+        self.heights.update(index, layout.height)
+
+    def top(self, index):
+        return self.heights.prefix(index)
+
+    def total_height(self):
+        return self.heights.total()
+
+    def find(self, y):
+        return self.heights.find(y)
+
+    def touch(self, layout):
+        key = id(layout)
+        self.rendered[key] = layout
+        self.rendered.move_to_end(key)
+        while len(self.rendered) > self.max_rendered:
+            _, old = self.rendered.popitem(last=False)
+            old.release()
+
+    def _drop(self, layouts):
+        for layout in layouts:
+            if layout is not None and self.rendered.pop(id(layout), None) is not None:
+                layout.release()
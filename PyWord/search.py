@@ -0,0 +1,135 @@
+import re
+
+BITS = 2048
+
+
+def signature(text):
+    # bitmask of the paragraph's lowercase trigrams: a plain query can only
+    # occur in a paragraph that has every bit of the query's own signature
+    text = text.lower()
+    bits = bytearray(BITS // 8)
+    for h in map(hash, set(map(''.join, zip(text, text[1:], text[2:])))):
+        h &= BITS - 1
+        bits[h >> 3] |= 1 << (h & 7)
+    return int.from_bytes(bits, 'little')
+
+
+class SearchIndex:
+    # Indexed like the buffer's paragraphs and spliced with it, the same way
+    # as LayoutCache: a signature per paragraph (None = not indexed yet) and
+    # the current query's matches per paragraph (None = not searched yet).
+    def __init__(self):
+        self.signatures = [None]
+        self.hits = [None]
+        self.pattern = None
+        self.regex = False
+        self.query = 0
+
+    def reset(self, count):
+        self.signatures = [None] * count
+        self.hits = [None] * count
+
+    def splice(self, index, removed, added):
+        self.signatures[index:index + removed + 1] = [None] * (added + 1)
+        self.hits[index:index + removed + 1] = [None] * (added + 1)
+
+    def set_query(self, text, regex=False, case=False):
+        # -> message for a bad regular expression, else None
+        self.hits = [None] * len(self.hits)
+        self.pattern = None
+        self.regex = regex
+        if not text:
+            return None
+        try:
+            self.pattern = re.compile(text if regex else re.escape(text), 0 if case else re.IGNORECASE)
+        except re.error as e:
+            return str(e)
+        # a regex can match anything, so it scans every paragraph
+        self.query = 0 if regex else signature(text)
+        return None
+
+    def _text(self, buffer, line):
+        start = buffer.line_start(line)
+        return buffer.text(start, start + buffer.line_length(line))
+
+    def _prepare(self, buffer):
+        # when most paragraphs need their text, read them in one pass over the
+        # rope instead of looking each one up
+        q = self.query
+        need = sum(1 for sig, hits in zip(self.signatures, self.hits)
+                   if hits is None and (sig is None or sig & q == q))
+        if need <= len(self.hits) // 4:
+            return
+        for i, runs in enumerate(buffer.paragraphs()):
+            if self.hits[i] is None:
+                self._check(buffer, i, ''.join(text for text, _ in runs))
+
+    def _check(self, buffer, line, text=None):
+        hits = self.hits[line]
+        if hits is None:
+            sig = self.signatures[line]
+            if sig is not None and sig & self.query != self.query:
+                hits = []
+            else:
+                if text is None:
+                    text = self._text(buffer, line)
+                if sig is None:
+                    sig = self.signatures[line] = signature(text)
+                if sig & self.query != self.query:
+                    hits = []
+                else:
+                    hits = [m.span() for m in self.pattern.finditer(text) if m.end() > m.start()]
+            self.hits[line] = hits
+        return hits
+
+    def matches(self, buffer, line):
+        # [(start, end), ...] within paragraph `line`
+        if self.pattern is None:
+            return ()
+        return self._check(buffer, line)
+
+    def find(self, buffer, pos, backward=False):
+        # next match starting at or after offset pos (ending at or before it
+        # when backward), wrapping around the document -> (start, end) or None
+        if self.pattern is None:
+            return None
+        self._prepare(buffer)
+        line = buffer.line_of(pos)
+        idx = pos - buffer.line_start(line)
+        count = len(self.hits)
+        for step in range(count + 1):
+            i = (line - step if backward else line + step) % count
+            hits = self._check(buffer, i)
+            if step == 0:
+                hits = [h for h in hits if (h[1] <= idx if backward else h[0] >= idx)]
+            if hits:
+                start, end = hits[-1] if backward else hits[0]
+                base = buffer.line_start(i)
+                return base + start, base + end
+        return None
+
+    def replacements(self, buffer, repl):
+        # every match as (line, start, end, new text) in document order;
+        # re.error for a bad template, raised at the first match before the
+        # caller has changed anything
+        if self.pattern is None:
+            return []
+        self._prepare(buffer)
+        edits = []
+        for line in range(len(self.hits)):
+            if not self._check(buffer, line):
+                continue
+            base = buffer.line_start(line)
+            for m in self.pattern.finditer(self._text(buffer, line)):
+                if m.end() > m.start():
+                    edits.append((line, base + m.start(), base + m.end(), self._expand(m, repl)))
+        return edits
+
+    def _expand(self, m, repl):
+        if not self.regex:
+            return repl
+        try:
+            return m.expand(repl)
+        except IndexError as e:
+            # \g<name> for a group the pattern does not have
+            raise re.error(str(e)) from None
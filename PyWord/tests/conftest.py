@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the app's modules import each other by plain name, as when run from its folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
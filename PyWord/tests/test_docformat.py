@@ -0,0 +1,63 @@
+from docformat import DocumentFile, is_binary, pieces_from_json, write_document
+from textbuffer import TextBuffer, make_style
+
+PLAIN = make_style((), 20, (0, 0, 0))
+BOLD = make_style(('bold', 'italic'), 24, (200, 0, 0))
+
+
+def save(path, buffer):
+    with open(path, 'wb') as f:
+        write_document(f, buffer.paragraphs(), PLAIN)
+
+
+def test_binary_round_trip(tmp_path):
+    buffer = TextBuffer()
+    buffer.insert(0, 'plain start\n\nünïcödé 🙂 line\n' + 'long ' * 500 + '\nend', PLAIN)
+    buffer.set_style(6, 5, BOLD)
+    buffer.set_style(20, 4, BOLD)
+    path = str(tmp_path / 'doc.pword')
+    save(path, buffer)
+    assert is_binary(path)
+    doc = DocumentFile(path, cache_size=2)
+    try:
+        assert doc.count == buffer.line_count()
+        assert [doc.char_length(i) for i in range(doc.count)] == \
+            [buffer.line_length(i) for i in range(buffer.line_count())]
+        loaded = TextBuffer()
+        loaded.load(doc.pieces())
+        assert loaded.text() == buffer.text()
+        assert list(loaded.paragraphs()) == list(buffer.paragraphs())
+        # edits on top of the lazily loaded pieces
+        loaded.insert(3, 'X', BOLD)
+        loaded.delete(0, 1)
+        assert loaded.text() == buffer.text()[1:3] + 'X' + buffer.text()[3:]
+    finally:
+        doc.close()
+
+
+def test_save_over_a_loaded_document(tmp_path):
+    path = str(tmp_path / 'doc.pword')
+    buffer = TextBuffer()
+    buffer.insert(0, 'one\ntwo', PLAIN)
+    save(path, buffer)
+    doc = DocumentFile(path)
+    loaded = TextBuffer()
+    loaded.load(doc.pieces())
+    loaded.load(list(loaded.pieces()))
+    doc.close()
+    loaded.insert(0, 'zero\n', BOLD)
+    save(path, loaded)
+    again = DocumentFile(path)
+    try:
+        assert [''.join(t for t, _ in again.runs(i)) for i in range(again.count)] == ['zero', 'one', 'two']
+        assert again.runs(0) == [('zero', BOLD)]
+    finally:
+        again.close()
+
+
+def test_old_json_lines():
+    lines = [[['a', ['bold', 'italic'], 24, [200, 0, 0]], ['b', [], 20, [0, 0, 0]]], [], [['c', [], 20, [0, 0, 0]]]]
+    buffer = TextBuffer()
+    buffer.load(pieces_from_json(lines, PLAIN))
+    assert buffer.text() == 'ab\n\nc'
+    assert buffer.paragraph(0) == [('a', BOLD), ('b', PLAIN)]
@@ -0,0 +1,185 @@
+import json
+import os
+
+import pytest
+
+import journal
+from journal import (Journal, JournalLog, crashed_journals, lock_journal, read_log, replay,
+                     session_journal, unlock_journal)
+from textbuffer import TextBuffer, make_style
+
+PLAIN = make_style((), 20, (0, 0, 0))
+BOLD = make_style(('bold',), 20, (0, 0, 0))
+
+
+class Box:
+    # the part of word.TextBox the journal drives
+    def __init__(self, journal=None):
+        self.buffer = TextBuffer()
+        self.journal = journal or Journal()
+
+    def insert_text(self, pos, text, style):
+        self.buffer.insert(pos, text, style)
+        self.journal.record(('insert', pos, text, style))
+
+    def delete_text(self, pos, length):
+        removed = self.buffer.delete(pos, length)
+        self.journal.record(('delete', pos, tuple(removed)))
+        return removed
+
+    def format_text(self, pos, length, style):
+        old = self.buffer.set_style(pos, length, style)
+        self.journal.record(('format', pos, tuple(old), style))
+        return old
+
+    def runs(self):
+        return list(self.buffer.paragraphs())
+
+
+def test_undo_redo_round_trip():
+    box = Box(Journal(coalesce_delay=0))
+    states = [box.runs()]
+    box.insert_text(0, 'hello world', PLAIN)
+    states.append(box.runs())
+    box.format_text(0, 5, BOLD)
+    states.append(box.runs())
+    box.delete_text(3, 6)
+    states.append(box.runs())
+    box.insert_text(2, '\nX', PLAIN)
+    states.append(box.runs())
+    for state in reversed(states[:-1]):
+        assert box.journal.undo(box) is not None
+        assert box.runs() == state
+    assert box.journal.undo(box) is None
+    for state in states[1:]:
+        box.journal.redo(box)
+        assert box.runs() == state
+
+
+def test_typing_coalesces_into_one_step():
+    box = Box()
+    for i, ch in enumerate('word'):
+        box.insert_text(i, ch, PLAIN)
+    box.delete_text(3, 1)
+    box.delete_text(2, 1)
+    assert len(box.journal.undo_stack) == 2
+    box.journal.undo(box)
+    assert box.buffer.text() == 'word'
+    box.journal.undo(box)
+    assert box.buffer.text() == ''
+
+
+def test_a_new_edit_clears_redo():
+    box = Box()
+    box.insert_text(0, 'a', PLAIN)
+    box.journal.undo(box)
+    box.insert_text(0, 'b', PLAIN)
+    assert not box.journal.can_redo()
+
+
+def test_batch_undoes_as_one_step():
+    box = Box()
+    box.insert_text(0, 'aXbXc', PLAIN)
+    box.journal.break_group()
+    box.buffer.replace_many([(1, 2, '-'), (3, 4, '-')])
+    box.journal.record_batch([('delete', 1, (('X', PLAIN),)), ('insert', 1, '-', PLAIN),
+                              ('delete', 3, (('X', PLAIN),)), ('insert', 3, '-', PLAIN)])
+    assert box.buffer.text() == 'a-b-c'
+    box.journal.undo(box)
+    assert box.buffer.text() == 'aXbXc'
+    box.journal.redo(box)
+    assert box.buffer.text() == 'a-b-c'
+
+
+def test_history_is_bounded():
+    box = Box(Journal(limit=2000, coalesce_delay=0))
+    for i in range(100):
+        box.insert_text(i, '\n', PLAIN)
+    assert box.journal.size <= 2000
+    assert 1 <= len(box.journal.undo_stack) < 100
+
+
+def test_log_replays_the_session(tmp_path):
+    path = str(tmp_path / 'session.journal')
+    box = Box()
+    box.journal.log = JournalLog(path)
+    box.insert_text(0, 'first line\nsecond', PLAIN)
+    box.format_text(6, 4, BOLD)
+    box.delete_text(0, 6)
+    box.insert_text(0, 'ü ', PLAIN)
+    box.journal.log.close(remove=False)
+    base, records = read_log(path)
+    assert base is None
+    again = Box()
+    replay(records, again)
+    assert again.runs() == box.runs()
+
+
+def test_log_restarts_from_a_saved_file(tmp_path):
+    path = str(tmp_path / 'session.journal')
+    log = JournalLog(path)
+    log.write(('insert', 0, 'lost', PLAIN))
+    log.reset(str(tmp_path / 'doc.pword'))
+    log.write(('insert', 0, 'kept', PLAIN))
+    log.close(remove=False)
+    base, records = read_log(path)
+    assert base == os.path.abspath(tmp_path / 'doc.pword')
+    assert [r['t'] for r in records] == ['kept']
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    path = tmp_path / 'torn.journal'
+    path.write_text(json.dumps({'base': None}) + '\n' + json.dumps({'i': 0, 't': 'ok', 's': [[], 20, [0, 0, 0]]})
+                    + '\n{"i": 2, "t": "cut', encoding='utf-8')
+    base, records = read_log(str(path))
+    assert [r['t'] for r in records] == ['ok']
+
+
+def test_clean_close_removes_the_log(tmp_path):
+    path = str(tmp_path / 'session.journal')
+    log = JournalLog(path)
+    log.write(('insert', 0, 'x', PLAIN))
+    log.close()
+    assert not os.path.exists(path)
+
+
+def test_only_unlocked_journals_are_leftovers(tmp_path):
+    template = str(tmp_path / 'pyword.journal')
+    live = session_journal(template)
+    live_lock = lock_journal(live)
+    with open(live, 'w') as f:
+        f.write('{"base": null}\n')
+    dead = str(tmp_path / 'pyword-1-2.journal')
+    with open(dead, 'w') as f:
+        f.write('{"base": null}\n')
+    # a crash before the first edit leaves only a lock file
+    open(str(tmp_path / 'pyword-3-4.journal.lock'), 'w').close()
+    found = crashed_journals(template)
+    assert [path for path, _ in found] == [dead]
+    # while claimed it is nobody else's leftover
+    assert crashed_journals(template) == []
+    for path, lock in found:
+        os.remove(path)
+        unlock_journal(path, lock)
+    unlock_journal(live, live_lock)
+    assert sorted(os.listdir(tmp_path)) == [os.path.basename(live)]
+
+
+@pytest.mark.skipif(os.name == 'nt', reason="Windows cannot remove a held lock file")
+def test_lock_on_a_removed_lock_file_is_turned_down(tmp_path, monkeypatch):
+    path = str(tmp_path / 'pyword-1-2.journal')
+    lock = lock_journal(path)
+    assert lock_journal(path) is None
+    flock = journal.fcntl.flock
+
+    def unlock_in_between(fd, op):
+        # the holder unlocks right after this process opened the lock file
+        unlock_journal(path, lock)
+        flock(fd, op)
+    monkeypatch.setattr(journal.fcntl, 'flock', unlock_in_between)
+    assert lock_journal(path) is None
+    monkeypatch.setattr(journal.fcntl, 'flock', flock)
+    assert not os.path.exists(path + '.lock')
+    again = lock_journal(path)
+    assert again is not None
+    unlock_journal(path, again)
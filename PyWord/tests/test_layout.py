@@ -0,0 +1,35 @@
+import random
+
+import pytest
+
+pytest.importorskip('pygame')
+
+import layout
+from layout import HeightIndex
+
+
+@pytest.mark.parametrize('block', [1, 3, 256])
+def test_height_index_against_a_list(monkeypatch, block):
+    monkeypatch.setattr(layout, 'HEIGHT_BLOCK', block)
+    rnd = random.Random(block)
+    ref = [rnd.randint(1, 40) for _ in range(30)]
+    index = HeightIndex(ref)
+    for _ in range(1500):
+        if rnd.random() < 0.5:
+            i = rnd.randrange(len(ref))
+            removed = rnd.randint(0, min(len(ref) - 1 - i, rnd.choice([0, 2, 40])))
+            heights = [rnd.randint(1, 40) for _ in range(rnd.choice([1, 2, 30]))]
+            ref[i:i + removed + 1] = heights
+            index.splice(i, removed, heights)
+        else:
+            i = rnd.randrange(len(ref))
+            ref[i] = rnd.randint(1, 40)
+            index.update(i, ref[i])
+        assert len(index) == len(ref)
+        i = rnd.randrange(len(ref) + 1)
+        assert index.prefix(i) == sum(ref[:i])
+        assert index[min(i, len(ref) - 1)] == ref[min(i, len(ref) - 1)]
+        y = rnd.randint(0, sum(ref) + 10)
+        top = index.prefix(index.find(y))
+        assert top <= y
+        assert index.find(y) == len(ref) - 1 or y < top + index[index.find(y)]
@@ -0,0 +1,44 @@
+import re
+
+import pytest
+
+from search import SearchIndex
+from textbuffer import TextBuffer, make_style
+
+PLAIN = make_style((), 20, (0, 0, 0))
+
+
+def setup(text, query, regex=False, case=False):
+    buffer = TextBuffer()
+    buffer.insert(0, text, PLAIN)
+    search = SearchIndex()
+    search.reset(buffer.line_count())
+    assert search.set_query(query, regex, case) is None
+    return buffer, search
+
+
+def test_find_wraps_and_goes_back():
+    buffer, search = setup('Cat cat\nno\ncAt', 'cat')
+    assert search.find(buffer, 0) == (0, 3)
+    assert search.find(buffer, 1) == (4, 7)
+    assert search.find(buffer, 12) == (0, 3)
+    assert search.find(buffer, 11, backward=True) == (4, 7)
+
+
+def test_case_and_bad_pattern():
+    buffer, search = setup('Cat cat', 'cat', case=True)
+    assert search.find(buffer, 0) == (4, 7)
+    assert search.set_query('(', regex=True) is not None
+    assert search.find(buffer, 0) is None
+
+
+def test_regex_replacements():
+    buffer, search = setup('a1 b22\nc3', r'([a-z])(\d+)', regex=True)
+    assert search.replacements(buffer, r'\2\1') == [(0, 0, 2, '1a'), (0, 3, 6, '22b'), (1, 7, 9, '3c')]
+
+
+@pytest.mark.parametrize('template', [r'\2', r'\g<x>', '\\'])
+def test_bad_template_is_re_error(template):
+    buffer, search = setup('a1 b2', r'([a-z])\d', regex=True)
+    with pytest.raises(re.error):
+        search.replacements(buffer, template)
@@ -0,0 +1,113 @@
+import random
+
+import pytest
+
+from textbuffer import MAX_PIECE, TextBuffer, build, make_style, merge, split
+
+PLAIN = make_style((), 20, (0, 0, 0))
+BOLD = make_style(('bold',), 20, (0, 0, 0))
+
+
+def check(buffer, text):
+    assert buffer.text() == text
+    assert len(buffer) == len(text)
+    lines = text.split('\n')
+    assert buffer.line_count() == len(lines)
+    start = 0
+    for i, line in enumerate(lines):
+        assert buffer.line_start(i) == start
+        assert buffer.line_length(i) == len(line)
+        assert buffer.line_of(start) == i
+        start += len(line) + 1
+
+
+def walk(node):
+    # checks the treap's heap order and cached sums -> its text
+    if node is None:
+        return ''
+    for child in (node.left, node.right):
+        assert child is None or child.prio <= node.prio
+    text = walk(node.left) + node.text + walk(node.right)
+    assert node.length == len(text)
+    assert node.lines == text.count('\n')
+    return text
+
+
+def test_split_and_merge():
+    text = 'line one\nline two\n' * 200
+    root = build([(text[i:i + 37], PLAIN) for i in range(0, len(text), 37)])
+    for pos in (0, 1, 36, 37, 38, len(text) // 2, len(text) - 1, len(text)):
+        a, b = split(root, pos)
+        assert walk(a) == text[:pos]
+        assert walk(b) == text[pos:]
+        assert walk(merge(a, b)) == text
+    # the original root is untouched
+    assert walk(root) == text
+
+
+def test_insert_delete_against_a_string():
+    rnd = random.Random(3)
+    buffer, text = TextBuffer(), ''
+    for _ in range(400):
+        if text and rnd.random() < 0.4:
+            pos = rnd.randrange(len(text))
+            n = rnd.randint(1, 30)
+            removed = buffer.delete(pos, n)
+            assert ''.join(t for t, _ in removed) == text[pos:pos + n]
+            text = text[:pos] + text[pos + n:]
+        else:
+            pos = rnd.randint(0, len(text))
+            new = ''.join(rnd.choice('ab \n') for _ in range(rnd.choice([1, 5, 40, MAX_PIECE + 3])))
+            buffer.insert(pos, new, rnd.choice([PLAIN, BOLD]))
+            text = text[:pos] + new + text[pos:]
+    check(buffer, text)
+    assert walk(buffer.root) == text
+    assert buffer.text(10, 50) == text[10:50]
+
+
+def test_set_style_returns_the_old_runs():
+    buffer = TextBuffer()
+    buffer.insert(0, 'hello world', PLAIN)
+    old = buffer.set_style(6, 5, BOLD)
+    assert old == [('world', PLAIN)]
+    assert buffer.paragraph(0) == [('hello ', PLAIN), ('world', BOLD)]
+
+
+def test_snapshot_is_not_affected_by_edits():
+    buffer = TextBuffer()
+    buffer.insert(0, 'one\ntwo', PLAIN)
+    snap = buffer.snapshot()
+    buffer.delete(0, 4)
+    buffer.insert(0, 'x', BOLD)
+    assert snap.text() == 'one\ntwo'
+    assert buffer.text() == 'xtwo'
+
+
+def test_replace_many_matches_one_by_one():
+    rnd = random.Random(5)
+    text = ''.join(rnd.choice('abc\n') for _ in range(3000))
+    buffer = TextBuffer()
+    buffer.load([(text[i:i + 100], PLAIN if i % 200 else BOLD) for i in range(0, len(text), 100)])
+    edits, pos = [], 0
+    while True:
+        pos = text.find('ab', pos)
+        if pos < 0:
+            break
+        edits.append((pos, pos + 2, rnd.choice(['', 'X', 'long\nreplacement'])))
+        pos += 2
+    removed = buffer.replace_many(edits)
+    expected = text
+    for start, end, new in reversed(edits):
+        expected = expected[:start] + new + expected[end:]
+    check(buffer, expected)
+    assert all(''.join(t for t, _ in pieces) == 'ab' for pieces in removed)
+    # new text takes the style of what it replaced
+    start, end, new = next(e for e in edits if e[2])
+    assert next(buffer.pieces(start, start + 1))[1] is removed[edits.index((start, end, new))][0][1]
+
+
+@pytest.mark.parametrize('text', ['', 'a', '\n', 'a\n\nb\n'])
+def test_paragraphs(text):
+    buffer = TextBuffer()
+    buffer.insert(0, text, PLAIN)
+    assert [''.join(t for t, _ in runs) for runs in buffer.paragraphs()] == text.split('\n')
@@ -0,0 +1,293 @@
+import random
+
+MAX_PIECE = 512
+
+_styles = {}
+
+
+def make_style(fmt, size, color):
+    # styles are shared tuples (frozenset(fmt), size, color) so runs compare cheaply
+    key = (frozenset(fmt), size, tuple(color))
+    return _styles.setdefault(key, key)
+
+
+class Node:
+    # One styled piece of text in a treap ordered by position. Nodes are never
+    # modified once built, so an old root is a free snapshot of the document.
+    __slots__ = ('text', 'style', 'left', 'right', 'prio', 'length', 'lines')
+
+    def __init__(self, text, style, left=None, right=None, prio=None):
+        self.text = text
+        self.style = style
+        self.left = left
+        self.right = right
+        self.prio = random.random() if prio is None else prio
+        self.length = len(text)
+        self.lines = text.count('\n')
+        if left is not None:
+            self.length += left.length
+            self.lines += left.lines
+        if right is not None:
+            self.length += right.length
+            self.lines += right.lines
+
+    def with_children(self, left, right):
+        return Node(self.text, self.style, left, right, self.prio)
+
+
+def merge(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.prio > b.prio:
+        return a.with_children(a.left, merge(a.right, b))
+    return b.with_children(merge(a, b.left), b.right)
+
+
+def split(node, pos):
+    # -> (first pos characters, the rest)
+    if node is None:
+        return None, None
+    left_len = node.left.length if node.left is not None else 0
+    if pos <= left_len:
+        a, b = split(node.left, pos)
+        return a, node.with_children(b, node.right)
+    pos -= left_len
+    if pos >= len(node.text):
+        a, b = split(node.right, pos - len(node.text))
+        return node.with_children(node.left, a), b
+    head = Node(node.text[:pos], node.style, node.left, None, node.prio)
+    tail = Node(node.text[pos:], node.style, None, node.right, node.prio)
+    return head, tail
+
+
+def _append_last(node, text, style):
+    # grow the last piece in place of adding a node (typing coalesces this way)
+    if node is None:
+        return None
+    if node.right is None:
+        if node.style is not style or len(node.text) + len(text) > MAX_PIECE:
+            return None
+        return Node(node.text + text, style, node.left, None, node.prio)
+    right = _append_last(node.right, text, style)
+    if right is None:
+        return None
+    return node.with_children(node.left, right)
+
+
+def build(pieces):
+    # [(text, style), ...] -> treap in O(n), long runs cut into MAX_PIECE chunks
+    # a style of None marks a lazy piece (docformat.LazyText), kept whole
+    stack = []
+    for text, style in pieces:
+        step = MAX_PIECE if style is not None else max(1, len(text))
+        for i in range(0, len(text), step):
+            node = _Builder(text[i:i + step], style)
+            last = None
+            while stack and stack[-1].prio < node.prio:
+                last = stack.pop()
+            node.left = last
+            if stack:
+                stack[-1].right = node
+            stack.append(node)
+    if not stack:
+        return None
+    return stack[0].freeze()
+
+
+class _Builder:
+    __slots__ = ('text', 'style', 'left', 'right', 'prio')
+
+    def __init__(self, text, style):
+        self.text = text
+        self.style = style
+        self.left = self.right = None
+        self.prio = random.random()
+
+    def freeze(self):
+        out = []
+        work = [(self, False)]
+        while work:
+            b, expanded = work.pop()
+            if b is None:
+                out.append(None)
+            elif expanded:
+                right = out.pop()
+                left = out.pop()
+                out.append(Node(b.text, b.style, left, right, b.prio))
+            else:
+                work.append((b, True))
+                work.append((b.right, False))
+                work.append((b.left, False))
+        return out[0]
+
+
+def iter_pieces(node, start=0, end=None):
+    # (text, style) pieces overlapping [start, end), clipped to it
+    if node is None:
+        return
+    if end is None:
+        end = node.length
+    stack = [(node, 0, False)]
+    while stack:
+        node, base, emit = stack.pop()
+        if emit:
+            lo = max(0, start - base)
+            hi = min(len(node.text), end - base)
+            if lo < hi:
+                if node.style is None:
+                    yield from node.text.runs(lo, hi)
+                else:
+                    yield node.text[lo:hi], node.style
+            continue
+        if node is None or base >= end or base + node.length <= start:
+            continue
+        mid = base + (node.left.length if node.left is not None else 0)
+        stack.append((node.right, mid + len(node.text), False))
+        stack.append((node, mid, True))
+        stack.append((node.left, base, False))
+
+
+class TextBuffer:
+    def __init__(self, root=None):
+        self.root = root
+
+    def __len__(self):
+        return self.root.length if self.root is not None else 0
+
+    def snapshot(self):
+        return TextBuffer(self.root)
+
+    def line_count(self):
+        return (self.root.lines if self.root is not None else 0) + 1
+
+    def load(self, pieces):
+        self.root = build(pieces)
+
+    def insert(self, pos, text, style):
+        if not text:
+            return
+        left, right = split(self.root, pos)
+        grown = _append_last(left, text, style) if len(text) < MAX_PIECE else None
+        if grown is None:
+            grown = merge(left, build([(text, style)]))
+        self.root = merge(grown, right)
+
+    def delete(self, pos, length):
+        # -> removed (text, style) pieces, so callers can put them back
+        left, rest = split(self.root, pos)
+        removed, right = split(rest, length)
+        self.root = merge(left, right)
+        return list(iter_pieces(removed))
+
+    def set_style(self, pos, length, style):
+        left, rest = split(self.root, pos)
+        middle, right = split(rest, length)
+        old = list(iter_pieces(middle))
+        restyled = build([(''.join(text for text, _ in old), style)])
+        self.root = merge(merge(left, restyled), right)
+        return old
+
+    def replace_many(self, edits):
+        # edits: sorted, non-overlapping (start, end, text); each new text takes
+        # the style of what it replaces. One walk of splits and merges along the
+        # rope, however many edits. -> removed pieces of every edit
+        out, rest, done = None, self.root, 0
+        removed = []
+        for start, end, text in edits:
+            head, rest = split(rest, start - done)
+            cut, rest = split(rest, end - start)
+            pieces = list(iter_pieces(cut))
+            out = merge(out, head)
+            if text:
+                out = merge(out, build([(text, pieces[0][1])]))
+            removed.append(pieces)
+            done = end
+        self.root = merge(out, rest)
+        return removed
+
+    def text(self, start=0, end=None):
+        return ''.join(text for text, _ in iter_pieces(self.root, start, end))
+
+    def pieces(self, start=0, end=None):
+        return iter_pieces(self.root, start, end)
+
+    def line_start(self, line):
+        # offset of the first character of paragraph `line`
+        if line <= 0:
+            return 0
+        node = self.root
+        offset = 0
+        while node is not None:
+            left_lines = node.left.lines if node.left is not None else 0
+            if line <= left_lines:
+                node = node.left
+                continue
+            line -= left_lines
+            offset += node.left.length if node.left is not None else 0
+            here = node.text.count('\n')
+            if line <= here:
+                idx = -1
+                for _ in range(line):
+                    idx = node.text.index('\n', idx + 1)
+                return offset + idx + 1
+            line -= here
+            offset += len(node.text)
+            node = node.right
+        return len(self)
+
+    def line_of(self, pos):
+        # paragraph index that contains offset pos
+        node = self.root
+        line = 0
+        while node is not None:
+            left_len = node.left.length if node.left is not None else 0
+            if pos < left_len:
+                node = node.left
+                continue
+            line += node.left.lines if node.left is not None else 0
+            pos -= left_len
+            if pos < len(node.text):
+                return line + node.text.count('\n', 0, pos)
+            line += node.text.count('\n')
+            pos -= len(node.text)
+            node = node.right
+        return line
+
+    def offset(self, line, idx):
+        return self.line_start(line) + idx
+
+    def line_length(self, line):
+        start = self.line_start(line)
+        if line + 1 >= self.line_count():
+            return len(self) - start
+        return self.line_start(line + 1) - 1 - start
+
+    def paragraph(self, line):
+        # runs of paragraph `line` without its newline; neighbours of one style are joined
+        start = self.line_start(line)
+        end = start + self.line_length(line)
+        runs = []
+        for text, style in iter_pieces(self.root, start, end):
+            if runs and runs[-1][1] is style:
+                runs[-1] = (runs[-1][0] + text, style)
+            else:
+                runs.append((text, style))
+        return runs
+
+    def paragraphs(self):
+        # every paragraph's runs in order, in one pass over the pieces
+        runs = []
+        for text, style in iter_pieces(self.root):
+            parts = text.split('\n')
+            for i, part in enumerate(parts):
+                if i:
+                    yield runs
+                    runs = []
+                if part:
+                    if runs and runs[-1][1] is style:
+                        runs[-1] = (runs[-1][0] + part, style)
+                    else:
+                        runs.append((part, style))
+        yield runs
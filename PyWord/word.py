@@ -1,10 +1,23 @@
 import pygame
+import os
 import sys
 import json
+import re
 import tkinter as tk
-from tkinter import filedialog, colorchooser
+from tkinter import filedialog, colorchooser, messagebox
 import configparser
 import ast 
+from textbuffer import TextBuffer, make_style
+from layout import (ParagraphLayout, LayoutCache, font_functions, draw_line, default_size,
+                    FORMAT_BOLD, FORMAT_ITALIC, FORMAT_UNDERLINE, FORMAT_STRIKETHROUGH)
+from docformat import DocumentFile, EXTENSION, is_binary, write_document, pieces_from_json
+from journal import (Journal, JournalLog, read_log, replay, session_journal, lock_journal,
+                     unlock_journal, crashed_journals)
+from search import SearchIndex
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PyCommon'))
+from iowork import IOWorker, Autosave, autosave_path
+from fontcache import FontCache
+from profiler import Profiler
 
 Config = configparser.ConfigParser()
 Config.read('config.cfg')
@@ -13,6 +26,7 @@ root = tk.Tk()
 root.withdraw()
 
 pygame.init()
+io_worker = IOWorker()
 
 WIN_W, WIN_H = Config.getint('General', 'WIDTH'), Config.getint('General', 'HEIGHT')
 CANVAS_W, CANVAS_H = Config.getint('General', 'DOCUMENT_WIDTH'), Config.getint('General', 'DOCUMENT_HEIGHT')
@@ -23,24 +37,22 @@ DEFAULT_WINDOW_BG = ast.literal_eval(Config.get('Colors', 'DEFAULT_WINDOW_BG'))
 DEFAULT_CANVAS_BG = ast.literal_eval(Config.get('Colors', 'DEFAULT_CANVAS_BG'))
 DEFAULT_TEXT_COLOR = ast.literal_eval(Config.get('Colors', 'DEFAULT_TEXT_COLOR'))
 CURSOR_COLOR = ast.literal_eval(Config.get('Colors', 'CURSOR_COLOR'))
+MATCH_COLOR = (255, 240, 120)
+CURRENT_MATCH_COLOR = (255, 170, 60)
 FPS = Config.getint('General', 'FPS')
+UNDO_MEMORY = Config.getint('General', 'UNDO_MEMORY_KB', fallback=8192) * 1024
+JOURNAL_FILE = Config.get('General', 'JOURNAL_FILE', fallback='pyword.journal')
+AUTOSAVE_SECONDS = Config.getint('General', 'AUTOSAVE_SECONDS', fallback=60)
+CURSOR_BLINK_MS = Config.getint('General', 'CURSOR_BLINK_MS', fallback=530)
+TEXT_CACHE_KB = Config.getint('General', 'TEXT_CACHE_KB', fallback=8192)
 
-FORMAT_BOLD = "bold"
-FORMAT_ITALIC = "italic"
-FORMAT_UNDERLINE = "underline"
-FORMAT_STRIKETHROUGH = "strikethrough"
+FILE_TYPES = [('PyWord', '*' + EXTENSION), ('JSON', '*.json')]
 
-default_size = 20
-
-ttf_cache = {}
-def get_font(size, fmt):
-    key = (size, tuple(sorted(fmt)))
-    if key in ttf_cache:
-        return ttf_cache[key]
-    font = pygame.font.SysFont(None, size, bold=(FORMAT_BOLD in fmt), italic=(FORMAT_ITALIC in fmt))
-    font.set_underline(FORMAT_UNDERLINE in fmt)
-    ttf_cache[key] = font
-    return font
+text_cache = FontCache(TEXT_CACHE_KB * 1024)
+profiler = Profiler("PyWord", Config.getboolean('General', 'PROFILE', fallback=False),
+                    Config.get('General', 'TRACE_FILE', fallback=''), io_worker)
+profiler.watch('text', text_cache.stats, ('hits', 'misses', 'evictions'))
+get_font, render_text = font_functions(text_cache)
 
 class Toolbar:
     def __init__(self, width):
@@ -58,51 +70,319 @@ class Toolbar:
     def draw(self, surf, fmt, size, current_color):
         pygame.draw.rect(surf, (180, 180, 180), self.rect)
         pygame.draw.rect(surf, (150,150,150) if FORMAT_BOLD in fmt else (210,210,210), self.bold_btn)
-        surf.blit(get_font(18, {FORMAT_BOLD}).render("Abc", True, current_color), (self.bold_btn.x+3, self.bold_btn.y+7))
+        surf.blit(render_text("Abc", 18, {FORMAT_BOLD}, current_color), (self.bold_btn.x+3, self.bold_btn.y+7))
         
         pygame.draw.rect(surf, (150,150,150) if FORMAT_ITALIC in fmt else (210,210,210), self.italic_btn)
-        surf.blit(get_font(18, {FORMAT_ITALIC}).render("Abc", True, current_color), (self.italic_btn.x+3, self.italic_btn.y+7))
+        surf.blit(render_text("Abc", 18, {FORMAT_ITALIC}, current_color), (self.italic_btn.x+3, self.italic_btn.y+7))
         
         pygame.draw.rect(surf, (150,150,150) if FORMAT_UNDERLINE in fmt else (210,210,210), self.underline_btn)
-        surf.blit(get_font(18, {FORMAT_UNDERLINE}).render("Abc", True, current_color), (self.underline_btn.x+3, self.underline_btn.y+7))
+        surf.blit(render_text("Abc", 18, {FORMAT_UNDERLINE}, current_color), (self.underline_btn.x+3, self.underline_btn.y+7))
         
         pygame.draw.rect(surf, (150,150,150) if FORMAT_STRIKETHROUGH in fmt else (210,210,210), self.strike_btn)
-        surf.blit(get_font(18, set()).render("Abc", True, current_color), (self.strike_btn.x+3, self.strike_btn.y+7))
+        surf.blit(render_text("Abc", 18, set(), current_color), (self.strike_btn.x+3, self.strike_btn.y+7))
         
         pygame.draw.rect(surf, (210,210,210), self.size_up_btn)
-        surf.blit(get_font(18, set()).render("+", True, current_color), (self.size_up_btn.x+8, self.size_up_btn.y+5))
+        surf.blit(render_text("+", 18, set(), current_color), (self.size_up_btn.x+8, self.size_up_btn.y+5))
         
         pygame.draw.rect(surf, (210,210,210), self.size_down_btn)
-        surf.blit(get_font(18, set()).render("-", True, current_color), (self.size_down_btn.x+10, self.size_down_btn.y+5))
+        surf.blit(render_text("-", 18, set(), current_color), (self.size_down_btn.x+10, self.size_down_btn.y+5))
         
-        surf.blit(get_font(18, set()).render(f"Size: {size}", True, current_color), (self.size_down_btn.x+40, self.size_down_btn.y+10))
+        surf.blit(render_text(f"Size: {size}", 18, set(), current_color), (self.size_down_btn.x+40, self.size_down_btn.y+10))
         
         pygame.draw.rect(surf, (150,0,150), self.save_btn)
-        surf.blit(get_font(16, set()).render("Save", True, (255,255,255)), (self.save_btn.x+5, self.save_btn.y+7))
+        surf.blit(render_text("Save", 16, set(), (255,255,255)), (self.save_btn.x+5, self.save_btn.y+7))
         
         pygame.draw.rect(surf, (0,150,200), self.load_btn)
-        surf.blit(get_font(16, set()).render("Load", True, (255,255,255)), (self.load_btn.x+5, self.load_btn.y+7))
+        surf.blit(render_text("Load", 16, set(), (255,255,255)), (self.load_btn.x+5, self.load_btn.y+7))
         
         pygame.draw.rect(surf, current_color, self.color_btn)
         pygame.draw.rect(surf, (0,0,0), self.color_btn, 1)
 
+class FindBar:
+    # Find / replace fields on the right of the toolbar. Ctrl+F focuses the
+    # find field; Enter finds the next match, Shift+Enter the previous one,
+    # Tab switches fields and Escape goes back to the document.
+    def __init__(self):
+        self.find_rect = pygame.Rect(500, 5, 170, 30)
+        self.replace_rect = pygame.Rect(680, 5, 170, 30)
+        self.regex_btn = pygame.Rect(860, 5, 30, 30)
+        self.case_btn = pygame.Rect(895, 5, 30, 30)
+        self.all_btn = pygame.Rect(930, 5, 60, 30)
+        self.query = ""
+        self.replacement = ""
+        self.regex = False
+        self.case = False
+        self.focus = None
+        self.error = None
+        self.error_field = 'find'
+        self.found = True
+
+    def update(self, tb):
+        self.error = tb.search.set_query(self.query, self.regex, self.case)
+        self.error_field = 'find'
+        tb.current_match = None
+        self.found = True
+
+    def handle_click(self, pos, tb):
+        # -> True when the click was on the bar
+        if self.find_rect.collidepoint(pos):
+            self.focus = 'find'
+        elif self.replace_rect.collidepoint(pos):
+            self.focus = 'replace'
+        elif self.regex_btn.collidepoint(pos):
+            self.regex = not self.regex
+            self.update(tb)
+        elif self.case_btn.collidepoint(pos):
+            self.case = not self.case
+            self.update(tb)
+        elif self.all_btn.collidepoint(pos):
+            try:
+                self.found = tb.replace_all(self.replacement) > 0
+            except re.error as e:
+                # bad \1 / \g<name> in the template, nothing was replaced
+                self.error, self.error_field = str(e), 'replace'
+        else:
+            self.focus = None
+            return False
+        return True
+
+    def handle_key(self, event, tb):
+        if event.key == pygame.K_ESCAPE:
+            self.focus = None
+        elif event.key == pygame.K_TAB:
+            self.focus = 'replace' if self.focus == 'find' else 'find'
+        elif event.key == pygame.K_RETURN:
+            self.found = tb.find(backward=bool(event.mod & pygame.KMOD_SHIFT))
+        elif self.focus == 'find':
+            self.query = self.query[:-1] if event.key == pygame.K_BACKSPACE else self.query + self._char(event)
+            self.update(tb)
+        elif event.key == pygame.K_BACKSPACE:
+            self.replacement = self.replacement[:-1]
+            self._template_changed()
+        else:
+            self.replacement += self._char(event)
+            self._template_changed()
+
+    def _template_changed(self):
+        if self.error_field == 'replace':
+            self.error, self.error_field = None, 'find'
+
+    def _char(self, event):
+        return event.unicode if event.unicode and event.unicode.isprintable() else ""
+
+    def draw(self, surf):
+        for rect, text, field in ((self.find_rect, self.query, 'find'), (self.replace_rect, self.replacement, 'replace')):
+            bg = (255, 255, 255)
+            if (self.error and field == self.error_field) or (field == 'find' and not self.found):
+                bg = (255, 200, 200)
+            pygame.draw.rect(surf, bg, rect)
+            pygame.draw.rect(surf, (0, 0, 200) if self.focus == field else (0, 0, 0), rect, 1)
+            label = text or ("Find" if field == 'find' else "Replace")
+            color = (0, 0, 0) if text else (150, 150, 150)
+            prev_clip = surf.get_clip()
+            surf.set_clip(rect.inflate(-4, 0))
+            image = render_text(label, 18, set(), color)
+            surf.blit(image, (min(rect.x + 5, rect.right - 5 - image.get_width()), rect.y + 8))
+            surf.set_clip(prev_clip)
+        for rect, label, on in ((self.regex_btn, ".*", self.regex), (self.case_btn, "Aa", self.case)):
+            pygame.draw.rect(surf, (150,150,150) if on else (210,210,210), rect)
+            surf.blit(render_text(label, 18, set(), (0, 0, 0)), (rect.x+5, rect.y+8))
+        pygame.draw.rect(surf, (210,210,210), self.all_btn)
+        surf.blit(render_text("All", 16, set(), (0, 0, 0)), (self.all_btn.x+18, self.all_btn.y+9))
+
 class TextBox:
     def __init__(self, x, y):
         self.x, self.y = x, y
         self.rect = pygame.Rect(x, y, CANVAS_W, CANVAS_H)
-        self.lines = [[]]
+        self.buffer = TextBuffer()
+        self.layouts = LayoutCache(default_size)
+        self.search = SearchIndex()
+        self.current_match = None
         self.cursor = [0, 0]
         self.formatting = set()
         self.size = default_size
         self.text_color = DEFAULT_TEXT_COLOR
+        self.source = None
+        self.filename = None
+        self.journal = Journal(UNDO_MEMORY)
+        # background writes that may still read from self.source
+        self.jobs = []
+        self.autosave = Autosave(io_worker, AUTOSAVE_SECONDS)
+        self.autosaved = self.buffer.root
+        # what changed since the last frame, so only that gets redrawn
+        self.damaged = []
+        self.full_redraw = True
+        self.cursor_visible = True
+        self.last_view = None
+        self.last_cursor = None
 
         self.scroll_offset = 0
 
+    def current_style(self):
+        return make_style(self.formatting, self.size, self.text_color)
+
+    def layout(self, line):
+        lay = self.layouts.get(line)
+        if lay is None:
+            with profiler.phase('layout'):
+                lay = ParagraphLayout(self.buffer.paragraph(line), CANVAS_W - 10, get_font, default_size)
+            profiler.count('layouts')
+            self.layouts.put(line, lay)
+        return lay
+
+    # every edit goes through these three so the layouts and the journal follow it
+    def insert_text(self, pos, text, style):
+        line = self.buffer.line_of(pos)
+        self.damage(line, '\n' in text)
+        self.buffer.insert(pos, text, style)
+        self.layouts.splice(line, 0, text.count('\n'))
+        self.search.splice(line, 0, text.count('\n'))
+        self.current_match = None
+        self.journal.record(('insert', pos, text, style))
+
+    def delete_text(self, pos, length):
+        line = self.buffer.line_of(pos)
+        removed = self.buffer.delete(pos, length)
+        lines = sum(text.count('\n') for text, _ in removed)
+        self.damage(line, lines > 0)
+        self.layouts.splice(line, lines, 0)
+        self.search.splice(line, lines, 0)
+        self.current_match = None
+        self.journal.record(('delete', pos, tuple(removed)))
+        return removed
+
+    def format_text(self, pos, length, style):
+        line = self.buffer.line_of(pos)
+        old = self.buffer.set_style(pos, length, style)
+        lines = sum(text.count('\n') for text, _ in old)
+        self.damage(line, lines > 0)
+        self.layouts.splice(line, lines, lines)
+        self.journal.record(('format', pos, tuple(old), style))
+        return old
+
+    def damage(self, line, shifted):
+        # call before the edit: paragraph `line` changes, and with it everything
+        # below when paragraphs are added or removed or its height changes
+        self.damaged.append((line, self.layouts.heights[line], shifted))
+
+    def dirty_rects(self):
+        # screen rects that need redrawing since the last call
+        view = (self.scroll_offset, self.search.pattern, self.current_match)
+        cx, cy, ch = self.get_cursor_rect()
+        cursor = (pygame.Rect(cx - 1, cy + self.scroll_offset, 4, ch), self.cursor_visible)
+        if self.full_redraw or view != self.last_view:
+            rects = [self.rect.copy()]
+        else:
+            rects = []
+            origin = self.y + 5 + self.scroll_offset
+            count = self.buffer.line_count()
+            for line, old_height, shifted in self.damaged:
+                line = min(line, count - 1)
+                top = origin + self.paragraph_top(line)
+                # off screen nothing is laid out: below it nothing shows, above
+                # it only paragraphs added or removed move what is on screen
+                if top >= self.rect.bottom:
+                    continue
+                if top + old_height <= self.rect.top:
+                    if shifted:
+                        rects.append(self.rect.copy())
+                        break
+                    continue
+                height = self.layout(line).height
+                if shifted or height != old_height:
+                    height = self.rect.bottom - top
+                rects.append(pygame.Rect(self.rect.x, top, self.rect.width, height))
+            if cursor != self.last_cursor:
+                rects.append(cursor[0])
+                if self.last_cursor is not None:
+                    rects.append(self.last_cursor[0])
+        self.damaged = []
+        self.full_redraw = False
+        self.last_view = view
+        self.last_cursor = cursor
+        rects = [r.clip(self.rect) for r in rects]
+        return [r for r in rects if r.width and r.height]
+
+    def replace_all(self, repl):
+        # every match replaced in one pass over the rope, undone as one step
+        edits = self.search.replacements(self.buffer, repl)
+        if not edits:
+            return 0
+        # damage() wants the heights from before the edit
+        shifted = {}
+        for line, _, _, text in edits:
+            shifted[line] = shifted.get(line, False) or '\n' in text
+        for line, newlines in shifted.items():
+            self.damage(line, newlines)
+        removed = self.buffer.replace_many([(start, end, text) for _, start, end, text in edits])
+        ops = []
+        delta = 0
+        for (line, start, end, text), pieces in zip(edits, removed):
+            ops.append(('delete', start + delta, tuple(pieces)))
+            if text:
+                ops.append(('insert', start + delta, text, pieces[0][1]))
+            delta += len(text) - (end - start)
+        for line, _, _, text in reversed(edits):
+            self.layouts.splice(line, 0, text.count('\n'))
+            self.search.splice(line, 0, text.count('\n'))
+        self.journal.record_batch(ops)
+        self.current_match = None
+        self.set_cursor_offset(min(self.buffer.offset(*self.cursor), len(self.buffer)))
+        return len(edits)
+
+    def find(self, backward=False):
+        # select the next match from the cursor -> False when there is none
+        pos = self.buffer.offset(*self.cursor)
+        if self.current_match is not None and not backward:
+            pos = self.current_match[1]
+        elif self.current_match is not None:
+            pos = self.current_match[0]
+        match = self.search.find(self.buffer, pos, backward)
+        if match is None:
+            return False
+        self.current_match = match
+        self.set_cursor_offset(match[1])
+        self.scroll_to_cursor()
+        return True
+
+    def scroll_to_cursor(self):
+        _, cy, ch = self.get_cursor_rect()
+        top = cy + self.scroll_offset
+        if top < self.rect.top or top + ch > self.rect.bottom:
+            self.scroll_offset = self.rect.top + CANVAS_H // 3 - cy
+            total_height = self.document_height() + 10
+            self.scroll_offset = max(min(self.scroll_offset, 0), min(0, CANVAS_H - total_height))
+
+    def undo(self):
+        pos = self.journal.undo(self)
+        if pos is not None:
+            self.set_cursor_offset(pos)
+
+    def redo(self):
+        pos = self.journal.redo(self)
+        if pos is not None:
+            self.set_cursor_offset(pos)
+
+    def set_cursor_offset(self, pos):
+        line = self.buffer.line_of(pos)
+        self.cursor = [line, pos - self.buffer.line_start(line)]
+
+    def paragraph_top(self, line):
+        return self.layouts.top(line)
+
+    def document_height(self):
+        return self.layouts.total_height()
+
+    def estimate_heights(self, lengths):
+        # rough heights for paragraphs that have not been laid out yet
+        per_line = max(1, (CANVAS_W - 10) // (default_size // 2))
+        return [default_size * max(1, -(-length // per_line)) for length in lengths]
+
     def handle_event(self, event):
         if event.type == pygame.MOUSEWHEEL:
             if self.rect.collidepoint(pygame.mouse.get_pos()):
                 self.scroll_offset += event.y * self.size
-                total_height = len(self.lines) * self.size + 10
+                total_height = self.document_height() + 10
                 max_offset = 0
                 min_offset = min(0, CANVAS_H - total_height)
                 self.scroll_offset = max(min(self.scroll_offset, max_offset), min_offset)
@@ -111,93 +391,181 @@ class TextBox:
         if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.rect.collidepoint(event.pos):
             mx, my = event.pos
             self.set_cursor_by_pos(mx, my)
+            self.journal.break_group()
             return
 
         if event.type == pygame.KEYDOWN:
+            if event.mod & pygame.KMOD_CTRL:
+                if event.key == pygame.K_z and event.mod & pygame.KMOD_SHIFT or event.key == pygame.K_y:
+                    self.redo()
+                elif event.key == pygame.K_z:
+                    self.undo()
+                return
             line, idx = self.cursor
+            pos = self.buffer.offset(line, idx)
             if event.key == pygame.K_RETURN:
-                rest = self.lines[line][idx:]
-                self.lines[line] = self.lines[line][:idx]
-                self.lines.insert(line+1, rest)
+                self.insert_text(pos, '\n', self.current_style())
                 self.cursor = [line+1, 0]
             elif event.key == pygame.K_BACKSPACE:
-                if idx > 0:
-                    self.lines[line].pop(idx-1)
-                    self.cursor[1] -= 1
-                elif line > 0:
-                    prev_len = len(self.lines[line-1])
-                    self.lines[line-1] += self.lines[line]
-                    self.lines.pop(line)
-                    self.cursor = [line-1, prev_len]
+                if pos > 0:
+                    self.delete_text(pos-1, 1)
+                    self.set_cursor_offset(pos-1)
             else:
                 ch = event.unicode
-                if ch:
-                    self.lines[line].insert(idx, (ch, set(self.formatting), self.size, self.text_color))
-                    self.cursor[1] += 1
+                if ch and ch.isprintable():
+                    self.insert_text(pos, ch, self.current_style())
+                    self.cursor[1] += len(ch)
 
     def set_cursor_by_pos(self, mx, my):
         rel_y = my - (self.y + 5) - self.scroll_offset
-        line_index = max(0, min(len(self.lines)-1, rel_y // self.size))
-        rel_x = mx - (self.x + 5)
-        cum_x = 0
-        idx = 0
-        for ch, fmt, sz, col in self.lines[line_index]:
-            glyph_w, _ = get_font(sz, fmt).size(ch)
-            if cum_x + glyph_w/2 >= rel_x:
-                break
-            cum_x += glyph_w
-            idx += 1
+        line_index = self.layouts.find(max(0, rel_y))
+        lay = self.layout(line_index)
+        idx = lay.hit(mx - (self.x + 5), rel_y - self.paragraph_top(line_index))
         self.cursor = [line_index, idx]
 
-    def draw(self, surf):
-        pygame.draw.rect(surf, DEFAULT_CANVAS_BG, self.rect)
+    def draw(self, surf, area=None):
+        # redraws the canvas, or only the part of it inside `area`
+        area = self.rect if area is None else area.clip(self.rect)
+        pygame.draw.rect(surf, DEFAULT_CANVAS_BG, area)
         prev_clip = surf.get_clip()
-        surf.set_clip(self.rect)
-
-        y = self.y + 5 + self.scroll_offset
-        for line in self.lines:
-            x = self.x + 5
-            for ch, fmt, sz, col in line:
-                font = get_font(sz, fmt)
-                glyph = font.render(ch, True, col)
-                if x + glyph.get_width() > self.x + CANVAS_W - 5:
-                    x = self.x + 5
-                    y += sz
-                surf.blit(glyph, (x, y))
-                if FORMAT_STRIKETHROUGH in fmt:
-                    pygame.draw.line(surf, col, (x, y+sz//2), (x+glyph.get_width(), y+sz//2), 1)
-                x += glyph.get_width()
-            y += self.size
-
-        cx, cy = self.get_cursor_pos()
-        pygame.draw.rect(surf, CURSOR_COLOR, (cx, cy + self.scroll_offset, 2, self.size))
+        surf.set_clip(area)
+
+        first = self.layouts.find(max(0, area.top - (self.y + 5 + self.scroll_offset)))
+        y = self.y + 5 + self.scroll_offset + self.paragraph_top(first)
+        for i in range(first, self.buffer.line_count()):
+            if y >= area.bottom:
+                break
+            lay = self.layout(i)
+            self.draw_matches(surf, lay, i, self.x + 5, y)
+            self.draw_paragraph(surf, lay, self.x + 5, y)
+            y += lay.height
+
+        if self.cursor_visible:
+            cx, cy, ch = self.get_cursor_rect()
+            pygame.draw.rect(surf, CURSOR_COLOR, (cx, cy + self.scroll_offset, 2, ch))
         surf.set_clip(prev_clip)
 
-    def get_cursor_pos(self):
+    def draw_matches(self, surf, lay, index, x, y):
+        hits = self.search.matches(self.buffer, index)
+        if not hits:
+            return
+        base = self.buffer.line_start(index)
+        for start, end in hits:
+            current = self.current_match == (base + start, base + end)
+            for line in lay.lines:
+                lo, hi = max(start, line.start), min(end, line.end)
+                if lo < hi:
+                    x0, x1 = line.xs[lo - line.start], line.xs[hi - line.start]
+                    pygame.draw.rect(surf, CURRENT_MATCH_COLOR if current else MATCH_COLOR,
+                                     (x + x0, y + line.y, x1 - x0, line.height))
+
+    def draw_paragraph(self, surf, lay, x, y):
+        self.layouts.touch(lay)
+        for line, images in zip(lay.lines, lay.render(render_text)):
+            draw_line(surf, line, images, x, y + line.y)
+
+    def get_cursor_rect(self):
         line, idx = self.cursor
-        y = self.y + 5 + line * self.size
-        x = self.x + 5
-        for ch, fmt, sz, col in self.lines[line][:idx]:
-            x += get_font(sz, fmt).size(ch)[0]
+        cx, cy, height = self.layout(line).caret(idx)
+        return self.x + 5 + cx, self.y + 5 + self.paragraph_top(line) + cy, height
+
+    def get_cursor_pos(self):
+        x, y, _ = self.get_cursor_rect()
         return x, y
 
     def save(self, filename=None):
         if not filename:
-            filename = filedialog.asksaveasfilename(defaultextension='.json', filetypes=[('JSON','*.json')])
-        if filename:
-            data = {"lines": [[(c, list(f), s, col) for c, ф, s, col in line] for line in self.lines]}
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False)
+            filename = filedialog.asksaveasfilename(defaultextension=EXTENSION, filetypes=FILE_TYPES)
+        if not filename:
+            return
+        if filename.lower().endswith('.json'):
+            job = io_worker.submit(filename, self.json_writer(self.buffer.snapshot()))
+        else:
+            if self.source is not None and os.path.abspath(self.source.path) == os.path.abspath(filename):
+                # the old file is still mapped; pull its text in before replacing it
+                self.wait_io()
+                self.buffer.load(list(self.buffer.pieces()))
+                self.source.close()
+                self.source = None
+            job = io_worker.submit(filename, self.pword_writer(self.buffer.snapshot()), binary=True)
+        self.jobs.append(job)
+        self.filename = filename
+        self.saved(filename, job)
+
+    def saved(self, filename, job=None):
+        # the file now holds everything the recovery log had
+        if self.journal.log is not None:
+            self.journal.log.reset(filename, job)
+
+    # writers run on the I/O worker against a snapshot of the rope, so editing
+    # can carry on while they do
+    def pword_writer(self, snapshot):
+        default = make_style((), default_size, DEFAULT_TEXT_COLOR)
+        return lambda f: write_document(f, snapshot.paragraphs(), default)
+
+    def json_writer(self, snapshot):
+        def write(f):
+            lines = [[(c, sorted(fmt), sz, col) for text, (fmt, sz, col) in runs for c in text]
+                     for runs in snapshot.paragraphs()]
+            json.dump({"lines": lines}, f, ensure_ascii=False)
+        return write
+
+    def wait_io(self):
+        for job in self.jobs:
+            job.wait()
+        self.jobs = []
+
+    def poll_io(self):
+        # -> error of a finished background write, if any; also starts autosaves
+        error = None
+        for job in self.jobs:
+            if job.finished and job.error is not None:
+                error = job.error
+        self.jobs = [job for job in self.jobs if not job.finished]
+        if self.autosave.due() and self.buffer.root is not self.autosaved:
+            self.autosaved = self.buffer.root
+            path = autosave_path(self.filename, 'autosave' + EXTENSION)
+            self.jobs.append(self.autosave.save(path, self.pword_writer(self.buffer.snapshot()), binary=True))
+        return error
 
     def load(self, filename=None):
         if not filename:
-            filename = filedialog.askopenfilename(filetypes=[('JSON','*.json')])
-        if filename:
+            filename = filedialog.askopenfilename(filetypes=FILE_TYPES)
+        if not filename:
+            return
+        self.wait_io()
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+        if is_binary(filename):
+            self.source = DocumentFile(filename)
+            self.buffer.load(self.source.pieces())
+            lengths = [self.source.char_length(i) for i in range(self.source.count)] or [0]
+        else:
             with open(filename, 'r', encoding='utf-8') as f:
                 data = json.load(f)
-            self.lines = [[(c, set(f), s, tuple(col)) for c, f, s, col in line] for line in data.get("lines", [])]
-            self.cursor = [0, len(self.lines[0]) if self.lines else 0]
-            self.scroll_offset = 0
+            lines = data.get("lines", [])
+            self.buffer.load(pieces_from_json(lines, make_style((), default_size, DEFAULT_TEXT_COLOR)))
+            lengths = [len(line) for line in lines] or [0]
+        self.layouts.reset(self.buffer.line_count(), self.estimate_heights(lengths))
+        self.search.reset(self.buffer.line_count())
+        self.current_match = None
+        self.full_redraw = True
+        self.cursor = [0, 0]
+        self.scroll_offset = 0
+        self.journal.clear()
+        self.filename = filename
+        self.autosaved = self.buffer.root
+        self.saved(filename)
+
+    def recover(self, path):
+        # rebuild an unsaved session: the file it started from plus the logged edits
+        base, records = read_log(path)
+        if base and os.path.exists(base):
+            self.load(base)
+        replay(records, self)
+        self.journal.break_group()
+        self.set_cursor_offset(0)
 
 
 def main():
@@ -208,11 +576,58 @@ def main():
     canvas_x = (WIN_W - CANVAS_W) // 2
     canvas_y = TOOLBAR_HEIGHT + (WIN_H - TOOLBAR_HEIGHT - CANVAS_H) // 2
     toolbar = Toolbar(WIN_W)
+    findbar = FindBar()
     tb = TextBox(canvas_x, canvas_y)
 
+    # a journal nobody holds means its session did not exit cleanly; one is
+    # recovered into this window, the ones declined are dropped and the rest
+    # are offered again by the next PyWord started. This session's journal is
+    # open first, so the recovered edits are logged again in it
+    journal_path = session_journal(JOURNAL_FILE)
+    journal_lock = lock_journal(journal_path)
+    tb.journal.log = JournalLog(journal_path)
+    recovered = False
+    for path, lock in crashed_journals(JOURNAL_FILE, journal_path):
+        if not recovered:
+            base = read_log(path)[0]
+            name = os.path.basename(base) if base else "an untitled document"
+            if messagebox.askyesno("PyWord", f"Recover unsaved changes to {name} from a session that did not exit cleanly?"):
+                tb.recover(path)
+                recovered = True
+            os.remove(path)
+        unlock_journal(path, lock)
+
     running = True
+    full_redraw = True
+    toolbar_state = None
+    hud_rect = None
+    blink_at = pygame.time.get_ticks() + CURSOR_BLINK_MS
     while running:
-        for event in pygame.event.get():
+        profiler.frame()
+        profiler.enter('io')
+        error = tb.poll_io()
+        if error is not None:
+            pygame.display.set_caption(f"PyWord - {error}")
+        profiler.enter('events')
+        events = pygame.event.get()
+        if not events:
+            # idle: sleep until something happens or the cursor blinks
+            profiler.enter('idle')
+            timeout = blink_at - pygame.time.get_ticks() if CURSOR_BLINK_MS > 0 else 1000
+            event = pygame.event.wait(max(1, timeout))
+            if event.type != pygame.NOEVENT:
+                events = [event]
+            profiler.enter('events')
+        for event in events:
+            if profiler.handle_event(event):
+                # the overlay comes and goes over the whole window
+                full_redraw = True
+                continue
+            if event.type in (pygame.KEYDOWN, pygame.MOUSEBUTTONDOWN):
+                tb.cursor_visible = True
+                blink_at = pygame.time.get_ticks() + CURSOR_BLINK_MS
+            if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                full_redraw = True
             if event.type == pygame.QUIT:
                 running = False
             elif event.type == pygame.MOUSEBUTTONDOWN:
@@ -237,19 +652,59 @@ def main():
                     color = colorchooser.askcolor(initialcolor=tb.text_color)[0]
                     if color:
                         tb.text_color = tuple(map(int, color))
-                else:
+                elif not findbar.handle_click(pos, tb):
                     tb.handle_event(event)
             elif event.type == pygame.MOUSEWHEEL:
                 tb.handle_event(event)
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_f and event.mod & pygame.KMOD_CTRL:
+                findbar.focus = 'find'
+            elif event.type == pygame.KEYDOWN and findbar.focus:
+                findbar.handle_key(event, tb)
             else:
                 tb.handle_event(event)
 
-        screen.fill(DEFAULT_WINDOW_BG)
-        toolbar.draw(screen, tb.formatting, tb.size, tb.text_color)
-        tb.draw(screen)
-        pygame.display.flip()
+        if CURSOR_BLINK_MS > 0 and pygame.time.get_ticks() >= blink_at:
+            tb.cursor_visible = not tb.cursor_visible
+            blink_at = pygame.time.get_ticks() + CURSOR_BLINK_MS
+
+        # only what changed is drawn and pushed to the display
+        profiler.enter('draw')
+        state = (frozenset(tb.formatting), tb.size, tb.text_color, findbar.query, findbar.replacement,
+                 findbar.regex, findbar.case, findbar.focus, findbar.error, findbar.found)
+        rects = tb.dirty_rects()
+        if full_redraw:
+            screen.fill(DEFAULT_WINDOW_BG)
+            toolbar.draw(screen, tb.formatting, tb.size, tb.text_color)
+            findbar.draw(screen)
+            tb.draw(screen)
+            profiler.draw(screen)
+            profiler.enter('present')
+            pygame.display.flip()
+            full_redraw = False
+        else:
+            for rect in rects:
+                tb.draw(screen, rect)
+            if state != toolbar_state:
+                toolbar.draw(screen, tb.formatting, tb.size, tb.text_color)
+                findbar.draw(screen)
+                rects.append(toolbar.rect)
+            hud = profiler.draw(screen)
+            if hud is not None:
+                rects.append(hud)
+                # a smaller overlay leaves the old one showing around it
+                full_redraw = hud != hud_rect
+                hud_rect = hud
+            if rects:
+                profiler.enter('present')
+                pygame.display.update(rects)
+        toolbar_state = state
+        profiler.enter('idle')
         clock.tick(FPS)
 
+    profiler.close()
+    io_worker.close()
+    tb.journal.log.close()
+    unlock_journal(journal_path, journal_lock)
     pygame.quit()
     sys.exit()
 